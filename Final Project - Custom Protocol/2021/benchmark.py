@@ -0,0 +1,422 @@
+"""
+Reproducible benchmark harness.
+
+Every run starts receiver.py and sender.py as managed subprocesses on a seeded channel, times the transfer until both
+have exited, checks the output against the input and collects both sides' metrics: goodput, retransmission ratio,
+ACKs per segment and percentiles of the time from a segment's first transmission to its ACK, among others. Runs sweep
+over the inputs, modes, channel error probabilities, FEC settings and compression methods given on the command line.
+Results are printed as a table and written as JSON, so protocol changes can be compared across commits. Goodput counts
+input bytes per second, so with compression it includes the gain from sending fewer bytes, net of the time spent
+compressing.
+
+    python2 benchmark.py --input file_10MB.txt --drop-prob 0 0.005 0.02 --json results.json
+    python2 benchmark.py --input file_10MB.txt --channel "--burst-loss 0.001 0.3 --delay 0.005"
+    python2 benchmark.py --input file_10MB.txt --compress none zlib --channel "--bandwidth 2e6"
+
+With --simulate the runs happen in this process instead, over a loopback channel on simulated time: they are
+deterministic for a given seed, report simulated seconds, and take far less real time than the transfers they model.
+Simulated time only passes while frames are in flight or timers are pending, so a channel without a delay, jitter or
+a bandwidth limit gets a one way delay of SIMULATED_DELAY; without it every transfer would take next to no time.
+
+With --senders every run is many concurrent selective-repeat senders sending the input to one server (server.py)
+instead, simulated as well. It reports the aggregate goodput and percentiles of the time each sender took from its SYN
+to the answer to its FIN. The input is held in memory and sent by every sender, so keep it small:
+
+    python2 benchmark.py --simulate --input file_1MB.txt --senders 10 100 1000 --channel "--delay 0.01"
+"""
+
+import argparse
+import filecmp
+import hashlib
+import itertools
+import json
+import os
+import platform
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import channelmodels
+import compression
+import engine
+import loopback
+import metrics
+import packet
+import receiver
+import sender
+import server
+import utils
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# the inputs make_files.sh creates
+INPUTS = ("file_1MB.txt", "file_10MB.txt", "file_25MB.txt", "file_100MB.txt")
+MODES = ("stop-and-wait", "selective-repeat")
+# one way delay --simulate assumes when --channel sets neither a delay nor a bandwidth, in seconds
+SIMULATED_DELAY = 0.001
+
+
+def wait(process, deadline, name):
+    """
+    Wait for a process, killing it once the deadline has passed
+    :param process: subprocess.Popen
+    :param deadline: time.time() to give up at
+    :param name: what to call the process in errors
+    :return:
+    """
+    while process.poll() is None:
+        if time.time() > deadline:
+            process.kill()
+            process.wait()
+            raise RuntimeError("The {} did not finish in time".format(name))
+        time.sleep(0.01)
+    if process.returncode:
+        raise RuntimeError("The {} failed with exit code {}".format(name, process.returncode))
+
+
+def run(input_path, mode, seed, drop_prob, random_prob, swap_prob, fec=0, window=64, models=(), ack_every=2,
+        compress=None, limit=600):
+    """
+    Transfer a file once
+    :param input_path: file to send
+    :param mode: stop-and-wait or selective-repeat
+    :param seed: seed of the sender's channel, the receiver's channel uses seed + 1
+    :param drop_prob: drop frame error probability of both channels
+    :param random_prob: random bit error probability of both channels
+    :param swap_prob: swap frame error probability of both channels
+    :param fec: segments per parity segment for selective-repeat, 0 for none
+    :param window: window size for selective-repeat
+    :param models: extra channel model arguments for both sides, see channelmodels.add_arguments
+    :param ack_every: in-order segments per ACK for selective-repeat
+    :param compress: compression method, see compression.METHODS, None to send the input as it is
+    :param limit: seconds after which the run is killed and counted as failed
+    :return: dict describing the run
+    """
+    channel = ["--drop-prob", repr(drop_prob), "--random-prob", repr(random_prob), "--swap-prob", repr(swap_prob)]
+    common = ["--mode", mode] + channel + list(models)
+    if compress is not None:
+        common += ["--compress", compress]
+    if mode == "selective-repeat":
+        common += ["--window", str(window), "--fec", str(fec)]
+    fd, output_path = tempfile.mkstemp()
+    os.close(fd)
+    metrics_dir = tempfile.mkdtemp()
+    sender_path, receiver_path = (os.path.join(metrics_dir, name) for name in ("sender.json", "receiver.json"))
+    processes = []
+    try:
+        receiver_args = ["--output", output_path, "--seed", str(seed + 1), "--metrics", receiver_path]
+        if mode == "selective-repeat":
+            receiver_args += ["--timeout", "1", "--ack-every", str(ack_every)]
+        processes.append(subprocess.Popen([sys.executable, os.path.join(HERE, "receiver.py")] + common + receiver_args,
+                                          cwd=tempfile.gettempdir()))
+        # let the receiver bind its socket first
+        time.sleep(0.3)
+        deadline = time.time() + limit
+        with open(input_path, "rb") as stream:
+            start = time.time()
+            processes.append(subprocess.Popen([sys.executable, os.path.join(HERE, "sender.py")] + common +
+                                              ["--seed", str(seed), "--metrics", sender_path],
+                                              stdin=stream, cwd=tempfile.gettempdir()))
+            wait(processes[1], deadline, "sender")
+        # the receiver closes as soon as it answers the sender's FIN
+        wait(processes[0], deadline, "receiver")
+        seconds = time.time() - start
+        if not filecmp.cmp(input_path, output_path, shallow=False):
+            raise RuntimeError("Output differs from the input")
+        with open(sender_path) as snapshot:
+            sender_snapshot, = json.load(snapshot)["flows"]
+        with open(receiver_path) as snapshot:
+            receiver_snapshot, = json.load(snapshot)["flows"]
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        os.remove(output_path)
+        shutil.rmtree(metrics_dir)
+    return result(input_path, mode, seed, drop_prob, random_prob, swap_prob, fec, window, models, ack_every, compress,
+                  seconds, sender_snapshot, receiver_snapshot)
+
+
+class DigestWriter(object):
+    """
+    Output that only keeps a hash of what was written, so simulated transfers of big files need no memory for it
+    """
+
+    def __init__(self):
+        self.digest = hashlib.sha1()
+
+    def write(self, data):
+        self.digest.update(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def simulate(input_path, mode, seed, drop_prob, random_prob, swap_prob, fec=0, window=64, models=(), ack_every=2,
+             compress=None):
+    """
+    Transfer a file once in this process, over a loopback channel on simulated time. Takes the same arguments as
+    run(), but only selective-repeat can run on an event loop.
+    :return: dict describing the run, its seconds are simulated ones
+    """
+    if mode != "selective-repeat":
+        raise ValueError("Only selective-repeat can be simulated")
+    loop = engine.VirtualLoop()
+    network = loopback.Network(loop)
+    parser = argparse.ArgumentParser()
+    channelmodels.add_arguments(parser)
+    channel = ["--drop-prob", repr(drop_prob), "--random-prob", repr(random_prob), "--swap-prob", repr(swap_prob)]
+    sender_metrics, receiver_metrics = metrics.Metrics("sender"), metrics.Metrics("receiver")
+    output = DigestWriter()
+    rcvr = receiver.SelectiveRepeatReceiver(
+        window_size=window, timeout=1, output=compression.Decompressor(output) if compress is not None else output,
+        fec=fec, ack_every=ack_every, loop=loop, network=network, metrics=receiver_metrics,
+        **channelmodels.from_arguments(parser.parse_args(channel + list(models) + ["--seed", str(seed + 1)])))
+    sndr = sender.SelectiveRepeatSender(
+        window_size=window, fec=fec, loop=loop, network=network, metrics=sender_metrics,
+        **channelmodels.from_arguments(parser.parse_args(channel + list(models) + ["--seed", str(seed)])))
+    finished = []
+    expected = hashlib.sha1()
+    with open(input_path, "rb") as stream:
+        if compress is not None:
+            segments = utils.resegment(compression.compress(utils.read_segments(stream, compression.BLOCK_SIZE),
+                                                            compress), sndr.MSS)
+        else:
+            segments = utils.read_segments(stream, sndr.MSS)
+        rcvr.start()
+        sndr.start(segments, on_done=lambda: finished.append(loop.time()))
+        loop.run()
+        for segment in utils.read_segments(stream, 1 << 20):
+            expected.update(segment)
+    if not finished or output.digest.digest() != expected.digest():
+        raise RuntimeError("Output differs from the input")
+    return result(input_path, mode, seed, drop_prob, random_prob, swap_prob, fec, window, models, ack_every, compress,
+                  finished[0], sender_metrics.snapshot(), receiver_metrics.snapshot())
+
+
+def serve(input_path, senders, seed, drop_prob, random_prob, swap_prob, window=64, models=(), ack_every=2,
+          ack_budget=server.ACK_BUDGET):
+    """
+    Transfer a file from many senders at once to one server in this process, over loopback channels on simulated time
+    :param input_path: file every sender sends
+    :param senders: number of concurrent senders
+    :param seed: seed of the server's channel, sender n uses seed + 1 + n
+    :param ack_budget: ACKs per turn of the server's loop
+    :return: dict describing the run, see run() for the other arguments, its seconds are simulated ones
+    """
+    loop = engine.VirtualLoop()
+    network = loopback.Network(loop)
+    parser = argparse.ArgumentParser()
+    channelmodels.add_arguments(parser)
+    channel = ["--drop-prob", repr(drop_prob), "--random-prob", repr(random_prob), "--swap-prob", repr(swap_prob)]
+
+    def options(seed):
+        return channelmodels.from_arguments(parser.parse_args(channel + list(models) + ["--seed", str(seed)]))
+
+    with open(input_path, "rb") as stream:
+        data = stream.read()
+    expected = hashlib.sha1(data).digest()
+    # the connection IDs come from random
+    random.seed(seed)
+    outputs = {}
+
+    def output(connection):
+        writer = outputs[connection] = DigestWriter()
+        return writer
+
+    server_metrics, sender_metrics = metrics.Metrics("server"), metrics.Metrics("senders")
+    srvr = server.Server(output, window_size=window, timeout=1, loop=loop, ack_every=ack_every, ack_budget=ack_budget,
+                         max_sessions=senders, inbound_port=50005, network=network, metrics=server_metrics,
+                         **options(seed))
+    latencies = []
+    sndrs = []
+    for n in xrange(senders):
+        sndr = sender.SelectiveRepeatSender(
+            window_size=window, loop=loop, network=network, metrics=sender_metrics, inbound_port=50006 + n,
+            outbound_port=50005, **options(seed + 1 + n))
+
+        def established(reply, sndr=sndr):
+            sndr.start(utils.iter_segments(data, sndr.MSS), on_done=lambda: latencies.append(loop.time()))
+
+        sndr.connect(packet.REPLY.pack(sndr.inbound_port), established)
+        sndrs.append(sndr)
+    srvr.start()
+    start = time.time()
+    loop.run()
+    wall = time.time() - start
+    if len(latencies) != senders or any(outputs[sndr.connection].digest.digest() != expected for sndr in sndrs):
+        raise RuntimeError("Output differs from the input")
+    latencies.sort()
+    counters = sender_metrics.snapshot()["counters"]
+    segments = float(max(counters["segments_sent"], 1))
+    return {
+        "input": os.path.basename(input_path), "bytes": len(data), "senders": senders, "window": window,
+        "seed": seed, "drop_prob": drop_prob, "random_prob": random_prob, "swap_prob": swap_prob,
+        "models": " ".join(models), "ack_every": ack_every, "ack_budget": ack_budget, "seconds": latencies[-1],
+        "wall_seconds": wall, "goodput": len(data) * senders / latencies[-1],
+        "retransmission_ratio": counters["resends"] / segments,
+        "ack_ratio": server_metrics.snapshot()["counters"]["acks_sent"] / segments,
+        # every sender started at 0, so the time it finished is how long its session took
+        "session_latency": {"p50": latencies[(senders - 1) // 2], "p99": latencies[(senders * 99 - 1) // 100],
+                            "max": latencies[-1]},
+        "sender": sender_metrics.snapshot(), "server": server_metrics.snapshot(),
+    }
+
+
+def result(input_path, mode, seed, drop_prob, random_prob, swap_prob, fec, window, models, ack_every, compress,
+           seconds, sender_snapshot, receiver_snapshot):
+    size = os.path.getsize(input_path)
+    counters = sender_snapshot["counters"]
+    segments = float(max(counters["segments_sent"], 1))
+    return {
+        "input": os.path.basename(input_path), "bytes": size, "mode": mode, "window": window, "fec": fec,
+        "seed": seed, "drop_prob": drop_prob, "random_prob": random_prob, "swap_prob": swap_prob,
+        "models": " ".join(models), "ack_every": ack_every, "compress": compress or "none", "seconds": seconds,
+        # input bytes, however few of them went over the channel
+        "goodput": size / seconds, "compression_ratio": counters["bytes_sent"] / float(max(size, 1)),
+        "retransmission_ratio": counters["resends"] / segments,
+        "ack_ratio": receiver_snapshot["counters"]["acks_sent"] / segments,
+        "latency": sender_snapshot["histograms"]["ack_latency"],
+        "sender": sender_snapshot, "receiver": receiver_snapshot,
+    }
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def dump(path, runs, simulated):
+    with open(path, "w") as results:
+        json.dump({"commit": commit(), "python": platform.python_version(), "simulated": simulated, "runs": runs},
+                  results, indent=2)
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=HERE, stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", nargs="+", help="files to transfer, defaults to the ones make_files.sh creates")
+    parser.add_argument("--mode", nargs="+", choices=MODES, default=["selective-repeat"])
+    parser.add_argument("--drop-prob", type=float, nargs="+", default=[0.005])
+    parser.add_argument("--random-prob", type=float, nargs="+", default=[0.005])
+    parser.add_argument("--swap-prob", type=float, nargs="+", default=[0.005])
+    parser.add_argument("--fec", type=int, nargs="+", default=[0],
+                        help="segments per parity segment to try for selective-repeat, 0 is plain ARQ")
+    parser.add_argument("--compress", nargs="+", choices=["none"] + sorted(compression.METHODS), default=["none"],
+                        help="compression methods to try, none sends the input as it is")
+    parser.add_argument("--window", type=int, default=64)
+    parser.add_argument("--ack-every", type=int, default=receiver.ACK_EVERY,
+                        help="in-order segments per ACK for selective-repeat")
+    parser.add_argument("--channel", default="", help="extra channel model arguments for both sides, quoted")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the first repetition, the next ones count up")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per setting, the median is reported")
+    parser.add_argument("--json", help="file to write every run to")
+    parser.add_argument("--simulate", action="store_true",
+                        help="run in this process over a loopback channel on simulated time, selective-repeat only")
+    parser.add_argument("--senders", type=int, nargs="+",
+                        help="numbers of concurrent senders to try against one server, needs --simulate")
+    parser.add_argument("--ack-budget", type=int, default=server.ACK_BUDGET,
+                        help="ACKs per turn of the server's loop with --senders")
+    args = parser.parse_args()
+    if args.simulate and args.mode != ["selective-repeat"]:
+        parser.error("--simulate only supports --mode selective-repeat")
+    if args.senders and (not args.simulate or args.fec != [0] or args.compress != ["none"]):
+        parser.error("--senders needs --simulate, and supports neither --fec nor --compress")
+
+    if args.simulate:
+        channel_parser = argparse.ArgumentParser()
+        channelmodels.add_arguments(channel_parser)
+        channel = channel_parser.parse_args(shlex.split(args.channel))
+        if not channel.delay and not channel.jitter and channel.bandwidth is None:
+            args.channel += " --delay {}".format(SIMULATED_DELAY)
+            sys.stderr.write("--channel sets no delay, simulating a {} ms one way delay\n".format(
+                SIMULATED_DELAY * 1e3))
+
+    inputs = args.input or [path for path in (os.path.join(HERE, name) for name in INPUTS) if os.path.exists(path)]
+    if not inputs:
+        parser.error("no --input given and make_files.sh has not been run")
+
+    runs = []
+    if args.senders:
+        print("{:<16} {:>7} {:>6} {:>6} {:>6} {:>9} {:>9} {:>9} {:>8} {:>8} {:>9} {:>9}".format(
+            "input", "senders", "drop", "random", "swap", "seconds", "wall", "MB/s", "retx", "acks", "p50 ms",
+            "p99 ms"))
+        for input_path, senders, drop_prob, random_prob, swap_prob in itertools.product(
+                inputs, args.senders, args.drop_prob, args.random_prob, args.swap_prob):
+            repeats = [serve(input_path, senders, args.seed + n, drop_prob, random_prob, swap_prob, args.window,
+                             shlex.split(args.channel), args.ack_every, args.ack_budget) for n in xrange(args.repeat)]
+            runs += repeats
+            seconds, wall, goodput, retransmissions, acks = (
+                median([r[key] for r in repeats])
+                for key in ("seconds", "wall_seconds", "goodput", "retransmission_ratio", "ack_ratio"))
+            print("{:<16} {:>7} {:>6} {:>6} {:>6} {:>9.3f} {:>9.2f} {:>9.2f} {:>8.4f} {:>8.4f} {:>9.2f} "
+                  "{:>9.2f}".format(
+                      os.path.basename(input_path), senders, drop_prob, random_prob, swap_prob, seconds, wall,
+                      goodput / 1e6, retransmissions, acks,
+                      median([r["session_latency"]["p50"] for r in repeats]) * 1e3,
+                      median([r["session_latency"]["p99"] for r in repeats]) * 1e3))
+            sys.stdout.flush()
+        if args.json is not None:
+            dump(args.json, runs, True)
+        sys.exit()
+    # (input, mode, error probabilities, compression) -> {fec: median seconds}, for the FEC crossover
+    by_fec = {}
+    # (input, mode, error probabilities, fec) -> {compression: median goodput}, for the compression gain
+    by_compress = {}
+    print("{:<16} {:<16} {:>4} {:>5} {:>6} {:>6} {:>6} {:>9} {:>9} {:>6} {:>8} {:>8} {:>9} {:>9}".format(
+        "input", "mode", "fec", "comp", "drop", "random", "swap", "seconds", "MB/s", "size", "retx", "acks", "p50 ms",
+        "p99 ms"))
+    for input_path, mode, drop_prob, random_prob, swap_prob, fec, compress in itertools.product(
+            inputs, args.mode, args.drop_prob, args.random_prob, args.swap_prob, args.fec, args.compress):
+        if fec and mode != "selective-repeat":
+            continue
+        transfer = simulate if args.simulate else run
+        repeats = [transfer(input_path, mode, args.seed + n, drop_prob, random_prob, swap_prob, fec, args.window,
+                            shlex.split(args.channel), args.ack_every, None if compress == "none" else compress)
+                   for n in xrange(args.repeat)]
+        runs += repeats
+        by_fec.setdefault((input_path, mode, drop_prob, random_prob, swap_prob, compress), {})[fec] = median(
+            [r["seconds"] for r in repeats])
+        by_compress.setdefault((input_path, mode, drop_prob, random_prob, swap_prob, fec), {})[compress] = median(
+            [r["goodput"] for r in repeats])
+        print("{:<16} {:<16} {:>4} {:>5} {:>6} {:>6} {:>6} {:>9.3f} {:>9.2f} {:>6.3f} {:>8.4f} {:>8.4f} {:>9.2f} "
+              "{:>9.2f}".format(
+                  os.path.basename(input_path), mode, fec, compress, drop_prob, random_prob, swap_prob,
+                  median([r["seconds"] for r in repeats]), median([r["goodput"] for r in repeats]) / 1e6,
+                  median([r["compression_ratio"] for r in repeats]),
+                  median([r["retransmission_ratio"] for r in repeats]), median([r["ack_ratio"] for r in repeats]),
+                  median([r["latency"]["p50"] or 0 for r in repeats]) * 1e3,
+                  median([r["latency"]["p99"] or 0 for r in repeats]) * 1e3))
+        sys.stdout.flush()
+
+    for (input_path, mode, drop_prob, random_prob, swap_prob, compress), seconds in sorted(by_fec.items()):
+        if 0 not in seconds or len(seconds) == 1:
+            continue
+        crossover = next((fec for fec in sorted(seconds) if fec and seconds[fec] < seconds[0]), None)
+        print("{} {} drop={} random={} swap={}: {}".format(
+            os.path.basename(input_path), compress, drop_prob, random_prob, swap_prob,
+            "FEC beats plain ARQ from fec={}".format(crossover) if crossover is not None
+            else "FEC never beats plain ARQ"))
+    for (input_path, mode, drop_prob, random_prob, swap_prob, fec), goodput in sorted(by_compress.items()):
+        for compress in sorted(goodput):
+            if compress != "none" and "none" in goodput:
+                print("{} {} fec={} drop={} random={} swap={}: {} changes goodput by {:+.1f}%".format(
+                    os.path.basename(input_path), mode, fec, drop_prob, random_prob, swap_prob, compress,
+                    (goodput[compress] / goodput["none"] - 1) * 100))
+
+    if args.json is not None:
+        dump(args.json, runs, args.simulate)
@@ -0,0 +1,212 @@
+"""
+Pluggable channel models for ChannelSimulator.
+
+The simulator's own corrupt() draws independent drops, bit errors and swaps. Models are extra stages every frame
+goes through afterwards, in order. A model's process(frame, now) returns the frames to pass on as (frame, delay) pairs:
+an empty list drops the frame, a delay holds it back that many seconds, and a model that buffers frames (Reorder) can
+release older ones later. The simulator sends delayed frames once they are due.
+
+Every random model takes its own seed, so a run is reproducible model by model.
+"""
+
+import random
+
+# seeds between one flow's and the next, so that flows of nearby --seeds don't share error streams
+FLOW_SEEDS = 1000
+
+
+class GilbertElliott(object):
+    """
+    Two-state burst loss: a Markov chain moves between a good and a bad state once per frame, and each state loses
+    frames with its own probability. The mean burst length is 1 / bad_to_good frames.
+    """
+
+    def __init__(self, good_to_bad, bad_to_good, loss_good=0.0, loss_bad=1.0, seed=None):
+        """
+        :param good_to_bad: probability of going from good to bad, per frame
+        :param bad_to_good: probability of going from bad to good, per frame
+        :param loss_good: loss probability in the good state
+        :param loss_bad: loss probability in the bad state
+        :param seed: seed, None for a different run every time
+        """
+        self.good_to_bad = good_to_bad
+        self.bad_to_good = bad_to_good
+        self.loss_good = loss_good
+        self.loss_bad = loss_bad
+        self.random = random.Random(seed)
+        self.bad = False
+
+    def process(self, frame, now):
+        draw = self.random.random
+        if self.bad:
+            self.bad = draw() >= self.bad_to_good
+        else:
+            self.bad = draw() < self.good_to_bad
+        loss = self.loss_bad if self.bad else self.loss_good
+        # skip the second draw for the usual all-or-nothing states
+        if loss and (loss >= 1 or draw() < loss):
+            return []
+        return [(frame, 0.0)]
+
+
+class Delay(object):
+    """
+    Constant delay plus uniform jitter. Frames stay in order unless reordering is allowed, in which case jitter
+    lets later frames overtake earlier ones by any depth.
+    """
+
+    def __init__(self, delay, jitter=0.0, reorder=False, seed=None):
+        """
+        :param delay: one way delay, in seconds
+        :param jitter: each frame's delay is drawn from delay +- jitter, in seconds
+        :param reorder: let jitter reorder frames
+        :param seed: seed, None for a different run every time
+        """
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.random = random.Random(seed)
+        # arrival time of the last frame, to keep them in order
+        self.last_arrival = 0.0
+
+    def process(self, frame, now):
+        delay = self.delay
+        if self.jitter:
+            delay = max(delay + self.random.uniform(-self.jitter, self.jitter), 0.0)
+        if not self.reorder:
+            delay = max(delay, self.last_arrival - now)
+            self.last_arrival = now + delay
+        return [(frame, delay)]
+
+
+class Reorder(object):
+    """
+    Hold a frame back until up to depth later frames have passed it, like swap_queue but any number of frames deep
+    """
+
+    def __init__(self, probability, depth, seed=None):
+        """
+        :param probability: probability of holding a frame back
+        :param depth: the most frames a held frame lets past
+        :param seed: seed, None for a different run every time
+        """
+        self.probability = probability
+        self.depth = depth
+        self.random = random.Random(seed)
+        # [frames left to let past, frame]
+        self.held = []
+
+    def process(self, frame, now):
+        released = []
+        if self.held:
+            # every frame that arrives counts, held or not
+            for entry in self.held:
+                entry[0] -= 1
+            released = [(held, 0.0) for left, held in self.held if left <= 0]
+            self.held = [entry for entry in self.held if entry[0] > 0]
+        if self.random.random() < self.probability:
+            # the caller may reuse the frame's buffer
+            self.held.append([self.random.randint(1, self.depth), bytearray(frame)])
+            return released
+        # this frame is the last one to get past the ones released now
+        return [(frame, 0.0)] + released
+
+
+class Shaper(object):
+    """
+    Bandwidth limit: frames are serialized one after another at rate bytes per second behind a drop-tail queue
+    """
+
+    def __init__(self, rate, queue=None):
+        """
+        :param rate: bandwidth, in bytes per second
+        :param queue: the most seconds of backlog before frames are dropped, None for no limit
+        """
+        self.rate = float(rate)
+        self.queue = queue
+        # when the link is done with everything queued so far
+        self.free_at = 0.0
+
+    def process(self, frame, now):
+        start = max(now, self.free_at)
+        if self.queue is not None and start - now > self.queue:
+            return []
+        self.free_at = start + len(frame) / self.rate
+        return [(frame, self.free_at - now)]
+
+
+class TraceLoss(object):
+    """
+    Replay a recorded loss trace, one character per frame: 1 (or x) loses the frame, 0 (or .) delivers it.
+    Whitespace is ignored and the trace starts over once it runs out.
+    """
+
+    def __init__(self, trace):
+        """
+        :param trace: the trace as a string
+        """
+        self.trace = [c in "1xX" for c in trace if not c.isspace()]
+        if not self.trace:
+            raise ValueError("Empty loss trace")
+        self.position = 0
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as trace:
+            return cls(trace.read())
+
+    def process(self, frame, now):
+        lost = self.trace[self.position]
+        self.position = (self.position + 1) % len(self.trace)
+        return [] if lost else [(frame, 0.0)]
+
+
+def add_arguments(parser):
+    """
+    Add the channel options shared by the sender and the receiver
+    :param parser: argparse.ArgumentParser
+    :return:
+    """
+    group = parser.add_argument_group("channel")
+    group.add_argument("--seed", type=int, help="seed for the channel's errors")
+    group.add_argument("--drop-prob", type=float, default=0.005, help="drop frame error probability")
+    group.add_argument("--random-prob", type=float, default=0.005, help="random bit error probability")
+    group.add_argument("--swap-prob", type=float, default=0.005, help="swap frame error probability")
+    group.add_argument("--burst-loss", type=float, nargs=2, metavar=("GOOD_TO_BAD", "BAD_TO_GOOD"),
+                       help="Gilbert-Elliott burst loss, losing every frame in the bad state")
+    group.add_argument("--loss-trace", help="loss trace file to replay, 1 per lost frame and 0 per delivered one")
+    group.add_argument("--reorder", type=float, nargs=2, metavar=("PROBABILITY", "DEPTH"),
+                       help="hold frames back behind up to DEPTH later frames")
+    group.add_argument("--delay", type=float, default=0, help="one way delay, in seconds")
+    group.add_argument("--jitter", type=float, default=0,
+                       help="delay jitter, in seconds, frames keep their order unless --jitter-reorder is given")
+    group.add_argument("--jitter-reorder", action="store_true", help="let jitter reorder frames")
+    group.add_argument("--bandwidth", type=float, help="bandwidth limit, in bytes per second")
+
+
+def from_arguments(args, flow=0):
+    """
+    :param args: options parsed by a parser that add_arguments was called on
+    :param flow: flow number in parallel mode, every flow draws its own errors from --seed
+    :return: dict of ChannelSimulator keyword arguments
+    """
+    base = None if args.seed is None else args.seed + FLOW_SEEDS * flow
+
+    def seed(n):
+        # a different stream per model, all following --seed
+        return None if base is None else base * 100 + n
+
+    models = []
+    if args.burst_loss is not None:
+        models.append(GilbertElliott(*args.burst_loss, seed=seed(1)))
+    if args.loss_trace is not None:
+        models.append(TraceLoss.from_file(args.loss_trace))
+    if args.reorder is not None:
+        probability, depth = args.reorder
+        models.append(Reorder(probability, int(depth), seed=seed(2)))
+    if args.delay or args.jitter:
+        models.append(Delay(args.delay, args.jitter, reorder=args.jitter_reorder, seed=seed(3)))
+    if args.bandwidth is not None:
+        models.append(Shaper(args.bandwidth))
+    return dict(seed=base, drop_error_prob=args.drop_prob, random_error_prob=args.random_prob,
+                swap_error_prob=args.swap_prob, models=models)
@@ -1,18 +1,64 @@
 # Written by S. Mevawala, modified by D. Gitzel
 
+import binascii
+import errno
+import heapq
+import itertools
 import logging
+import random
 import socket
+import time
 from collections import deque
-from random import randint, choice, uniform
-from copy import deepcopy
 
+import metrics as metrics_
 import utils
 
 # region Helper Functions
 
 
-def random_bytes(n):
-    return bytearray([randint(0, 255) for i in xrange(n)])
+def random_bytes(n, rng=random):
+    """
+    Generate random bytes with a single call into the RNG
+    :param n: number of bytes
+    :param rng: random.Random instance (or the random module) to draw from
+    :return: byte array of n random bytes
+    """
+    if n == 0:
+        return bytearray()
+    return bytearray(binascii.unhexlify("%0*x" % (2 * n, rng.getrandbits(8 * n))))
+
+
+def xor_bytes(data_bytes, mask):
+    """
+    XOR two equal length byte strings as big integers instead of byte by byte
+    :param data_bytes: bytes to corrupt
+    :param mask: bytes to XOR in
+    :return: byte array of data_bytes ^ mask
+    """
+    n = len(data_bytes)
+    if n == 0:
+        return bytearray()
+    value = int(binascii.hexlify(data_bytes), 16) ^ int(binascii.hexlify(mask), 16)
+    return bytearray(binascii.unhexlify("%0*x" % (2 * n, value)))
+
+
+def describe(data_bytes):
+    """
+    Short description of a frame for debug logs, formatting all of it would dominate the cost of logging
+    :param data_bytes: frame
+    :return: its length and first bytes in hex
+    """
+    return "{} bytes {}...".format(len(data_bytes), binascii.hexlify(bytes(bytearray(data_bytes[:16]))))
+
+
+def iter_frames(data_bytes):
+    """
+    Lazily slice input into BUFFER_SIZE frames without copying it
+    :param data_bytes: input bytes (anything that supports the buffer protocol)
+    :return: generator of memoryviews of size BUFFER_SIZE into data_bytes
+    """
+    # split data into 1024 byte frames
+    return utils.iter_segments(data_bytes, ChannelSimulator.BUFFER_SIZE)
 
 
 def slice_frames(data_bytes):
@@ -21,19 +67,7 @@ def slice_frames(data_bytes):
     :param data_bytes: input bytes
     :return: list of frames of size BUFFER_SIZE
     """
-    frames = list()
-    num_bytes = len(data_bytes)
-    extra = 1 if num_bytes % ChannelSimulator.BUFFER_SIZE else 0
-
-    for i in xrange(num_bytes / ChannelSimulator.BUFFER_SIZE + extra):
-        # split data into 1024 byte frames
-        frames.append(
-            data_bytes[
-                i * ChannelSimulator.BUFFER_SIZE:
-                i * ChannelSimulator.BUFFER_SIZE + ChannelSimulator.BUFFER_SIZE
-            ]
-        )
-    return frames
+    return list(iter_frames(data_bytes))
 # endregion Helper Functions
 
 
@@ -43,22 +77,51 @@ class ChannelSimulator(object):
 
     PROTOCOL_VERSION = 5
     BUFFER_SIZE = 1024
+    # requested kernel socket buffer size, so that a whole window fits while the other side is busy
+    # (Linux silently caps it at net.core.rmem_max / wmem_max)
+    SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
     CORRUPTERS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 255)
+    # maps a random byte to a corrupter, the 6 bytes past the last multiple of len(CORRUPTERS) map to REDRAW so
+    # that every corrupter stays equally likely
+    REDRAW = b"\x03"
+    CORRUPTER_TABLE = bytes(
+        bytearray([CORRUPTERS[n % len(CORRUPTERS)] for n in range(256 - 256 % len(CORRUPTERS))]) +
+        bytearray(REDRAW) * (256 % len(CORRUPTERS))
+    )
     # endregion Constants
 
-    def __init__(self, inbound_port, outbound_port, debug_level=logging.INFO, ip_addr="127.0.0.1"):
+    def __init__(self, inbound_port, outbound_port, debug_level=logging.INFO, ip_addr="127.0.0.1", seed=None,
+                 drop_error_prob=0.005, random_error_prob=0.005, swap_error_prob=0.005, metrics=None, models=(),
+                 clock=time.time):
         """
         Create a ChannelSimulator
         :param inbound_port: port number for inbound connections
         :param outbound_port: port number of outbound connections
         :param debug_level: debug level for logging (e.g. logging.DEBUG)
         :param ip_addr: destination IP
+        :param seed: seed for the channel's errors, None for a different run every time
+        :param drop_error_prob: drop frame error probability of u_send
+        :param random_error_prob: random bit error probability of u_send
+        :param swap_error_prob: swap frame error probability of u_send
+        :param metrics: metrics.Metrics to count frames and errors in, None to not count
+        :param models: channelmodels stages that u_send passes frames through after corrupt(), in order
+        :param clock: function returning the current time in seconds, for the models' delays
         """
 
         self.ip = ip_addr
+        self.drop_error_prob = drop_error_prob
+        self.random_error_prob = random_error_prob
+        self.swap_error_prob = swap_error_prob
+        self.metrics = metrics
+        self.models = list(models)
+        # heap of (due time, tie breaker, frame) the models held back
+        self.delayed = []
+        self.order = itertools.count()
+        self.clock = clock
         self.sndr_socket = None
         self.rcvr_socket = None
-        self.swap_queue = deque([random_bytes(ChannelSimulator.BUFFER_SIZE), random_bytes(ChannelSimulator.BUFFER_SIZE)])
+        self.random = random.Random(seed)
+        self.swap_queue = deque(self.random_frames())
         self.debug = debug_level == logging.DEBUG
         if self.debug:
             self.logger = utils.Logger(self.__class__.__name__, debug_level)
@@ -68,6 +131,28 @@ class ChannelSimulator(object):
         self.sndr_port = outbound_port
         self.rcvr_port = inbound_port
 
+    def random_frames(self):
+        """
+        Two random frames to (re)fill the swap queue with, drawn in one go
+        :return: list of two BUFFER_SIZE byte arrays
+        """
+        frames = random_bytes(2 * ChannelSimulator.BUFFER_SIZE, self.random)
+        return [frames[:ChannelSimulator.BUFFER_SIZE], frames[ChannelSimulator.BUFFER_SIZE:]]
+
+    def random_errors(self, n):
+        """
+        Draw one corrupter per byte
+        :param n: number of bytes
+        :return: byte array of n corrupters, each picked uniformly from CORRUPTERS
+        """
+        mask = random_bytes(n, self.random).translate(ChannelSimulator.CORRUPTER_TABLE)
+        # only ~2% of the bytes landed on the biased tail, redraw those one by one
+        n = mask.find(ChannelSimulator.REDRAW)
+        while n != -1:
+            mask[n] = self.random.choice(ChannelSimulator.CORRUPTERS)
+            n = mask.find(ChannelSimulator.REDRAW, n + 1)
+        return mask
+
     def sndr_setup(self, timeout):
         """
         Setup the sender socket
@@ -75,6 +160,7 @@ class ChannelSimulator(object):
         :return:
         """
         self.sndr_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sndr_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, ChannelSimulator.SOCKET_BUFFER_SIZE)
         self.sndr_socket.settimeout(timeout)
 
     def rcvr_setup(self, timeout):
@@ -84,6 +170,7 @@ class ChannelSimulator(object):
         :return:
         """
         self.rcvr_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rcvr_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, ChannelSimulator.SOCKET_BUFFER_SIZE)
         self.rcvr_socket.bind((self.ip, self.rcvr_port))
         self.rcvr_socket.settimeout(timeout)
 
@@ -104,6 +191,66 @@ class ChannelSimulator(object):
             data, address = self.rcvr_socket.recvfrom(ChannelSimulator.BUFFER_SIZE)  # buffer size is 1024 bytes
             return bytearray(data)
 
+    def wait_for_frame(self):
+        """
+        (INTERNAL) get_from_socket, but keep sending delayed frames as they come due while it blocks
+        :return: bit string of data from the socket
+        """
+        if not self.delayed:
+            return self.get_from_socket()
+        timeout = self.rcvr_socket.gettimeout()
+        deadline = None if timeout is None else self.clock() + timeout
+        try:
+            while True:
+                due = self.send_due()
+                remaining = None if deadline is None else max(deadline - self.clock(), 0.0)
+                # wake up for the next delayed frame if it comes before the caller's timeout
+                woken = due is not None and (remaining is None or due < remaining)
+                self.rcvr_socket.settimeout(due if woken else remaining)
+                try:
+                    return self.get_from_socket()
+                except socket.timeout:
+                    if not woken:
+                        raise
+        finally:
+            self.rcvr_socket.settimeout(timeout)
+
+    def send_due(self):
+        """
+        Send the delayed frames that are due
+        :return: seconds until the next delayed frame is due, None if there is none
+        """
+        now = self.clock()
+        while self.delayed and self.delayed[0][0] <= now:
+            self.put_to_socket(heapq.heappop(self.delayed)[2])
+        return self.delayed[0][0] - now if self.delayed else None
+
+    def get_many_from_socket(self, max_frames, timeout=None):
+        """
+        (INTERNAL) Wait for one frame, then drain what is already queued on the socket without blocking
+        :param max_frames: maximum number of frames to return
+        :param timeout: seconds to wait for the first frame, None for the socket's own timeout
+        :return: list of bit strings of data from the socket
+        """
+        frames = []
+        previous_timeout = self.rcvr_socket.gettimeout()
+        if timeout is not None:
+            self.rcvr_socket.settimeout(timeout)
+        try:
+            frames.append(self.wait_for_frame())
+            # non-blocking: recv fails with EAGAIN as soon as the socket is empty
+            self.rcvr_socket.settimeout(0.0)
+            while len(frames) < max_frames:
+                frames.append(bytearray(self.rcvr_socket.recv(ChannelSimulator.BUFFER_SIZE)))
+        except socket.timeout:
+            raise
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        finally:
+            self.rcvr_socket.settimeout(previous_timeout)
+        return frames
+
     def corrupt(self, data_bytes, drop_error_prob=0.005, random_error_prob=0.005, swap_error_prob=0.005):
         """
         Corrupt data in the channel with random errors, swaps, and drops.
@@ -121,40 +268,50 @@ class ChannelSimulator(object):
         """
         if self.debug:
             logging.debug("Sending bytes through corrupting channel")
-        p_error = uniform(0, 1)
-        p_swap = uniform(0, 1)
-        p_drop = uniform(0, 1)
-        corrupted = deepcopy(data_bytes)
+        p_error = self.random.random()
+        p_swap = self.random.random()
+        p_drop = self.random.random()
+        # the frame is only copied if it actually gets corrupted
+        corrupted = data_bytes
+        if self.metrics is not None:
+            self.metrics.count(metrics_.CHANNEL_FRAMES)
         if p_drop < drop_error_prob:
+            if self.metrics is not None:
+                self.metrics.count(metrics_.CHANNEL_DROPS)
             if self.debug:
-                logging.debug("Dropping delayed and swapped frames: {}".format(self.swap_queue))
+                logging.debug("Dropping {} delayed and swapped frames".format(len(self.swap_queue)))
             # drop all the delayed frames in the swap queue
             self.swap_queue.clear()
-            self.swap_queue += [random_bytes(ChannelSimulator.BUFFER_SIZE), random_bytes(ChannelSimulator.BUFFER_SIZE)]
+            self.swap_queue += self.random_frames()
             if self.debug:
-                logging.debug("Dropping current frame: {}".format(data_bytes))
+                logging.debug("Dropping current frame: {}".format(describe(data_bytes)))
             return None
-        if p_error < random_error_prob:
+        # a swapped in frame replaces the corrupted one anyway, so skip the work
+        if p_error < random_error_prob and not p_swap < swap_error_prob:
+            if self.metrics is not None:
+                self.metrics.count(metrics_.CHANNEL_CORRUPTIONS)
             # insert random errors into the frame
             if self.debug:
-                logging.debug("Frame before random errors: {}".format(data_bytes))
-            for n in xrange(len(data_bytes)):
-                # XOR a random corrupter byte to change a single bit, none of the bits, or all the bits
-                corrupted[n] ^= choice(ChannelSimulator.CORRUPTERS)
+                logging.debug("Frame before random errors: {}".format(describe(data_bytes)))
+            # XOR a random corrupter byte to change a single bit, none of the bits, or all the bits
+            corrupted = xor_bytes(data_bytes, self.random_errors(len(data_bytes)))
             if self.debug:
-                logging.debug("Frame after random errors: {}".format(corrupted))
+                logging.debug("Frame after random errors: {}".format(describe(corrupted)))
         if p_swap < swap_error_prob:
+            if self.metrics is not None:
+                self.metrics.count(metrics_.CHANNEL_SWAPS)
             if self.debug:
-                logging.debug("Frame before swap: {}".format(data_bytes))
+                logging.debug("Frame before swap: {}".format(describe(data_bytes)))
             # swap packets with an earlier packet by popping it off the swap queue
             if p_swap < swap_error_prob / 2:
                 corrupted = self.swap_queue.pop()
             else:
                 corrupted = self.swap_queue.popleft()
             # store the current packet in the queue
-            self.swap_queue.append(data_bytes)
+            # the frame may be a view into a buffer the caller reuses, so the delayed copy has to be its own
+            self.swap_queue.append(bytearray(data_bytes))
             if self.debug:
-                logging.debug("Frame after swap: {}".format(corrupted))
+                logging.debug("Frame after swap: {}".format(describe(corrupted)))
         return corrupted
 
     def u_send(self, data_bytes):
@@ -165,15 +322,56 @@ class ChannelSimulator(object):
         """
 
         # split data into 1024 byte frames
-        for frame in slice_frames(data_bytes):
-            corrupted = self.corrupt(frame)
+        for frame in iter_frames(data_bytes):
+            corrupted = self.corrupt(frame, self.drop_error_prob, self.random_error_prob, self.swap_error_prob)
             # put corrupted frame into socket if it wasn't dropped
             if corrupted:
-                self.put_to_socket(corrupted)
+                if self.models:
+                    self.apply_models(corrupted)
+                else:
+                    self.put_to_socket(corrupted)
+
+    def apply_models(self, data_bytes):
+        """
+        (INTERNAL) Pass a frame through the channel models, then send it or hold it back until it is due
+        :param data_bytes: frame that made it through corrupt()
+        :return:
+        """
+        now = self.clock()
+        if self.delayed:
+            self.send_due()
+        passed = [(data_bytes, 0.0)]
+        for model in self.models:
+            passed = [(out, delay + extra)
+                      for frame, delay in passed for out, extra in model.process(frame, now + delay)]
+        for frame, delay in passed:
+            if delay > 0:
+                # the frame may be a view into a buffer the caller reuses
+                heapq.heappush(self.delayed, (now + delay, next(self.order), bytearray(frame)))
+            else:
+                self.put_to_socket(frame)
+
+    def u_send_many(self, frames):
+        """
+        Send several pieces of data through unreliable channel
+        :param frames: iterable of byte arrays to send, each is sent as if passed to u_send
+        :return:
+        """
+        for data_bytes in frames:
+            self.u_send(data_bytes)
 
     def u_receive(self):
         """
         Receive data through unreliable channel
         :return: byte array of data
         """
-        return self.get_from_socket()
+        return self.wait_for_frame()
+
+    def u_receive_many(self, max_frames=64, timeout=None):
+        """
+        Receive everything that is waiting in the unreliable channel, blocking only until the first frame arrives
+        :param max_frames: maximum number of frames to return
+        :param timeout: seconds to wait for the first frame, None for the socket's own timeout, 0 to not block at all
+        :return: list of byte arrays of data, only empty for a zero timeout (socket.timeout is raised instead)
+        """
+        return self.get_many_from_socket(max_frames, timeout)
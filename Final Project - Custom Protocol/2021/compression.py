@@ -0,0 +1,131 @@
+"""
+Optional compression stage between the input and segmentation.
+
+The sender cuts its input into blocks of BLOCK_SIZE bytes and compresses each one on its own, so the receiver can
+decompress block by block as the bytes arrive and neither side ever holds more than a block. A block that doesn't
+shrink by at least MIN_SAVING is sent raw instead, which the receiver only has to copy. After a raw block the sender
+compresses a PROBE_SIZE sample of the next one first, so incompressible input costs a fraction of the CPU time of
+compressing all of it.
+
+Python 2 has no lzma, bz2 is the stdlib's stronger (and much slower) alternative to zlib.
+
+Stream layout, one record per block:
+    0   - method (RAW, ZLIB or BZ2)
+    1:5 - length of the data that follows
+    5:  - data
+"""
+
+import bz2
+import struct
+import zlib
+
+RECORD = struct.Struct("!BI")
+# small enough that compressing one doesn't hold up the sender's event loop for longer than a round trip
+BLOCK_SIZE = 1 << 14
+PROBE_SIZE = 1 << 10
+# the smallest fraction of a block compression has to save for it to be worth decompressing
+MIN_SAVING = 0.05
+
+# region Methods
+
+RAW = 0
+ZLIB = 1
+BZ2 = 2
+# name -> (method, compress(data, level), decompress(data), default level)
+METHODS = {
+    "zlib": (ZLIB, zlib.compress, zlib.decompress, 1),
+    "bz2": (BZ2, bz2.compress, bz2.decompress, 9),
+}
+DECOMPRESSORS = dict((method, decompress) for method, _, decompress, _ in METHODS.values())
+# endregion Methods
+
+
+def as_bytes(data):
+    # zlib and bz2 only take strings and read-only buffers
+    return data if isinstance(data, str) else memoryview(data).tobytes()
+
+
+class Compressor(object):
+
+    def __init__(self, method="zlib", level=None):
+        """
+        :param method: name of the method, a key of METHODS
+        :param level: compression level, None for the method's default
+        """
+        self.method, self.compressor, _, default_level = METHODS[method]
+        self.level = level if level is not None else default_level
+        # the last block didn't compress, so probe the next one first
+        self.probing = False
+        self.raw_blocks = 0
+        self.compressed_blocks = 0
+
+    def worth_it(self, original, compressed):
+        return compressed <= original * (1 - MIN_SAVING)
+
+    def compress(self, blocks):
+        """
+        :param blocks: iterable of input blocks, at most 2 ** 32 - 1 bytes each
+        :return: generator of pieces of the compressed stream
+        """
+        for block in blocks:
+            block = as_bytes(block)
+            if not block:
+                continue
+            compressed = None
+            if not self.probing or len(block) <= PROBE_SIZE or self.worth_it(
+                    PROBE_SIZE, len(self.compressor(block[:PROBE_SIZE], self.level))):
+                compressed = self.compressor(block, self.level)
+            if compressed is not None and self.worth_it(len(block), len(compressed)):
+                self.compressed_blocks += 1
+                self.probing = False
+                yield RECORD.pack(self.method, len(compressed))
+                yield compressed
+            else:
+                self.raw_blocks += 1
+                self.probing = True
+                yield RECORD.pack(RAW, len(block))
+                yield block
+
+
+def compress(blocks, method="zlib", level=None):
+    """
+    Compress a stream, see Compressor
+    :return: generator of pieces of the compressed stream
+    """
+    return Compressor(method, level).compress(blocks)
+
+
+class Decompressor(object):
+    """
+    Output that decompresses the stream written to it and writes the result to another output
+    """
+
+    def __init__(self, output):
+        """
+        :param output: file-like object to write the decompressed stream to
+        """
+        self.output = output
+        # bytes of the record that is still incomplete
+        self.pending = bytearray()
+
+    def write(self, data):
+        self.pending += data
+        start = 0
+        while len(self.pending) - start >= RECORD.size:
+            method, length = RECORD.unpack_from(self.pending, start)
+            end = start + RECORD.size + length
+            if end > len(self.pending):
+                break
+            block = buffer(self.pending, start + RECORD.size, length)
+            if method == RAW:
+                self.output.write(block)
+            elif method in DECOMPRESSORS:
+                self.output.write(DECOMPRESSORS[method](block))
+            else:
+                raise ValueError("Unknown compression method {}".format(method))
+            start = end
+        if start:
+            del self.pending[:start]
+
+    def flush(self):
+        self.output.flush()
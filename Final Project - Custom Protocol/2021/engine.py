@@ -0,0 +1,181 @@
+"""
+Single threaded event loop for the windowed protocols.
+
+Python 2 has no asyncio, so this is a small select() based reactor in the same spirit: sockets register a callback
+for when they become readable, timers are cancellable one-shot callbacks kept on a heap, and any number of senders
+and receivers can share one loop without a thread per socket. VirtualLoop runs the same protocols on simulated time
+over loopback channels.
+"""
+
+import heapq
+import itertools
+import select
+import time
+
+
+class Timer(object):
+    __slots__ = ("loop", "when", "callback", "args", "cancelled")
+
+    def __init__(self, loop, when, callback, args):
+        self.loop = loop
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.loop.pending -= 1
+
+
+class EventLoop(object):
+
+    def __init__(self):
+        # socket -> callback to run when it is readable
+        self.readers = {}
+        # heap of (when, tie breaker, Timer), cancelled timers stay in it until they come up
+        self.timers = []
+        self.order = itertools.count()
+        # number of timers that are neither cancelled nor run yet
+        self.pending = 0
+        self.stopped = False
+
+    def time(self):
+        return time.time()
+
+    def call_later(self, delay, callback, *args):
+        """
+        Run callback(*args) after delay seconds
+        :param delay: seconds from now
+        :param callback: function to call
+        :return: Timer that can be cancelled
+        """
+        timer = Timer(self, self.time() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.when, next(self.order), timer))
+        self.pending += 1
+        return timer
+
+    def add_reader(self, sock, callback):
+        self.readers[sock] = callback
+
+    def remove_reader(self, sock):
+        self.readers.pop(sock, None)
+
+    def stop(self):
+        self.stopped = True
+
+    def wait(self, timeout):
+        """
+        Block until a reader is ready or timeout runs out, and run the ready readers
+        :param timeout: seconds, None to wait for a reader forever
+        :return:
+        """
+        if self.readers:
+            readable, _, _ = select.select(list(self.readers), [], [], timeout)
+            for sock in readable:
+                # an earlier callback may have removed it
+                callback = self.readers.get(sock)
+                if callback is not None:
+                    callback()
+        elif timeout:
+            time.sleep(timeout)
+
+    def run_once(self):
+        """
+        Wait for the next socket or timer event and run everything that is due
+        :return:
+        """
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        timeout = max(self.timers[0][0] - self.time(), 0) if self.timers else None
+        self.wait(timeout)
+        now = self.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                self.pending -= 1
+                timer.callback(*timer.args)
+
+    def run(self):
+        """
+        Run until stop() is called or there is nothing left to wait for
+        :return:
+        """
+        self.stopped = False
+        while not self.stopped and (self.readers or self.pending):
+            self.run_once()
+
+
+class VirtualLoop(EventLoop):
+    """
+    EventLoop on simulated time for loopback.Network channels: a reader is ready when its loopback socket has
+    datagrams queued, and waiting moves the clock straight to the next timer instead of sleeping.
+    """
+
+    def __init__(self, start=0.0):
+        super(VirtualLoop, self).__init__()
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def wait(self, timeout):
+        ready = [sock for sock in self.readers if sock.pending()]
+        if ready:
+            for sock in ready:
+                # an earlier callback may have removed it
+                callback = self.readers.get(sock)
+                if callback is not None:
+                    callback()
+        elif timeout is None:
+            raise RuntimeError("Waiting for readers that nothing will ever write to")
+        else:
+            self.now += timeout
+
+
+class ChannelTransport(object):
+    """
+    Connects a protocol to a ChannelSimulator: batches of frames read from the simulator's inbound socket are handed
+    to protocol.frames_received, and frames the protocol sends go out through the corrupting channel.
+    """
+
+    def __init__(self, loop, simulator, protocol, max_frames=64):
+        self.loop = loop
+        self.simulator = simulator
+        self.protocol = protocol
+        self.max_frames = max_frames
+        # timer that sends the frames the channel models delayed
+        self.flush_timer = None
+
+    def start(self):
+        self.loop.add_reader(self.simulator.rcvr_socket, self.readable)
+
+    def close(self):
+        self.loop.remove_reader(self.simulator.rcvr_socket)
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+    def readable(self):
+        frames = self.simulator.u_receive_many(self.max_frames, 0.0)
+        if frames:
+            self.protocol.frames_received(frames)
+
+    def send(self, frame):
+        self.simulator.u_send(frame)
+        self.schedule_flush()
+
+    def send_many(self, frames):
+        self.simulator.u_send_many(frames)
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.flush_timer is None and self.simulator.delayed:
+            self.flush_timer = self.loop.call_later(max(self.simulator.delayed[0][0] - self.loop.time(), 0),
+                                                    self.flush)
+
+    def flush(self):
+        self.flush_timer = None
+        self.simulator.send_due()
+        self.schedule_flush()
@@ -0,0 +1,94 @@
+"""
+XOR parity forward error correction.
+
+Every block of K consecutive segments (block starts are multiples of K) is followed by one parity segment holding the
+XOR of the block's payload lengths and of its payloads, zero padded to the segment size. A receiver that is missing
+exactly one segment of a block rebuilds it from the parity and the others instead of waiting for a retransmission.
+"""
+
+import binascii
+import struct
+
+LENGTH = struct.Struct("!H")
+# a parity payload is this much longer than the segments it protects
+OVERHEAD = LENGTH.size
+
+
+def to_int(payload, size):
+    """
+    Read a payload as a big integer, zero padded on the right to size bytes
+    :param payload: bytes
+    :param size: padded length
+    :return: int
+    """
+    if not len(payload):
+        return 0
+    return int(binascii.hexlify(payload), 16) << 8 * (size - len(payload))
+
+
+def to_bytes(value, size):
+    """
+    Inverse of to_int
+    :param value: int
+    :param size: padded length
+    :return: byte array of size bytes
+    """
+    return bytearray(binascii.unhexlify("%0*x" % (2 * size, value)))
+
+
+class ParityEncoder(object):
+
+    def __init__(self, block_size, segment_size):
+        """
+        :param block_size: K, segments per parity segment
+        :param segment_size: maximum payload length
+        """
+        self.block_size = block_size
+        self.segment_size = segment_size
+        self.count = 0
+        self.length = 0
+        self.value = 0
+
+    def add(self, payload):
+        """
+        XOR the next segment of the block in
+        :param payload: bytes of the segment
+        :return: (number of segments covered, parity payload) once the block is full, else None
+        """
+        self.count += 1
+        self.length ^= len(payload)
+        self.value ^= to_int(payload, self.segment_size)
+        if self.count == self.block_size:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """
+        Close the current, possibly partial, block
+        :return: (number of segments covered, parity payload), or None if the block is empty
+        """
+        if not self.count:
+            return None
+        parity = (self.count, bytearray(LENGTH.pack(self.length)) + to_bytes(self.value, self.segment_size))
+        self.count = 0
+        self.length = 0
+        self.value = 0
+        return parity
+
+
+def recover(parity, payloads):
+    """
+    Rebuild the one missing segment of a block
+    :param parity: parity payload of the block
+    :param payloads: payloads of all the other segments of the block
+    :return: payload of the missing segment
+    """
+    size = len(parity) - OVERHEAD
+    length, = LENGTH.unpack_from(parity)
+    value = to_int(memoryview(parity)[OVERHEAD:], size)
+    for payload in payloads:
+        length ^= len(payload)
+        value ^= to_int(payload, size)
+    if length > size:
+        raise ValueError("Parity does not match the block")
+    return to_bytes(value, size)[:length]
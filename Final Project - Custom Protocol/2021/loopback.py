@@ -0,0 +1,133 @@
+"""
+In-process loopback channel: ChannelSimulator with the UDP sockets swapped for in-memory queues.
+
+A Network maps port numbers to queues. LoopbackChannel is a ChannelSimulator whose sockets live on a Network, so
+u_send/u_receive and the corruption and channel models behave exactly as over UDP, without binding real ports.
+
+With a plain Network the queues block like sockets, which suits the blocking stop-and-wait classes in threads. With
+Network(engine.VirtualLoop()) the windowed protocols run on simulated time instead: nothing ever blocks, the clock
+jumps from one timer to the next, and a transfer takes as long as the CPU needs rather than as long as its timeouts,
+with the same outcome for the same seeds every time.
+"""
+
+import errno
+import socket
+import threading
+import time
+from collections import deque
+
+from channelsimulator import ChannelSimulator
+
+
+class LoopbackSocket(object):
+    """
+    The part of the UDP socket API ChannelSimulator uses. Datagrams past the receive buffer are dropped like the
+    kernel does.
+    """
+
+    def __init__(self, network, capacity):
+        """
+        :param network: Network the socket sends on
+        :param capacity: the most datagrams to queue
+        """
+        self.network = network
+        self.capacity = capacity
+        self.queue = deque()
+        self.timeout = None
+        self.condition = threading.Condition()
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def setsockopt(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def pending(self):
+        """
+        :return: True if a recv would not block, used by engine.VirtualLoop instead of select()
+        """
+        return bool(self.queue)
+
+    def put(self, data):
+        with self.condition:
+            if len(self.queue) < self.capacity:
+                self.queue.append(data)
+                self.condition.notify()
+
+    def sendto(self, data, address):
+        self.network.deliver(address[1], data)
+
+    def recvfrom(self, buffer_size):
+        return self.recv(buffer_size), None
+
+    def recv(self, buffer_size):
+        if self.queue:
+            return self.queue.popleft()[:buffer_size]
+        if self.timeout == 0:
+            raise socket.error(errno.EAGAIN, "Resource temporarily unavailable")
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self.condition:
+            while not self.queue:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise socket.timeout("timed out")
+                self.condition.wait(remaining)
+            return self.queue.popleft()[:buffer_size]
+
+
+class Network(object):
+
+    def __init__(self, loop=None):
+        """
+        :param loop: engine.VirtualLoop whose clock the channels use, None for real time
+        """
+        self.loop = loop
+        # port -> LoopbackSocket bound to it
+        self.ports = {}
+
+    def clock(self):
+        return self.loop.time() if self.loop is not None else time.time()
+
+    def bind(self, port):
+        sock = LoopbackSocket(self, ChannelSimulator.SOCKET_BUFFER_SIZE // ChannelSimulator.BUFFER_SIZE)
+        self.ports[port] = sock
+        return sock
+
+    def deliver(self, port, data):
+        sock = self.ports.get(port)
+        # like UDP, nobody listening means the datagram is lost
+        if sock is not None:
+            # copy, the sender may reuse its buffer
+            sock.put(bytearray(data))
+
+    def channel(self, inbound_port, outbound_port, **kwargs):
+        """
+        :return: LoopbackChannel on this network, kwargs are passed to ChannelSimulator
+        """
+        return LoopbackChannel(self, inbound_port=inbound_port, outbound_port=outbound_port, **kwargs)
+
+
+class LoopbackChannel(ChannelSimulator):
+
+    def __init__(self, network, **kwargs):
+        """
+        :param network: Network to bind to
+        :param kwargs: ChannelSimulator arguments
+        """
+        kwargs.setdefault("clock", network.clock)
+        super(LoopbackChannel, self).__init__(**kwargs)
+        self.network = network
+
+    def sndr_setup(self, timeout):
+        self.sndr_socket = LoopbackSocket(self.network, 0)
+        self.sndr_socket.settimeout(timeout)
+
+    def rcvr_setup(self, timeout):
+        self.rcvr_socket = self.network.bind(self.rcvr_port)
+        self.rcvr_socket.settimeout(timeout)
@@ -0,0 +1,188 @@
+"""
+Counters and histograms for the transport.
+
+A Metrics object holds one flow's counters and histograms in arrays that are allocated once, so recording is an
+index and an add. Instrumented code keeps None instead of a Metrics object when metrics are off and checks for it
+before recording, which leaves a single comparison on the hot path.
+
+Histograms are log scaled: SUB_BUCKETS buckets per power of two microseconds, which keeps percentiles within ~10%.
+An Exporter writes snapshots of a set of flows to JSON (the latest snapshot) or CSV (one row per flow per dump),
+every interval seconds from a background thread and once more at exit.
+"""
+
+import array
+import atexit
+import csv
+import json
+import math
+import os
+import threading
+import time
+
+# region Counters
+
+SEGMENTS_SENT = 0
+BYTES_SENT = 1
+RESENDS = 2
+TIMEOUTS = 3
+FAST_RETRANSMITS = 4
+ACKS_RECEIVED = 5
+FRAMES_RECEIVED = 6
+CORRUPT_FRAMES = 7
+DUPLICATES = 8
+BYTES_WRITTEN = 9
+ACKS_SENT = 10
+FEC_RECOVERED = 11
+CHANNEL_FRAMES = 12
+CHANNEL_DROPS = 13
+CHANNEL_SWAPS = 14
+CHANNEL_CORRUPTIONS = 15
+# connections a server opened
+SESSIONS = 16
+COUNTERS = ("segments_sent", "bytes_sent", "resends", "timeouts", "fast_retransmits", "acks_received",
+            "frames_received", "corrupt_frames", "duplicates", "bytes_written", "acks_sent", "fec_recovered",
+            "channel_frames", "channel_drops", "channel_swaps", "channel_corruptions", "sessions")
+# endregion Counters
+
+# region Histograms
+
+# round trip time samples that fed the retransmission timeout
+RTT = 0
+# first transmission of a segment to its ACK, resends included
+ACK_LATENCY = 1
+# SYN to FIN of every connection a server closed
+SESSION_LATENCY = 2
+HISTOGRAMS = ("rtt", "ack_latency", "session_latency")
+# endregion Histograms
+
+SUB_BUCKETS = 8
+# 1 us up to 2 ** 31 us (~36 minutes), anything longer lands in the last bucket
+BUCKETS = 31 * SUB_BUCKETS + 2
+PERCENTILES = (50, 90, 99)
+
+
+def bucket_of(seconds):
+    microseconds = seconds * 1e6
+    if microseconds < 1:
+        return 0
+    return min(int(math.log(microseconds, 2) * SUB_BUCKETS) + 1, BUCKETS - 1)
+
+
+def bucket_limit(bucket):
+    """
+    :param bucket: histogram bucket
+    :return: upper bound of the bucket, in seconds
+    """
+    return 2 ** (bucket / float(SUB_BUCKETS)) / 1e6
+
+
+class Metrics(object):
+
+    def __init__(self, flow):
+        """
+        :param flow: name of the flow in snapshots
+        """
+        self.flow = flow
+        self.counters = array.array("L", [0]) * len(COUNTERS)
+        # one row of BUCKETS counts per histogram
+        self.buckets = array.array("L", [0]) * (len(HISTOGRAMS) * BUCKETS)
+        self.sums = array.array("d", [0.0]) * len(HISTOGRAMS)
+        self.maxima = array.array("d", [0.0]) * len(HISTOGRAMS)
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def observe(self, histogram, seconds):
+        self.buckets[histogram * BUCKETS + bucket_of(seconds)] += 1
+        self.sums[histogram] += seconds
+        if seconds > self.maxima[histogram]:
+            self.maxima[histogram] = seconds
+
+    def summary(self, histogram):
+        """
+        :param histogram: histogram index
+        :return: dict of the sample count, mean, maximum and percentiles (bucket upper bounds) in seconds
+        """
+        row = self.buckets[histogram * BUCKETS:(histogram + 1) * BUCKETS]
+        total = sum(row)
+        summary = {"count": total, "mean": self.sums[histogram] / total if total else None,
+                   "max": self.maxima[histogram] if total else None}
+        for point in PERCENTILES:
+            summary["p{}".format(point)] = None
+        seen = 0
+        points = list(PERCENTILES)
+        for bucket, n in enumerate(row):
+            seen += n
+            while points and total and seen >= math.ceil(points[0] / 100.0 * total):
+                # the top bucket is open ended, report the real maximum instead
+                summary["p{}".format(points.pop(0))] = min(bucket_limit(bucket), self.maxima[histogram])
+        return summary
+
+    def snapshot(self):
+        return {
+            "flow": self.flow,
+            "counters": dict(zip(COUNTERS, self.counters)),
+            "histograms": dict((name, self.summary(n)) for n, name in enumerate(HISTOGRAMS)),
+        }
+
+
+class Exporter(object):
+
+    def __init__(self, path, flows, interval=0):
+        """
+        :param path: file to write, CSV if it ends in .csv and JSON otherwise
+        :param flows: list of Metrics to export, more can be appended later
+        :param interval: seconds between dumps, 0 to only dump at exit
+        """
+        self.path = path
+        self.flows = flows
+        self.interval = interval
+        self.csv = path.endswith(".csv")
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.csv:
+            # rows are appended from here on, start from an empty file
+            open(self.path, "wb").close()
+        atexit.register(self.stop)
+        if self.interval:
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    def stop(self):
+        if not self.stopped.is_set():
+            self.stopped.set()
+            self.dump()
+
+    def dump(self):
+        now = time.time()
+        snapshots = [flow.snapshot() for flow in self.flows]
+        with self.lock:
+            if self.csv:
+                self.append_rows(now, snapshots)
+            else:
+                # write and rename, so a reader never sees half a snapshot
+                with open(self.path + ".tmp", "w") as output:
+                    json.dump({"time": now, "flows": snapshots}, output, indent=2, sort_keys=True)
+                os.rename(self.path + ".tmp", self.path)
+
+    def append_rows(self, now, snapshots):
+        header = ["time", "flow"] + list(COUNTERS) + ["{}_{}".format(name, field) for name in HISTOGRAMS
+                                                      for field in ("count", "mean", "max", "p50", "p90", "p99")]
+        new = not os.path.exists(self.path) or not os.path.getsize(self.path)
+        with open(self.path, "ab") as output:
+            writer = csv.writer(output)
+            if new:
+                writer.writerow(header)
+            for snapshot in snapshots:
+                row = [now, snapshot["flow"]] + [snapshot["counters"][name] for name in COUNTERS]
+                for name in HISTOGRAMS:
+                    summary = snapshot["histograms"][name]
+                    row += [summary[field] for field in ("count", "mean", "max", "p50", "p90", "p99")]
+                writer.writerow(row)
@@ -0,0 +1,129 @@
+"""
+Binary segment codec shared by the senders and receivers.
+
+Header layout (network byte order, 20 bytes):
+    0     - version
+    1     - flags
+    2:4   - payload length
+    4:8   - sequence number
+    8:12  - ACK number
+    12:16 - connection ID
+    16:20 - CRC32 of the header (with this field zeroed) and the payload
+    20:   - payload
+
+ACKs carry the cumulative ACK in the ACK number field and may carry a selective ACK bitmap as their payload.
+Connections open with a SYN and close with a FIN, each answered by the receiver with the same flag and ACK. Every
+frame carries the random ID its sender picked for the SYN (0 before it connects), and answers echo it, so one socket
+can serve many connections.
+"""
+
+import binascii
+import struct
+from collections import namedtuple
+
+VERSION = 2
+HEADER = struct.Struct("!BBHIIII")
+CHECKSUM = struct.Struct("!I")
+HEADER_SIZE = HEADER.size
+MAX_SEQUENCE_NUMBER = 2 ** 32
+
+# region Flags
+
+ACK = 0x01
+# FEC parity over the segments starting at the sequence number, the ACK number field holds how many it covers
+PARITY = 0x02
+# opens a connection: the payload holds the handshake of the layer above, or REPLY, the receiver answers with
+# SYN | ACK
+SYN = 0x04
+# closes a connection once everything is acknowledged: the sequence number field holds the sequence number after the
+# last segment and the payload (LENGTH) the number of bytes sent, the receiver answers with FIN | ACK and closes
+FIN = 0x08
+# endregion Flags
+
+LENGTH = struct.Struct("!Q")
+# payload of a plain SYN: the port the sender listens on, which stands in for the source address the channel doesn't
+# report
+REPLY = struct.Struct("!H")
+
+Packet = namedtuple("Packet", ("flags", "sequence_number", "ack_number", "payload", "connection"))
+Packet.__new__.__defaults__ = (0,)
+
+
+def crc(frame):
+    """
+    CRC32 of a frame, skipping its checksum field
+    :param frame: encoded frame
+    :return: unsigned 32 bit CRC
+    """
+    view = memoryview(frame)
+    return binascii.crc32(view[HEADER_SIZE:], binascii.crc32(view[:HEADER_SIZE - 4])) & 0xffffffff
+
+
+def encode_into(frame, sequence_number, ack_number=0, flags=0, payload=b"", connection=0):
+    """
+    Build a frame in place, e.g. in a buffer that is reused for every segment
+    :param frame: writable buffer with room for HEADER_SIZE + len(payload) bytes
+    :param sequence_number: sequence number of the segment
+    :param ack_number: ACK number, only meaningful with the ACK flag
+    :param flags: bitwise OR of the flag constants
+    :param payload: bytes to carry (a memoryview slice of the input avoids a copy)
+    :param connection: ID of the connection the frame belongs to
+    :return: memoryview of the encoded frame
+    """
+    length = len(payload)
+    view = memoryview(frame)[:HEADER_SIZE + length]
+    HEADER.pack_into(frame, 0, VERSION, flags, length, sequence_number, ack_number, connection, 0)
+    view[HEADER_SIZE:] = payload
+    CHECKSUM.pack_into(frame, HEADER_SIZE - 4, crc(view))
+    return view
+
+
+def encode(sequence_number, ack_number=0, flags=0, payload=b"", connection=0):
+    """
+    Build a frame in a new buffer, see encode_into
+    :return: encoded frame
+    """
+    frame = bytearray(HEADER_SIZE + len(payload))
+    encode_into(frame, sequence_number, ack_number, flags, payload, connection)
+    return frame
+
+
+def sack(base, received):
+    """
+    Selective ACK bitmap of the segments received past the first missing one
+    :param base: cumulative ACK, i.e. the first missing sequence number
+    :param received: sequence numbers received above base
+    :return: bytearray where bit n (least significant bit of each byte first) is set if segment base + 1 + n was
+    received, empty if nothing was
+    """
+    if not received:
+        return bytearray()
+    bitmap = bytearray((max(received) - base + 7) // 8)
+    for sequence_number in received:
+        offset = sequence_number - base - 1
+        bitmap[offset >> 3] |= 1 << (offset & 7)
+    return bitmap
+
+
+def sacked(base, bitmap):
+    """
+    :param base: cumulative ACK the bitmap was built for
+    :param bitmap: payload of an ACK, see sack
+    :return: list of the sequence numbers the bitmap marks as received, in order
+    """
+    return [base + 1 + (n << 3) + bit for n, byte in enumerate(bytearray(bitmap)) if byte
+            for bit in xrange(8) if byte >> bit & 1]
+
+
+def decode(frame):
+    """
+    Parse and verify a frame
+    :param frame: bytes received from the channel
+    :return: Packet, or None if the frame is corrupt, truncated or from another protocol version
+    """
+    if len(frame) < HEADER_SIZE:
+        return None
+    version, flags, length, sequence_number, ack_number, connection, checksum = HEADER.unpack_from(frame)
+    if version != VERSION or len(frame) != HEADER_SIZE + length or checksum != crc(frame):
+        return None
+    return Packet(flags, sequence_number, ack_number, frame[HEADER_SIZE:], connection)
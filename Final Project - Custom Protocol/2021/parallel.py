@@ -0,0 +1,143 @@
+"""
+Parallel transfer mode: the input is split into byte ranges that are sent by a pool of processes, one Selective
+Repeat flow per range on its own pair of ports. Each receiving process writes its range straight to its offset in
+the output file, so the ranges never have to be stitched together afterwards.
+
+Flow i uses ports 50006 + 2i (sender inbound) and 50005 + 2i (receiver inbound). Every flow gets the same protocol
+settings and channel options, and draws its channel errors from a seed of its own.
+"""
+
+import io
+import itertools
+import multiprocessing
+import os
+import stat
+import struct
+
+import channelmodels
+import receiver
+import sender
+import utils
+
+# first segment of every flow: offset of its range and total length of the file
+RANGE = struct.Struct("!QQ")
+SENDER_PORT = 50006
+RECEIVER_PORT = 50005
+
+
+def split(total, flows, segment_size):
+    """
+    Split the input into one range per flow, aligned to whole segments
+    :param total: input length in bytes
+    :param flows: number of flows
+    :param segment_size: maximum segment size
+    :return: list of (offset, length)
+    """
+    per_flow = -(-total // (flows * segment_size)) * segment_size
+    return [(min(n * per_flow, total), max(min(per_flow, total - n * per_flow), 0)) for n in xrange(flows)]
+
+
+class RangeWriter(object):
+    """
+    Output of one flow: once the RANGE header has been delivered, the rest of the flow is written from its offset on
+    """
+
+    def __init__(self, path, buffer_size=1 << 20):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.header = bytearray()
+        self.file = None
+
+    def write(self, data):
+        if self.file is None:
+            self.header += data
+            if len(self.header) < RANGE.size:
+                return
+            offset, total = RANGE.unpack_from(self.header)
+            data = self.header[RANGE.size:]
+            self.file = io.open(self.path, "r+b", buffering=self.buffer_size)
+            # every flow sets the same final size, whichever finishes first
+            self.file.truncate(total)
+            self.file.seek(offset)
+        self.file.write(data)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+
+def channel(channel_args, flow):
+    return channelmodels.from_arguments(channel_args, flow) if channel_args is not None else {}
+
+
+def send_range(arguments):
+    fd, flow, offset, length, total, base_port, channel_args, settings = arguments
+    sndr = sender.SelectiveRepeatSender(inbound_port=base_port + 2 * flow, outbound_port=base_port - 1 + 2 * flow,
+                                        **dict(settings, **channel(channel_args, flow)))
+    # a worker may run several flows, so it reads from a copy of the shared descriptor and only closes that
+    with os.fdopen(os.dup(fd), "rb") as stream:
+        segments = utils.read_segments(stream, sndr.MSS, offset=offset, length=length)
+        sndr.send_segments(itertools.chain([RANGE.pack(offset, total)], segments))
+
+
+def receive_range(arguments):
+    path, flow, base_port, channel_args, settings = arguments
+    rcvr = receiver.SelectiveRepeatReceiver(output=RangeWriter(path), inbound_port=base_port + 2 * flow,
+                                            outbound_port=base_port + 1 + 2 * flow,
+                                            **dict(settings, **channel(channel_args, flow)))
+    rcvr.receive()
+
+
+def send_parallel(stream, flows, window_size=sender.WINDOW_SIZE, base_port=SENDER_PORT, channel_args=None,
+                  **settings):
+    """
+    Send a regular file over several flows, one process each
+    :param stream: file object of a regular file (e.g. stdin redirected from a file)
+    :param flows: number of flows
+    :param window_size: window size of each flow
+    :param base_port: inbound port of the first flow's sender
+    :param channel_args: options parsed by a parser that channelmodels.add_arguments was called on, None for the
+    channel's defaults
+    :param settings: more SelectiveRepeatSender keyword arguments for every flow, e.g. fec or window_policy
+    :return:
+    """
+    status = os.fstat(stream.fileno())
+    if not stat.S_ISREG(status.st_mode):
+        raise ValueError("Parallel mode splits the input by offset, it has to be a regular file")
+    total = status.st_size
+    # multiprocessing points the workers' stdin at /dev/null, so hand them their own descriptor
+    fd = os.dup(stream.fileno())
+    # whole segments of what every flow's sender actually sends, so that no range edge splits one
+    ranges = split(total, flows, sender.segment_size(settings.get("max_segment_size", sender.MAX_SEGMENT_SIZE),
+                                                     settings.get("fec", 0)))
+    pool = multiprocessing.Pool(flows)
+    try:
+        settings = dict(settings, window_size=window_size)
+        pool.map(send_range, [(fd, flow, offset, length, total, base_port, channel_args, settings)
+                              for flow, (offset, length) in enumerate(ranges)])
+    finally:
+        pool.close()
+        os.close(fd)
+
+
+def receive_parallel(path, flows, window_size=receiver.WINDOW_SIZE, timeout=5, base_port=RECEIVER_PORT,
+                     channel_args=None, **settings):
+    """
+    Receive several flows, one process each, into one file
+    :param path: output file, created or truncated
+    :param flows: number of flows
+    :param window_size: window size of each flow
+    :param timeout: idle timeout of each flow, in seconds
+    :param base_port: inbound port of the first flow's receiver
+    :param channel_args: options parsed by a parser that channelmodels.add_arguments was called on, None for the
+    channel's defaults
+    :param settings: more SelectiveRepeatReceiver keyword arguments for every flow, e.g. fec or ack_every
+    :return:
+    """
+    open(path, "wb").close()
+    settings = dict(settings, window_size=window_size, timeout=timeout)
+    pool = multiprocessing.Pool(flows)
+    try:
+        pool.map(receive_range, [(path, flow, base_port, channel_args, settings) for flow in xrange(flows)])
+    finally:
+        pool.close()
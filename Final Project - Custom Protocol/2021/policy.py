@@ -0,0 +1,157 @@
+"""
+Retransmission timeout and window policies used by the senders.
+
+Timeout policies expose ``rto``, ``sample(rtt)`` and ``backoff()``.
+Window policies expose ``size``, ``on_ack()``, ``on_duplicate_ack()`` and ``on_timeout()``.
+"""
+
+# the longest a receiver holds back an ACK waiting for more segments to cover, in seconds
+ACK_DELAY = 0.001
+
+
+class FixedTimeout(object):
+
+    def __init__(self, timeout=0.01):
+        """
+        Always wait the same amount of time before resending
+        :param timeout: retransmission timeout, in seconds
+        """
+        self.rto = timeout
+
+    def sample(self, rtt):
+        pass
+
+    def backoff(self):
+        pass
+
+
+class AdaptiveTimeout(object):
+    """
+    Jacobson/Karels estimator (RFC 6298): SRTT/RTTVAR smoothing with exponential backoff.
+    Callers are expected to follow Karn's rule and only sample segments that were transmitted once.
+    The receiver's ACK delay is added on top like QUIC does: a segment whose ACK was held back would otherwise time out
+    right as the ACK arrives, and never be sampled to correct that.
+    """
+
+    ALPHA = 1.0 / 8
+    BETA = 1.0 / 4
+    K = 4
+
+    def __init__(self, initial=0.05, minimum=0.002, maximum=2.0, granularity=0.001, max_ack_delay=ACK_DELAY):
+        """
+        :param initial: timeout to use before the first RTT sample, in seconds
+        :param minimum: lower bound on the timeout, in seconds
+        :param maximum: upper bound on the timeout (also caps the backoff), in seconds
+        :param granularity: least margin over SRTT, so a perfectly steady RTT doesn't put the timeout on top of it
+        :param max_ack_delay: longest the receiver holds back an ACK, in seconds
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.granularity = granularity
+        self.max_ack_delay = max_ack_delay
+        self.srtt = None
+        self.rttvar = None
+        self.rto = self.clamp(initial)
+
+    def clamp(self, value):
+        return min(max(value, self.minimum), self.maximum)
+
+    def sample(self, rtt):
+        """
+        Update the estimate with a new round trip time measurement
+        :param rtt: measured round trip time, in seconds
+        :return:
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - AdaptiveTimeout.BETA) * self.rttvar + AdaptiveTimeout.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - AdaptiveTimeout.ALPHA) * self.srtt + AdaptiveTimeout.ALPHA * rtt
+        # a fresh sample also undoes any backoff
+        self.rto = self.clamp(self.srtt + max(self.granularity, AdaptiveTimeout.K * self.rttvar) + self.max_ack_delay)
+
+    def backoff(self):
+        self.rto = self.clamp(self.rto * 2)
+
+
+class FixedWindow(object):
+
+    def __init__(self, size=64):
+        """
+        Always keep the same number of segments in flight
+        :param size: window size, in segments
+        """
+        self.size = size
+        self.duplicates = 0
+
+    def on_ack(self):
+        self.duplicates = 0
+
+    def on_duplicate_ack(self):
+        """
+        :return: True if the missing segment should be fast retransmitted
+        """
+        self.duplicates += 1
+        return self.duplicates == AIMDWindow.DUPLICATE_THRESHOLD
+
+    def on_timeout(self):
+        pass
+
+
+class AIMDWindow(object):
+    """
+    TCP Reno style congestion window: slow start, additive increase, multiplicative decrease and
+    fast retransmit after DUPLICATE_THRESHOLD duplicate ACKs.
+    """
+
+    DUPLICATE_THRESHOLD = 3
+
+    def __init__(self, initial=2, ssthresh=64, minimum=2, maximum=256):
+        """
+        :param initial: starting window, in segments
+        :param ssthresh: slow start threshold, in segments
+        :param minimum: the window is never shrunk below this, in segments
+        :param maximum: the window is never grown above this, in segments
+        """
+        self.cwnd = float(initial)
+        self.ssthresh = float(ssthresh)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.duplicates = 0
+
+    @property
+    def size(self):
+        return int(self.cwnd)
+
+    def on_ack(self):
+        """
+        The cumulative ACK moved forward
+        :return:
+        """
+        self.duplicates = 0
+        if self.cwnd < self.ssthresh:
+            # slow start: +1 per ACK, doubles every round trip
+            self.cwnd += 1
+        else:
+            # congestion avoidance: +1 per round trip
+            self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.maximum)
+
+    def on_duplicate_ack(self):
+        """
+        An ACK arrived for a later segment while the cumulative ACK stayed put
+        :return: True if the missing segment should be fast retransmitted
+        """
+        self.duplicates += 1
+        if self.duplicates != AIMDWindow.DUPLICATE_THRESHOLD:
+            return False
+        # fast retransmit: halve the window instead of collapsing it
+        self.ssthresh = max(self.cwnd / 2, self.minimum)
+        self.cwnd = self.ssthresh
+        return True
+
+    def on_timeout(self):
+        self.duplicates = 0
+        self.ssthresh = max(self.cwnd / 2, self.minimum)
+        self.cwnd = float(self.minimum)
@@ -1,26 +1,47 @@
 # Written by S. Mevawala, modified by D. Gitzel
 
+import argparse
+import collections
+import io
 import logging
 
+import channelmodels
 import channelsimulator
+import compression
+import engine
+import fec as fec_
+import metrics as metrics_
+import packet
+import policy
+import session
 import utils
 import sys
 import socket
 
-import hashlib
-
-MAX_SEQUENCE_NUMBER = 256
+WINDOW_SIZE = 64
+# in-order segments per ACK
+ACK_EVERY = 2
 
 
 class Receiver(object):
 
-    def __init__(self, inbound_port=50005, outbound_port=50006, timeout=10, debug_level=logging.INFO):
+    def __init__(self, inbound_port=50005, outbound_port=50006, timeout=10, debug_level=logging.INFO, metrics=None,
+                 network=None, **channel):
         self.logger = utils.Logger(self.__class__.__name__, debug_level)
 
         self.inbound_port = inbound_port
         self.outbound_port = outbound_port
-        self.simulator = channelsimulator.ChannelSimulator(inbound_port=inbound_port, outbound_port=outbound_port,
-                                                           debug_level=debug_level)
+        # None when metrics are off, checked before recording anything
+        self.metrics = metrics
+        # channel holds any other ChannelSimulator arguments, e.g. its seed and error probabilities
+        # a loopback.Network swaps the UDP sockets for in-memory ones
+        factory = network.channel if network is not None else channelsimulator.ChannelSimulator
+        self.simulator = factory(inbound_port=inbound_port, outbound_port=outbound_port, debug_level=debug_level,
+                                 metrics=metrics, **channel)
+        # kept to build more channels like it, see server.py
+        self.factory = factory
+        self.channel = channel
+        self.debug_level = debug_level
         self.simulator.rcvr_setup(timeout)
         self.simulator.sndr_setup(timeout)
 
@@ -31,8 +52,8 @@ class Receiver(object):
 class BogoReceiver(Receiver):
     ACK_DATA = bytes(123)
 
-    def __init__(self):
-        super(BogoReceiver, self).__init__()
+    def __init__(self, **kwargs):
+        super(BogoReceiver, self).__init__(**kwargs)
 
     def receive(self):
         self.logger.info(
@@ -49,72 +70,477 @@ class BogoReceiver(Receiver):
 
 
 class OurReceiver(BogoReceiver):
+    """
+    Stop-and-wait receiver. receive() returns as soon as the sender's FIN says the last segment has been delivered
+    and acknowledged. Resending is up to the sender, the receiver only answers what arrives, so its timeout just
+    gives up on a sender that went away.
+    """
 
-    def __init__(self, timeout=0.01):
-        super(OurReceiver, self).__init__()
+    def __init__(self, timeout=10, output=None, **kwargs):
+        """
+        :param timeout: seconds the sender may be quiet before the receiver gives up
+        :param output: file object to write to, defaults to stdout
+        """
+        super(OurReceiver, self).__init__(**kwargs)
         self.timeout = timeout
+        self.output = output if output is not None else utils.buffered_stdout()
         self.simulator.sndr_socket.settimeout(self.timeout)
         self.simulator.rcvr_socket.settimeout(self.timeout)
 
-    # produce a checksum value
-    @staticmethod
-    def checksum(data):
-        return hashlib.md5(data).hexdigest()
-
     def receive(self):
         self.logger.info(
             "Receiving on port: {} and replying with ACK on port: {}".format(self.inbound_port, self.outbound_port))
         # initialize parameters
-        duplicates = 0
-        previous_ack_number = -1
-        recent_ack = bytearray([0 for _ in range(33)])
-        previous_checksum = bytearray([0 for _ in range(32)])
+        expected = 0
+        recent_ack = packet.encode(0, ack_number=expected, flags=packet.ACK)
+        # a corrupt frame is answered once, so the sender resends without waiting for its timeout
+        nacked = False
+        connection = None
+        length = 0
+        metrics = self.metrics
         while True:
             try:
                 data = self.simulator.u_receive()
-                # bring down timeout for received packet
-                if self.timeout > 0.1:
-                    duplicates = 0
-                    self.timeout /= 2
-                    self.simulator.rcvr_socket.settimeout(self.timeout)
-
-                # check the checksum of the received packet
-                if self.checksum(data[32:]) == data[0:32]:
-                    ack_number = (data[64] + 1) % MAX_SEQUENCE_NUMBER
-                    # make sure sequence number is correct and that the previous checksum matches
-                    # include previous checksum because in some instances MAX_SEQUENCE_NUMBER packets were dropped in a row
-                    # can alternatively include checksum in ACK
-                    if (data[64] == previous_ack_number or previous_ack_number == -1) and previous_checksum == data[32:64]:
-                        sys.stdout.write(data[65:])
-                        sys.stdout.flush()
-                        # store sequence number and checksum
-                        previous_ack_number = ack_number
-                        previous_checksum = data[0:32]
-
-                        send_array = bytearray([ack_number])
-                        send_array = self.checksum(send_array) + send_array
+                if metrics is not None:
+                    metrics.count(metrics_.FRAMES_RECEIVED)
+
+                # decode also checks the checksum of the received packet
+                segment = packet.decode(data)
+                if segment is not None and segment.flags & packet.SYN:
+                    if segment.connection != connection:
+                        # a new connection starts over
+                        connection = segment.connection
+                        expected = length = 0
+                        recent_ack = packet.encode(0, ack_number=expected, flags=packet.ACK, connection=connection)
+                    self.simulator.u_send(packet.encode(0, flags=packet.SYN | packet.ACK, connection=connection))
+                    continue
+                # left over from an earlier connection
+                if segment is not None and connection is not None and segment.connection != connection:
+                    continue
+                if segment is not None and segment.flags & packet.FIN:
+                    # sent once the last segment is acknowledged, anything else is left over from before
+                    if segment.sequence_number != expected or len(segment.payload) != packet.LENGTH.size:
+                        continue
+                    announced, = packet.LENGTH.unpack(bytes(segment.payload))
+                    if announced != length:
+                        self.logger.info("The sender announced {} bytes but {} were delivered".format(announced,
+                                                                                                       length))
+                    self.simulator.u_send(packet.encode(expected, ack_number=expected, flags=packet.FIN | packet.ACK,
+                                                        connection=segment.connection))
+                    self.output.flush()
+                    return
+                if segment is not None and not segment.flags & packet.ACK:
+                    nacked = False
+                    # make sure sequence number is correct
+                    if segment.sequence_number == expected:
+                        self.output.write(segment.payload)
+                        length += len(segment.payload)
+                        expected = (expected + 1) % packet.MAX_SEQUENCE_NUMBER
+                        if metrics is not None:
+                            metrics.count(metrics_.BYTES_WRITTEN, len(segment.payload))
+
                         # store ACK and send
-                        recent_ack = send_array
-                        self.simulator.u_send(send_array)
+                        recent_ack = packet.encode(0, ack_number=expected, flags=packet.ACK,
+                                                   connection=segment.connection)
+                    # otherwise a duplicate: the last ACK got lost -> send it again
+                    elif metrics is not None:
+                        metrics.count(metrics_.DUPLICATES)
+                elif segment is None:
+                    if metrics is not None:
+                        metrics.count(metrics_.CORRUPT_FRAMES)
+                    if nacked:
                         continue
-                # corrupt packet -> send most recent packet
+                    nacked = True
+                else:
+                    continue
                 self.simulator.u_send(recent_ack)
-            # socket timeout -> send most recent ACK
+                if metrics is not None:
+                    metrics.count(metrics_.ACKS_SENT)
+            # the sender went away without closing
             except socket.timeout:
-                self.simulator.u_send(recent_ack)
-                duplicates += 1
-                if duplicates == 3:
-                    duplicates = 0
-                    self.timeout *= 2
-                    if self.timeout > 10:
-                        sys.exit()
-                    self.simulator.rcvr_socket.settimeout(self.timeout)
+                if metrics is not None:
+                    metrics.count(metrics_.TIMEOUTS)
+                self.output.flush()
+                return
+
+
+class SelectiveRepeatReceiver(BogoReceiver):
+    """
+    Event driven Selective Repeat receiver. receive() runs its own loop until the sender closes the connection, or
+    gives up once the sender has been quiet for timeout seconds; pass a shared engine.EventLoop and call start() to
+    run many transfers on one loop.
+
+    ACKs are delayed and coalesced: one goes out per ack_every in-order segments or ack_delay seconds after the
+    first one it covers, whichever comes first. Anything out of order (a gap, a duplicate, the segment that fills a
+    gap) is ACKed at once, with a SACK bitmap of the segments buffered past the gap.
+
+    Every SYN is answered, and one with a new connection ID starts the sequence numbers over, so a restarted sender
+    can connect again, after which frames of any other connection are dropped. With on_syn set, data is only accepted
+    once a sender has connected. The sender only sends its FIN once everything is acknowledged, so the receiver
+    answers it and closes at once. See server.py for many senders at once.
+    """
+
+    def __init__(self, window_size=WINDOW_SIZE, timeout=5, output=None, loop=None, fec=0, ack_every=ACK_EVERY,
+                 ack_delay=policy.ACK_DELAY, on_syn=None, **kwargs):
+        """
+        :param window_size: receiver window, must be at least the sender's
+        :param timeout: seconds the sender may be quiet before the receiver gives up on it
+        :param output: file-like object to write to, defaults to stdout
+        :param loop: engine.EventLoop to run on, defaults to a private one
+        :param fec: segments per parity segment, must match the sender's, 0 ignores parity
+        :param ack_every: in-order segments per ACK
+        :param ack_delay: longest an ACK is held back for more segments, in seconds
+        :param on_syn: called with the payload of a new connection's SYN, returns the payload to answer it with, or
+        None to ignore the SYN. None answers with an empty payload and accepts data without a handshake too
+        """
+        super(SelectiveRepeatReceiver, self).__init__(timeout=timeout, **kwargs)
+        self.window_size = window_size
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.fec = fec
+        self.timeout = timeout
+        self.output = output if output is not None else utils.buffered_stdout()
+        self.loop = loop if loop is not None else engine.EventLoop()
+        self.transport = engine.ChannelTransport(self.loop, self.simulator, self, max_frames=window_size)
+        # where in-order payloads go
+        self.deliver = self.output.write
+        self.done = False
+        self.on_syn = on_syn
+        # ID of the connection the data belongs to and the SYN | ACK that answered it
+        self.connection = None
+        self.syn_reply = None
+        self.ack_timer = None
+
+    def start(self):
+        """
+        Start receiving on the loop without blocking
+        :return:
+        """
+        self.logger.info(
+            "Receiving on port: {} and replying with ACK on port: {}".format(self.inbound_port, self.outbound_port))
+        self.reset()
+        self.done = False
+        self.last_activity = self.loop.time()
+        self.idle_timer = self.loop.call_later(self.timeout, self.check_idle)
+        self.transport.start()
+
+    def reset(self):
+        # initialize parameters
+        self.base = 0
+        # bytes delivered, checked against the length the FIN announces
+        self.length = 0
+        # out of order segments waiting for the gap before them to be filled
+        self.buffered = {}
+        # FEC state per block start: payloads seen so far, and (segments covered, parity payload)
+        self.blocks = {}
+        self.parities = {}
+        # every block before this one has been delivered and forgotten
+        self.fec_base = 0
+        # segments accepted since the last ACK, the first of them and the timer that sends the delayed ACK. The ACK
+        # echoes the first one (like TCP timestamps), so the sender's RTT samples include the time it was held back
+        self.unacked = 0
+        self.echo = 0
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+
+    def receive(self):
+        self.start()
+        self.loop.run()
+
+    def iter_receive(self):
+        """
+        Receive like receive(), but hand back the in-order payloads as they arrive instead of writing them out
+        :return: generator of payloads
+        """
+        delivered = collections.deque()
+        self.deliver = delivered.append
+        self.start()
+        while not self.done or delivered:
+            while delivered:
+                yield delivered.popleft()
+            if not self.done:
+                self.loop.run_once()
+
+    def check_idle(self):
+        # the sender has been quiet for the whole timeout -> transfer is over
+        # compared against the deadline itself, a remaining time can round away to nothing on a virtual clock
+        now, deadline = self.loop.time(), self.last_activity + self.timeout
+        self.idle_timer = None
+        if now >= deadline:
+            self.logger.info("The sender has been quiet for {} seconds, giving up".format(self.timeout))
+            self.finish()
+        else:
+            self.idle_timer = self.loop.call_later(deadline - now, self.check_idle)
+
+    def finish(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        self.transport.close()
+        self.output.flush()
+        self.done = True
+
+    def frames_received(self, frames):
+        self.last_activity = self.loop.time()
+        acks = []
+        for data in frames:
+            # drop corrupt packets, the sender will time out and resend
+            segment = packet.decode(data)
+            if segment is not None and segment.flags & packet.SYN:
+                self.syn_received(segment)
+                continue
+            # left over from an earlier connection
+            if segment is not None and self.connection is not None and segment.connection != self.connection:
+                continue
+            if segment is not None and segment.flags & packet.FIN:
+                if self.fin_received(segment):
+                    break
+                continue
+            # no data before the handshake, it can't be placed
+            if segment is None or segment.flags & packet.ACK or self.on_syn is not None and self.connection is None:
+                if self.metrics is not None and segment is None:
+                    self.metrics.count(metrics_.CORRUPT_FRAMES)
+                continue
+            if segment.flags & packet.PARITY:
+                recovered = self.parity_received(segment) if self.fec else None
+                if recovered is None:
+                    continue
+                sequence_number, payload = recovered
+            else:
+                sequence_number, payload = segment.sequence_number, segment.payload
+            # beyond the window -> the sender cannot have sent it yet, must be garbage
+            if sequence_number >= self.base + self.window_size:
+                continue
+            while True:
+                expected = self.base
+                recovered = self.accept(sequence_number, payload)
+                # ACK everything, including segments below the window whose ACK got lost
+                if not self.unacked:
+                    self.echo = sequence_number
+                self.unacked += 1
+                # out of order, a duplicate or the segment that fills a gap is ACKed at once
+                if sequence_number != expected or self.base > expected + 1 or self.unacked >= self.ack_every:
+                    acks.append(self.ack())
+                if recovered is None:
+                    break
+                sequence_number, payload = recovered
+        if self.metrics is not None:
+            self.metrics.count(metrics_.FRAMES_RECEIVED, len(frames))
+            self.metrics.count(metrics_.ACKS_SENT, len(acks))
+        if acks:
+            self.transport.send_many(acks)
+        if self.unacked and self.ack_timer is None and not self.done:
+            self.ack_timer = self.loop.call_later(self.ack_delay, self.ack_timeout)
+
+    def syn_received(self, segment):
+        """
+        :param segment: decoded SYN
+        :return:
+        """
+        if segment.connection != self.connection:
+            reply = self.on_syn(segment.payload) if self.on_syn is not None else b""
+            if reply is None:
+                return
+            # a new sender numbers its segments from 0 again
+            self.reset()
+            self.connection = segment.connection
+            self.syn_reply = packet.encode(0, flags=packet.SYN | packet.ACK, payload=reply, connection=self.connection)
+        # otherwise the sender didn't get the answer, send it again
+        self.transport.send(self.syn_reply)
+
+    def fin_received(self, segment):
+        """
+        :param segment: decoded FIN
+        :return: True if it closed the connection
+        """
+        # the sender only closes once everything is acknowledged, anything else is left over from before
+        if segment.sequence_number != self.base or len(segment.payload) != packet.LENGTH.size:
+            return False
+        length, = packet.LENGTH.unpack(bytes(segment.payload))
+        if length != self.length:
+            self.logger.info("The sender announced {} bytes but {} were delivered".format(length, self.length))
+        self.transport.send(packet.encode(segment.sequence_number, ack_number=self.base,
+                                          flags=packet.FIN | packet.ACK, connection=segment.connection))
+        self.finish()
+        return True
+
+    def ack_timeout(self):
+        self.ack_timer = None
+        if self.metrics is not None:
+            self.metrics.count(metrics_.ACKS_SENT)
+        self.transport.send(self.ack())
+
+    def ack(self):
+        """
+        ACK everything accepted so far
+        :return: ACK frame echoing the first segment it covers, with the cumulative ACK and a SACK bitmap of the
+        segments buffered past the gap
+        """
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        self.unacked = 0
+        # a huge window could need more than a frame, the segments left out are simply ACKed later
+        bitmap = packet.sack(self.base, self.buffered)[:channelsimulator.ChannelSimulator.BUFFER_SIZE -
+                                                        packet.HEADER_SIZE]
+        return packet.encode(self.echo, ack_number=self.base, flags=packet.ACK, payload=bitmap,
+                             connection=self.connection or 0)
+
+    def accept(self, sequence_number, payload):
+        """
+        Buffer a segment and deliver the in-order run
+        :param sequence_number: sequence number of the segment
+        :param payload: its payload
+        :return: (sequence number, payload) of a segment FEC rebuilt thanks to this one, or None
+        """
+        if sequence_number < self.base or sequence_number in self.buffered:
+            if self.metrics is not None:
+                self.metrics.count(metrics_.DUPLICATES)
+            return None
+        self.buffered[sequence_number] = payload
+        recovered = None
+        if self.fec:
+            block = sequence_number - sequence_number % self.fec
+            self.blocks.setdefault(block, {})[sequence_number] = payload
+            recovered = self.recover(block)
+        # deliver the in-order run
+        while self.base in self.buffered:
+            delivered = self.buffered.pop(self.base)
+            self.deliver(delivered)
+            self.length += len(delivered)
+            self.base += 1
+            if self.metrics is not None:
+                self.metrics.count(metrics_.BYTES_WRITTEN, len(delivered))
+        # forget the blocks that have been delivered completely
+        while self.fec and self.fec_base + self.fec <= self.base:
+            self.blocks.pop(self.fec_base, None)
+            self.parities.pop(self.fec_base, None)
+            self.fec_base += self.fec
+        return recovered
+
+    def parity_received(self, segment):
+        """
+        :param segment: decoded parity segment
+        :return: (sequence number, payload) of the segment it rebuilt, or None
+        """
+        block, count = segment.sequence_number, segment.ack_number
+        if block % self.fec or not 0 < count <= self.fec:
+            return None
+        # already delivered, or too far ahead to be real
+        if block + count <= self.base or block >= self.base + self.window_size:
+            return None
+        self.parities[block] = (count, segment.payload)
+        return self.recover(block)
+
+    def recover(self, block):
+        """
+        Rebuild the missing segment of a block if it is the only one missing and its parity is here
+        :param block: sequence number of the block's first segment
+        :return: (sequence number, payload) of the rebuilt segment, or None
+        """
+        if block not in self.parities:
+            return None
+        count, parity = self.parities[block]
+        received = self.blocks.get(block, {})
+        if len(received) != count - 1:
+            return None
+        missing = next(n for n in xrange(block, block + count) if n not in received)
+        try:
+            payload = fec_.recover(parity, received.values())
+        except ValueError:
+            return None
+        if self.metrics is not None:
+            self.metrics.count(metrics_.FEC_RECOVERED)
+        return missing, payload
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("stop-and-wait", "selective-repeat"), default="stop-and-wait")
+    parser.add_argument("--window", type=int, default=WINDOW_SIZE, help="window size for selective-repeat")
+    parser.add_argument("--output", help="file to write to instead of stdout")
+    parser.add_argument("--fec", type=int, default=0,
+                        help="segments per XOR parity segment for selective-repeat, must match the sender")
+    parser.add_argument("--flows", type=int, default=1,
+                        help="number of parallel selective-repeat flows, needs --output")
+    parser.add_argument("--compress", choices=sorted(compression.METHODS),
+                        help="decompress what the sender compressed, must match the sender")
+    parser.add_argument("--resume", action="store_true",
+                        help="resumable selective-repeat transfer into --output, progress is kept in a .checkpoint "
+                             "file next to it")
+    parser.add_argument("--server", metavar="DIRECTORY",
+                        help="serve many selective-repeat senders at once, each one's transfer goes to a file in "
+                             "DIRECTORY named after its connection ID")
+    parser.add_argument("--max-sessions", type=int, help="transfers to serve with --server before exiting")
+    parser.add_argument("--timeout", type=float, default=5,
+                        help="give up after the sender has been quiet this long, in seconds")
+    parser.add_argument("--ack-every", type=int, default=ACK_EVERY,
+                        help="in-order segments per ACK for selective-repeat")
+    parser.add_argument("--ack-delay", type=float, default=policy.ACK_DELAY,
+                        help="longest selective-repeat holds back an ACK for more segments, in seconds, "
+                             "the sender's timeouts assume the default")
+    channelmodels.add_arguments(parser)
+    parser.add_argument("--metrics", help="file to write metrics to, CSV if it ends in .csv and JSON otherwise")
+    parser.add_argument("--metrics-interval", type=float, default=0,
+                        help="seconds between metrics dumps, 0 to only write them at exit")
+    args = parser.parse_args()
+    if args.flows > 1 and (args.mode != "selective-repeat" or args.output is None):
+        parser.error("--flows needs --mode selective-repeat and --output")
+    if args.flows > 1 and args.metrics is not None:
+        parser.error("--metrics only supports a single flow")
+    if args.flows > 1 and args.compress is not None:
+        parser.error("--compress only supports a single flow")
+    if args.resume and (args.mode != "selective-repeat" or args.output is None or args.flows > 1 or
+                        args.compress is not None):
+        parser.error("--resume needs --mode selective-repeat, --output, a single flow and no --compress")
+    if args.server is not None and (args.mode != "selective-repeat" or args.output is not None or args.flows > 1 or
+                                    args.compress is not None or args.resume or args.fec):
+        parser.error("--server needs --mode selective-repeat, and supports neither --output, --flows, --compress, "
+                     "--resume nor --fec")
+    channel = channelmodels.from_arguments(args)
+    metrics = None
+    if args.metrics is not None:
+        metrics = metrics_.Metrics("receiver")
+        metrics_.Exporter(args.metrics, [metrics], args.metrics_interval).start()
+
     # test out BogoReceiver
     # rcvr = BogoReceiver()
     # rcvr.receive()
-    # use OurReceiver
-    rcvr = OurReceiver()
+    if args.flows > 1:
+        # imported here because parallel imports this module
+        import parallel
+        parallel.receive_parallel(args.output, args.flows, window_size=args.window, timeout=args.timeout,
+                                  channel_args=args, fec=args.fec, ack_every=args.ack_every,
+                                  ack_delay=args.ack_delay)
+        sys.exit()
+    if args.server is not None:
+        # imported here because server imports this module
+        import server
+        server.Server(server.files(args.server), window_size=args.window, timeout=args.timeout,
+                      ack_every=args.ack_every, ack_delay=args.ack_delay, max_sessions=args.max_sessions,
+                      metrics=metrics, **channel).receive()
+        sys.exit()
+    if args.resume:
+        output = session.SessionReceiver(args.output)
+        rcvr = SelectiveRepeatReceiver(window_size=args.window, timeout=args.timeout, output=output, fec=args.fec,
+                                       ack_every=args.ack_every, ack_delay=args.ack_delay, on_syn=output.hello,
+                                       metrics=metrics, **channel)
+        rcvr.receive()
+        if not output.verified:
+            sys.exit("Transfer incomplete or corrupt, run it again to resume")
+        sys.exit()
+    output = io.open(args.output, "wb", buffering=1 << 20) if args.output is not None else None
+    if args.compress is not None:
+        # each record names its own method, --compress only says that records are coming
+        output = compression.Decompressor(output if output is not None else utils.buffered_stdout())
+    if args.mode == "selective-repeat":
+        rcvr = SelectiveRepeatReceiver(window_size=args.window, timeout=args.timeout, output=output, fec=args.fec,
+                                       ack_every=args.ack_every, ack_delay=args.ack_delay, metrics=metrics, **channel)
+    else:
+        # use OurReceiver
+        rcvr = OurReceiver(timeout=args.timeout, output=output, metrics=metrics, **channel)
     rcvr.receive()
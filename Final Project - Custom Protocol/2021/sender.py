@@ -1,26 +1,57 @@
 # Written by S. Mevawala, modified by D. Gitzel
 
+import argparse
 import logging
+import os
+import random
 import socket
+import stat
+import time
 
+import channelmodels
 import channelsimulator
+import compression
+import engine
+import fec as fec_
+import metrics as metrics_
+import packet
+import policy
+import session
 import utils
 import sys
 
-import hashlib
+MAX_SEGMENT_SIZE = channelsimulator.ChannelSimulator.BUFFER_SIZE - packet.HEADER_SIZE
+WINDOW_SIZE = 64
+# longest a sender keeps resending its FIN, in seconds. Everything is acknowledged by then, the FIN only lets the
+# receiver close, and a receiver whose answer got lost has closed already
+TIME_WAIT = 1
 
-MAX_SEQUENCE_NUMBER = 256
+
+def segment_size(max_segment_size=MAX_SEGMENT_SIZE, fec=0):
+    """
+    :param max_segment_size: largest payload asked for, in bytes
+    :param fec: segments per parity segment, 0 for none
+    :return: largest payload a SelectiveRepeatSender with these settings sends, in bytes
+    """
+    # parity segments are slightly longer than what they protect and still have to fit in a frame
+    return min(max_segment_size, MAX_SEGMENT_SIZE - fec_.OVERHEAD) if fec else max_segment_size
 
 
 class Sender(object):
 
-    def __init__(self, inbound_port=50006, outbound_port=50005, timeout=10, debug_level=logging.INFO):
+    def __init__(self, inbound_port=50006, outbound_port=50005, timeout=10, debug_level=logging.INFO, metrics=None,
+                 network=None, **channel):
         self.logger = utils.Logger(self.__class__.__name__, debug_level)
 
         self.inbound_port = inbound_port
         self.outbound_port = outbound_port
-        self.simulator = channelsimulator.ChannelSimulator(inbound_port=inbound_port, outbound_port=outbound_port,
-                                                           debug_level=debug_level)
+        # None when metrics are off, checked before recording anything
+        self.metrics = metrics
+        # channel holds any other ChannelSimulator arguments, e.g. its seed and error probabilities
+        # a loopback.Network swaps the UDP sockets for in-memory ones
+        factory = network.channel if network is not None else channelsimulator.ChannelSimulator
+        self.simulator = factory(inbound_port=inbound_port, outbound_port=outbound_port, debug_level=debug_level,
+                                 metrics=metrics, **channel)
         self.simulator.sndr_setup(timeout)
         self.simulator.rcvr_setup(timeout)
 
@@ -30,8 +61,8 @@ class Sender(object):
 
 class BogoSender(Sender):
 
-    def __init__(self):
-        super(BogoSender, self).__init__()
+    def __init__(self, **kwargs):
+        super(BogoSender, self).__init__(**kwargs)
 
     def send(self, data):
         self.logger.info(
@@ -48,71 +79,527 @@ class BogoSender(Sender):
 
 
 class OurSender(BogoSender):
+    """
+    Stop-and-wait sender. Opens the connection with a SYN and, once the last segment is acknowledged, closes it with
+    a FIN announcing the length, like SelectiveRepeatSender. How long it waits for an ACK is up to its timeout
+    policy, which samples the round trip of every segment that was sent once (Karn's rule) and backs off on timeouts.
+    """
 
-    def __init__(self, max_segment_size=959, timeout=0.01):
-        super(OurSender, self).__init__()
+    def __init__(self, max_segment_size=MAX_SEGMENT_SIZE, timeout_policy=None, time_wait=TIME_WAIT, **kwargs):
+        """
+        :param max_segment_size: largest payload per segment, in bytes
+        :param timeout_policy: retransmission timeout policy from policy.py, defaults to an AdaptiveTimeout that
+        expects no ACK delay, as OurReceiver ACKs at once
+        :param time_wait: seconds to keep resending the FIN before giving up on its answer
+        """
+        super(OurSender, self).__init__(**kwargs)
         self.MSS = max_segment_size
-        self.timeout = timeout
-        self.simulator.sndr_socket.settimeout(self.timeout)
-        self.simulator.rcvr_socket.settimeout(self.timeout)
+        self.timeout_policy = timeout_policy if timeout_policy is not None else policy.AdaptiveTimeout(max_ack_delay=0)
+        self.time_wait = time_wait
+        # every packet is built in this buffer instead of a fresh one
+        self.frame = bytearray(packet.HEADER_SIZE + self.MSS)
+        self.timeout = None
+        self.update_timeout()
 
-    # produce a checksum value
-    @staticmethod
-    def checksum(data):
-        return hashlib.md5(data).hexdigest()
+    def update_timeout(self):
+        # the sockets wait for an answer as long as the policy says
+        if self.timeout != self.timeout_policy.rto:
+            self.timeout = self.timeout_policy.rto
+            self.simulator.sndr_socket.settimeout(self.timeout)
+            self.simulator.rcvr_socket.settimeout(self.timeout)
 
     def send(self, data):
+        self.send_segments(utils.iter_segments(data, self.MSS))
+
+    def send_segments(self, segments):
+        """
+        Send a stream of segments, only the current one is kept in memory
+        :param segments: iterable of payloads of at most MSS bytes
+        :return:
+        """
         self.logger.info(
             "Sending on port: {} and waiting for ACK on port: {}".format(self.outbound_port, self.inbound_port))
+        segments = iter(segments)
+        metrics = self.metrics
         # initialize parameters
-        start = 0
         resend = False
         send_array = None
         sequence_number = 0
-        previous_checksum = bytearray([0 for _ in range(32)])
+        first_sent = 0
+        # of the current segment
+        transmissions = 0
+        length = 0
+        connection = random.getrandbits(32)
+        self.exchange(packet.encode(0, flags=packet.SYN, payload=packet.REPLY.pack(self.inbound_port),
+                                    connection=connection), 0, connection)
         while True:
             try:
-                # 0:32 - md5
-                # 32:64 - previous md5
-                # 64 - sequence_number
-                # 65: - data
-                # include previous checksum because in some instances MAX_SEQUENCE_NUMBER packets were dropped in a row
-                # can alternatively include checksum in ACK
+                # the 32 bit sequence number is wide enough that a run of dropped packets can't alias an old one
                 if not resend:
                     # send a new packet
-                    send_array = bytearray([sequence_number])
-                    sequence_number = (sequence_number + 1) % MAX_SEQUENCE_NUMBER
-                    send_array += data[start:start+self.MSS]
-                    send_array = previous_checksum + send_array
-                    checksum = self.checksum(send_array)
-                    send_array = checksum + send_array
-                    previous_checksum = checksum
-                    start += self.MSS
-                    self.simulator.u_send(send_array)
-                else:
-                    # send previous packet
-                    self.simulator.u_send(send_array)
-
-                ack = self.simulator.u_receive()
-                # check the checksum of the ACK
-                if self.checksum(ack[32:]) == ack[0:32]:
-                    if ack[32] == sequence_number:
-                        if start >= len(data):
-                            break
-                        resend = False
-                    else:
-                        resend = True
-                else:
-                    resend = True
+                    payload = next(segments, None)
+                    if payload is None:
+                        break
+                    length += len(payload)
+                    send_array = packet.encode_into(self.frame, sequence_number, payload=payload,
+                                                    connection=connection)
+                    sequence_number = (sequence_number + 1) % packet.MAX_SEQUENCE_NUMBER
+                    transmissions = 0
+                    if metrics is not None:
+                        metrics.count(metrics_.SEGMENTS_SENT)
+                        metrics.count(metrics_.BYTES_SENT, len(payload))
+                        first_sent = time.time()
+                elif metrics is not None:
+                    metrics.count(metrics_.RESENDS)
+                self.simulator.u_send(send_array)
+                transmissions += 1
+                sent_at = time.time()
+
+                # decode also checks the checksum of the ACK
+                ack = packet.decode(self.simulator.u_receive())
+                resend = (ack is None or ack.flags != packet.ACK or ack.ack_number != sequence_number or
+                          ack.connection != connection)
+                # Karn's rule: an ACK for a resent segment may answer any of its copies
+                if not resend and transmissions == 1:
+                    self.timeout_policy.sample(time.time() - sent_at)
+                    self.update_timeout()
+                if metrics is not None:
+                    metrics.count(metrics_.FRAMES_RECEIVED)
+                    if ack is None:
+                        metrics.count(metrics_.CORRUPT_FRAMES)
+                    elif not resend:
+                        metrics.count(metrics_.ACKS_RECEIVED)
+                        metrics.observe(metrics_.ACK_LATENCY, time.time() - first_sent)
             except socket.timeout:
                 resend = True
+                self.timeout_policy.backoff()
+                self.update_timeout()
+                if metrics is not None:
+                    metrics.count(metrics_.TIMEOUTS)
+        # everything is acknowledged, the FIN only lets the receiver close, see SelectiveRepeatSender.close
+        self.exchange(packet.encode(sequence_number, flags=packet.FIN, payload=packet.LENGTH.pack(length),
+                                    connection=connection), sequence_number, connection, time.time() + self.time_wait)
+
+    def exchange(self, frame, sequence_number, connection, deadline=None):
+        """
+        Send a SYN or FIN until the receiver answers it
+        :param frame: encoded SYN or FIN
+        :param sequence_number: its sequence number, which the answer echoes
+        :param connection: connection ID, which the answer echoes too
+        :param deadline: time.time() to give up at, None to keep trying
+        :return: True if it was answered
+        """
+        flags = packet.decode(frame).flags | packet.ACK
+        transmissions = 0
+        while deadline is None or time.time() < deadline:
+            self.simulator.u_send(frame)
+            transmissions += 1
+            sent_at = time.time()
+            try:
+                # ACKs still on their way don't count, only a timeout sends it again
+                while True:
+                    answer = packet.decode(self.simulator.u_receive())
+                    if answer is not None and (answer.flags, answer.sequence_number, answer.connection) == (
+                            flags, sequence_number, connection):
+                        if transmissions == 1:
+                            self.timeout_policy.sample(time.time() - sent_at)
+                            self.update_timeout()
+                        return True
+            except socket.timeout:
+                self.timeout_policy.backoff()
+                self.update_timeout()
+                if self.metrics is not None:
+                    self.metrics.count(metrics_.TIMEOUTS)
+        return False
+
+
+class SelectiveRepeatSender(BogoSender):
+    """
+    Event driven Selective Repeat sender with a retransmission timer per segment on the loop.
+    send() runs its own loop until everything is acknowledged; pass a shared engine.EventLoop and call start() to
+    run many transfers on one loop.
+    """
+    # data segments carry their sequence number, ACKs echo the first one they cover in the sequence number field,
+    # carry the cumulative ACK (next sequence number the receiver is waiting for) in the ACK number field and a SACK
+    # bitmap of the segments received past it as their payload
+    # connect() opens the connection by trading a SYN for a SYN | ACK, which may carry the handshake of a layer above
+    # (see session.py), and once everything is acknowledged a FIN for a FIN | ACK closes it. Every frame carries the
+    # connection ID and answers to any other connection are ignored
+
+    def __init__(self, window_size=WINDOW_SIZE, max_segment_size=MAX_SEGMENT_SIZE, timeout_policy=None,
+                 window_policy=None, loop=None, fec=0, time_wait=TIME_WAIT, **kwargs):
+        """
+        :param window_size: receiver window, the congestion window never grows past it
+        :param max_segment_size: payload bytes per segment
+        :param timeout_policy: retransmission timeout policy from policy.py, defaults to AdaptiveTimeout
+        :param window_policy: window policy from policy.py, defaults to AIMDWindow
+        :param loop: engine.EventLoop to run on, defaults to a private one
+        :param fec: send one XOR parity segment per this many segments, 0 to turn FEC off
+        :param time_wait: longest to keep resending the FIN for, in seconds
+        """
+        super(SelectiveRepeatSender, self).__init__(**kwargs)
+        self.window_size = window_size
+        self.fec = fec
+        self.time_wait = time_wait
+        self.MSS = segment_size(max_segment_size, fec)
+        # every packet is built in this buffer instead of a fresh one
+        self.frame = bytearray(channelsimulator.ChannelSimulator.BUFFER_SIZE)
+        self.timeout_policy = timeout_policy if timeout_policy is not None else policy.AdaptiveTimeout()
+        self.window_policy = window_policy if window_policy is not None else policy.AIMDWindow(maximum=window_size)
+        self.loop = loop if loop is not None else engine.EventLoop()
+        self.transport = engine.ChannelTransport(self.loop, self.simulator, self, max_frames=window_size)
+        self.done = False
+        self.on_done = None
+        # set by start(), nothing is sent or acknowledged before that
+        self.segments = None
+        self.closing = False
+        self.timers = {}
+        # connection ID, 0 until connect(), and the callback of a connect() in progress
+        self.connection = 0
+        self.on_established = None
+        # the SYN or FIN waiting for an answer and its retransmission timer
+        self.control = None
+        self.control_timer = None
+
+    def send(self, data):
+        self.send_segments(utils.iter_segments(data, self.MSS))
+
+    def send_segments(self, segments):
+        """
+        Open a connection and send a stream of segments, only the ones inside the window are kept in memory.
+        Blocks until all of them are acknowledged and the connection is closed.
+        :param segments: iterable of payloads of at most MSS bytes
+        :return:
+        """
+        # a server (see server.py) answers on the port the SYN names
+        self.connect(packet.REPLY.pack(self.inbound_port), lambda reply: self.start(segments))
+        self.loop.run()
+
+    def start(self, segments, on_done=None):
+        """
+        Start sending on the loop without blocking
+        :param segments: iterable of payloads of at most MSS bytes
+        :param on_done: called without arguments once everything is acknowledged and the connection is closed
+        :return:
+        """
+        self.logger.info(
+            "Sending on port: {} and waiting for ACK on port: {}".format(self.outbound_port, self.inbound_port))
+        self.segments = iter(segments)
+        self.on_done = on_done
+        self.done = False
+        # initialize parameters
+        # payload of every segment that was sent but not acknowledged yet
+        self.outstanding = {}
+        # number of transmissions and time of the last one, for Karn's rule
+        self.transmissions = {}
+        self.sent_at = {}
+        # time of the first transmission, only kept for the metrics
+        self.first_sent = {}
+        # retransmission timer of every unacknowledged segment
+        self.timers = {}
+        self.base = 0
+        self.next_sequence_number = 0
+        # bytes queued so far, announced in the FIN
+        self.length = 0
+        self.exhausted = False
+        self.closing = False
+        # segments sent before the last loss event expire together, that counts as one event
+        self.last_loss = 0
+        self.parity = fec_.ParityEncoder(self.fec, self.MSS) if self.fec else None
+        self.transport.start()
+        self.fill_window()
+
+    def connect(self, payload, on_established):
+        """
+        Open a connection before start(): send a SYN until the receiver answers it
+        :param payload: handshake for the layer above the receiver
+        :param on_established: called with the payload of the receiver's answer, usually calls start()
+        :return:
+        """
+        self.connection = random.getrandbits(32)
+        self.on_established = on_established
+        self.transport.start()
+        self.send_control(packet.encode(0, flags=packet.SYN, payload=payload, connection=self.connection))
+
+    def close(self):
+        """
+        Everything is acknowledged: send a FIN until the receiver answers it, so that it can close as well.
+        The receiver closes as soon as it answers, so if the answer gets lost no FIN is ever answered again. That
+        makes time_wait the longest the sender lingers, after which it closes anyway.
+        :return:
+        """
+        self.closing = True
+        self.send_control(packet.encode(self.next_sequence_number, flags=packet.FIN,
+                                        payload=packet.LENGTH.pack(self.length), connection=self.connection),
+                          deadline=self.loop.time() + self.time_wait)
+
+    def send_control(self, frame, deadline=None):
+        """
+        Send a SYN or FIN until it is answered, backing off like a segment
+        :param frame: encoded SYN or FIN
+        :param deadline: loop time to give up and finish at, None to keep trying
+        :return:
+        """
+        self.control = frame
+        self.control_deadline = deadline
+        self.control_transmissions = 0
+        self.transmit_control()
+
+    def transmit_control(self):
+        self.control_timer = None
+        if self.control_deadline is not None and self.loop.time() >= self.control_deadline:
+            self.finish()
+            return
+        if self.control_transmissions:
+            self.timeout_policy.backoff()
+            if self.metrics is not None:
+                self.metrics.count(metrics_.RESENDS)
+        self.control_transmissions += 1
+        self.control_sent_at = self.loop.time()
+        self.transport.send(self.control)
+        self.control_timer = self.loop.call_later(self.timeout_policy.rto, self.transmit_control)
+
+    def control_received(self, reply):
+        """
+        :param reply: decoded SYN | ACK or FIN | ACK
+        :return:
+        """
+        control = packet.decode(self.control) if self.control is not None else None
+        # answers to an earlier connection, or duplicates of one that already got through
+        if control is None or (reply.flags, reply.sequence_number) != (control.flags | packet.ACK,
+                                                                        control.sequence_number):
+            return
+        self.control = None
+        self.control_timer.cancel()
+        self.control_timer = None
+        if self.control_transmissions == 1:
+            self.timeout_policy.sample(self.loop.time() - self.control_sent_at)
+        if reply.flags & packet.FIN:
+            self.finish()
+        else:
+            on_established, self.on_established = self.on_established, None
+            on_established(reply.payload)
+
+    def transmit(self, sequence_number):
+        """
+        (Re)send a segment and (re)arm its timer
+        :param sequence_number: sequence number of the segment
+        :return:
+        """
+        self.transport.send(packet.encode_into(self.frame, sequence_number, payload=self.outstanding[sequence_number],
+                                               connection=self.connection))
+        transmissions = self.transmissions[sequence_number] = self.transmissions.get(sequence_number, 0) + 1
+        if self.metrics is not None and transmissions > 1:
+            self.metrics.count(metrics_.RESENDS)
+        self.sent_at[sequence_number] = self.loop.time()
+        if sequence_number in self.timers:
+            self.timers[sequence_number].cancel()
+        self.timers[sequence_number] = self.loop.call_later(self.timeout_policy.rto, self.expire, sequence_number)
+
+    def forget(self, sequence_number):
+        if self.metrics is not None:
+            self.metrics.observe(metrics_.ACK_LATENCY, self.loop.time() - self.first_sent.pop(sequence_number))
+        del self.outstanding[sequence_number]
+        del self.transmissions[sequence_number]
+        del self.sent_at[sequence_number]
+        self.timers.pop(sequence_number).cancel()
+
+    def fill_window(self):
+        limit = self.base + min(self.window_policy.size, self.window_size)
+        while not self.exhausted and self.next_sequence_number < limit:
+            payload = next(self.segments, None)
+            if payload is None:
+                self.exhausted = True
+                if self.parity is not None:
+                    self.send_parity(self.parity.flush())
+                break
+            if self.next_sequence_number == packet.MAX_SEQUENCE_NUMBER:
+                raise ValueError("Input needs more than {} segments".format(packet.MAX_SEQUENCE_NUMBER))
+            self.outstanding[self.next_sequence_number] = payload
+            self.length += len(payload)
+            if self.metrics is not None:
+                self.metrics.count(metrics_.SEGMENTS_SENT)
+                self.metrics.count(metrics_.BYTES_SENT, len(payload))
+                self.first_sent[self.next_sequence_number] = self.loop.time()
+            self.transmit(self.next_sequence_number)
+            self.next_sequence_number += 1
+            if self.parity is not None:
+                self.send_parity(self.parity.add(payload))
+        if self.exhausted and not self.outstanding and not self.closing:
+            self.close()
+
+    def send_parity(self, parity):
+        """
+        Send the parity of the block that ends with the last new segment. It is sent once and never retransmitted.
+        :param parity: (number of segments covered, parity payload) from the encoder, or None
+        :return:
+        """
+        if parity is None:
+            return
+        count, payload = parity
+        self.transport.send(packet.encode_into(self.frame, self.next_sequence_number - count, ack_number=count,
+                                               flags=packet.PARITY, payload=payload, connection=self.connection))
+
+    def finish(self):
+        if self.control_timer is not None:
+            self.control_timer.cancel()
+            self.control_timer = None
+        # only left when the transfer is abandoned
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        self.transport.close()
+        self.done = True
+        if self.on_done is not None:
+            self.on_done()
+
+    def frames_received(self, frames):
+        now = self.loop.time()
+        for ack in frames:
+            # decode also checks the checksum of the ACK
+            ack = packet.decode(ack)
+            # left over from an earlier connection
+            if ack is not None and ack.connection != self.connection:
+                continue
+            if ack is not None and ack.flags & (packet.SYN | packet.FIN):
+                self.control_received(ack)
+                continue
+            if ack is None or not ack.flags & packet.ACK or self.segments is None:
+                if self.metrics is not None and ack is None:
+                    self.metrics.count(metrics_.CORRUPT_FRAMES)
+                continue
+            if self.metrics is not None:
+                self.metrics.count(metrics_.ACKS_RECEIVED)
+            cumulative, sequence_number = ack.ack_number, ack.sequence_number
+            # Karn's rule: an ACK for a resent segment is ambiguous
+            if sequence_number in self.outstanding and self.transmissions[sequence_number] == 1:
+                self.timeout_policy.sample(now - self.sent_at[sequence_number])
+                if self.metrics is not None:
+                    self.metrics.observe(metrics_.RTT, now - self.sent_at[sequence_number])
+            # everything below the cumulative ACK has been delivered, even if its own ACK got lost
+            acknowledged = 0
+            for delivered in xrange(self.base, min(cumulative, self.next_sequence_number)):
+                if delivered in self.outstanding:
+                    self.forget(delivered)
+                    acknowledged += 1
+            # and everything in the SACK bitmap is buffered past the gap
+            sacked = 0
+            for buffered in packet.sacked(cumulative, ack.payload):
+                if buffered in self.outstanding:
+                    self.forget(buffered)
+                    sacked += 1
+            previous_base = self.base
+            while self.base < self.next_sequence_number and self.base not in self.outstanding:
+                self.base += 1
+            if self.base > previous_base:
+                # once per segment, however many one ACK covers
+                for _ in xrange(acknowledged):
+                    self.window_policy.on_ack()
+            # every segment that got past the hole counts as a duplicate ACK, coalesced or not
+            for _ in xrange(sacked):
+                if self.window_policy.on_duplicate_ack():
+                    # fast retransmit the hole the receiver keeps reporting, unless a stale ACK's SACKs just
+                    # retired everything that was left
+                    if self.base in self.outstanding:
+                        if self.metrics is not None:
+                            self.metrics.count(metrics_.FAST_RETRANSMITS)
+                        self.transmit(self.base)
+                    break
+        if self.metrics is not None:
+            self.metrics.count(metrics_.FRAMES_RECEIVED, len(frames))
+        if self.segments is not None:
+            self.fill_window()
+
+    def expire(self, sequence_number):
+        del self.timers[sequence_number]
+        if self.metrics is not None:
+            self.metrics.count(metrics_.TIMEOUTS)
+        if self.sent_at[sequence_number] >= self.last_loss:
+            # first timeout since the last loss event
+            self.last_loss = self.loop.time()
+            self.timeout_policy.backoff()
+            self.window_policy.on_timeout()
+        self.transmit(sequence_number)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("stop-and-wait", "selective-repeat"), default="stop-and-wait")
+    parser.add_argument("--window", type=int, default=WINDOW_SIZE, help="window size for selective-repeat")
+    parser.add_argument("--timeout-policy", choices=("adaptive", "fixed"), default="adaptive",
+                        help="retransmission timeout policy")
+    parser.add_argument("--window-policy", choices=("aimd", "fixed"), default="aimd",
+                        help="window policy for selective-repeat")
+    parser.add_argument("--fec", type=int, default=0,
+                        help="segments per XOR parity segment for selective-repeat, 0 for no FEC")
+    parser.add_argument("--flows", type=int, default=1,
+                        help="number of parallel selective-repeat flows, stdin has to be a regular file")
+    parser.add_argument("--compress", choices=sorted(compression.METHODS),
+                        help="compress the input, blocks that don't compress are sent raw, the receiver must match")
+    parser.add_argument("--compress-level", type=int, help="compression level, defaults to the method's own")
+    parser.add_argument("--resume", action="store_true",
+                        help="resumable selective-repeat transfer, stdin has to be a regular file and the receiver "
+                             "has to use --resume too")
+    parser.add_argument("--chunk-size", type=int, default=session.CHUNK_SIZE,
+                        help="bytes per checkpointed and verified chunk with --resume")
+    parser.add_argument("--inbound-port", type=int, default=50006,
+                        help="port to receive ACKs on, every sender of a receiver with --server needs its own")
+    channelmodels.add_arguments(parser)
+    parser.add_argument("--metrics", help="file to write metrics to, CSV if it ends in .csv and JSON otherwise")
+    parser.add_argument("--metrics-interval", type=float, default=0,
+                        help="seconds between metrics dumps, 0 to only write them at exit")
+    args = parser.parse_args()
+    if args.flows > 1 and args.mode != "selective-repeat":
+        parser.error("--flows needs --mode selective-repeat")
+    if args.flows > 1 and args.metrics is not None:
+        parser.error("--metrics only supports a single flow")
+    if args.flows > 1 and args.compress is not None:
+        parser.error("--compress only supports a single flow")
+    if args.resume and (args.mode != "selective-repeat" or args.flows > 1 or args.compress is not None):
+        parser.error("--resume needs --mode selective-repeat, a single flow and no --compress")
+    if args.resume and not stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode):
+        parser.error("--resume needs stdin to be a regular file")
+    if args.chunk_size <= 0:
+        parser.error("--chunk-size has to be positive")
+    channel = channelmodels.from_arguments(args)
+    metrics = None
+    if args.metrics is not None:
+        metrics = metrics_.Metrics("sender")
+        metrics_.Exporter(args.metrics, [metrics], args.metrics_interval).start()
+
     # test out BogoSender
-    DATA = bytearray(sys.stdin.read())
+    # DATA = bytearray(sys.stdin.read())
     # sndr = BogoSender()
     # sndr.send(DATA)
-    # use OurSender
-    sndr = OurSender()
-    sndr.send(DATA)
+    # every flow gets its own copy of the policies
+    settings = dict(
+        fec=args.fec,
+        timeout_policy=policy.AdaptiveTimeout() if args.timeout_policy == "adaptive" else policy.FixedTimeout(),
+        window_policy=(policy.AIMDWindow(maximum=args.window) if args.window_policy == "aimd"
+                       else policy.FixedWindow(args.window)))
+    if args.flows > 1:
+        # imported here because parallel imports this module
+        import parallel
+        parallel.send_parallel(sys.stdin, args.flows, window_size=args.window, channel_args=args, **settings)
+        sys.exit()
+    if args.mode == "selective-repeat":
+        sndr = SelectiveRepeatSender(
+            window_size=args.window,
+            inbound_port=args.inbound_port,
+            metrics=metrics,
+            **dict(settings, **channel))
+    else:
+        # use OurSender
+        sndr = OurSender(timeout_policy=None if args.timeout_policy == "adaptive" else policy.FixedTimeout(),
+                         inbound_port=args.inbound_port, metrics=metrics,
+                         **channel)
+    if args.resume:
+        session.send(sndr, sys.stdin, args.chunk_size)
+        sys.exit()
+    # stream stdin instead of reading all of it before the first packet goes out
+    if args.compress is not None:
+        segments = utils.resegment(compression.compress(utils.read_segments(sys.stdin, compression.BLOCK_SIZE),
+                                                        args.compress, args.compress_level), sndr.MSS)
+    else:
+        segments = utils.read_segments(sys.stdin, sndr.MSS)
+    sndr.send_segments(segments)
@@ -0,0 +1,364 @@
+"""
+Server mode: one receiver socket serving many Selective Repeat senders at once.
+
+Every frame carries the ID of the connection it belongs to (see packet.py), so the server demultiplexes the frames of
+its one socket into a Session per connection. A sender's SYN opens its session and its FIN closes it. The channel
+doesn't report where a datagram came from, so the SYN's payload (packet.REPLY) names the port to answer on. Each
+session is written to its own output. A session whose sender has been quiet for the whole timeout is dropped.
+
+Sessions are all the state a connection costs, so they keep it in __slots__ and share the rest: ACKs go out through
+a channel per session (its own errors, towards its own port) on the server's one outbound socket, and a single timer
+each handles the delayed ACKs and the idle sessions of all of them.
+
+ACKs are scheduled fairly. A session that owes an ACK joins a FIFO queue once, however many segments it sent, and
+every turn of the loop sends at most ack_budget ACKs off the front before going back to the socket. So each sender
+gets one ACK per round however fast it sends, ACKs coalesce more the more sessions compete, and answering never keeps
+the server from reading for so long that the socket buffer overflows and drops everyone's segments.
+
+Senders must not use FEC or the session layer (session.py).
+"""
+
+import collections
+import io
+import os
+
+import engine
+import metrics as metrics_
+import packet
+import policy
+from receiver import ACK_EVERY, WINDOW_SIZE, Receiver
+
+# sessions per turn of the loop that get an ACK
+ACK_BUDGET = 64
+# closed connections remembered, to answer their FIN again and ignore what else is still on its way
+CLOSED_SESSIONS = 1024
+
+
+class Session(object):
+    """
+    Reassembly state of one connection
+    """
+    __slots__ = ("connection", "transport", "output", "base", "buffered", "length", "unacked", "echo", "due",
+                 "queued", "opened", "last_activity")
+
+    def __init__(self, connection, transport, output, now):
+        """
+        :param connection: connection ID
+        :param transport: engine.ChannelTransport the session's ACKs go out on
+        :param output: file-like object to write to
+        :param now: loop time of the SYN
+        """
+        self.connection = connection
+        self.transport = transport
+        self.output = output
+        # next sequence number to deliver and the out of order segments past it
+        self.base = 0
+        self.buffered = {}
+        # bytes delivered, checked against the length the FIN announces
+        self.length = 0
+        # segments accepted since the last ACK and the first of them, see SelectiveRepeatReceiver.reset
+        self.unacked = 0
+        self.echo = 0
+        # when the delayed ACK is due, None if none is
+        self.due = None
+        # waiting in the server's ACK queue
+        self.queued = False
+        self.opened = now
+        self.last_activity = now
+
+    def accept(self, sequence_number, payload):
+        """
+        Buffer a segment and deliver the in-order run
+        :param sequence_number: sequence number of the segment
+        :param payload: its payload
+        :return: bytes delivered, None for a duplicate
+        """
+        if sequence_number < self.base or sequence_number in self.buffered:
+            return None
+        self.buffered[sequence_number] = payload
+        delivered = 0
+        while self.base in self.buffered:
+            payload = self.buffered.pop(self.base)
+            self.output.write(payload)
+            delivered += len(payload)
+            self.base += 1
+        self.length += delivered
+        return delivered
+
+    def ack(self):
+        """
+        :return: ACK of everything accepted so far, like SelectiveRepeatReceiver.ack
+        """
+        self.unacked = 0
+        self.due = None
+        bitmap = packet.sack(self.base, self.buffered)[:self.transport.simulator.BUFFER_SIZE - packet.HEADER_SIZE]
+        return packet.encode(self.echo, ack_number=self.base, flags=packet.ACK, payload=bitmap,
+                             connection=self.connection)
+
+
+class Server(Receiver):
+    """
+    Receiver for many senders at once on one port, see the module docstring. receive() serves until max_sessions
+    sessions have ended; pass a shared engine.EventLoop and call start() to run it next to other protocols.
+    """
+
+    def __init__(self, outputs, window_size=WINDOW_SIZE, timeout=5, loop=None, ack_every=ACK_EVERY,
+                 ack_delay=policy.ACK_DELAY, ack_budget=ACK_BUDGET, max_sessions=None, **kwargs):
+        """
+        :param outputs: called with the ID of a new connection, returns the file-like object to write it to, which is
+        closed when the session ends
+        :param window_size: receiver window, must be at least the senders'
+        :param timeout: seconds a sender may be quiet before its session is dropped
+        :param loop: engine.EventLoop to run on, defaults to a private one
+        :param ack_every: in-order segments per ACK
+        :param ack_delay: longest an ACK is held back for more segments, in seconds
+        :param ack_budget: ACKs per turn of the loop
+        :param max_sessions: sessions to serve before receive() returns, None to serve forever
+        """
+        super(Server, self).__init__(timeout=timeout, **kwargs)
+        self.outputs = outputs
+        self.window_size = window_size
+        self.timeout = timeout
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.ack_budget = ack_budget
+        self.max_sessions = max_sessions
+        self.loop = loop if loop is not None else engine.EventLoop()
+        self.transport = engine.ChannelTransport(self.loop, self.simulator, self, max_frames=window_size)
+        # connection ID -> Session, and the last CLOSED_SESSIONS closed ones
+        self.sessions = {}
+        self.closed = collections.OrderedDict()
+        # sessions that owe an ACK now, in the order they will get it, and the timer of the next turn
+        self.ready = collections.deque()
+        self.ack_turn = None
+        # (due, session) of the delayed ACKs in the order they come due, which is the order they were delayed in
+        self.delayed = collections.deque()
+        self.ack_timer = None
+        self.idle_timer = None
+        # sessions that ended, closed or dropped
+        self.ended = 0
+        self.done = False
+
+    def start(self):
+        """
+        Start serving on the loop without blocking
+        :return:
+        """
+        self.logger.info("Serving on port: {}".format(self.inbound_port))
+        self.done = False
+        self.transport.start()
+
+    def receive(self):
+        self.start()
+        self.loop.run()
+
+    def finish(self):
+        self.done = True
+        for timer in (self.ack_turn, self.ack_timer, self.idle_timer):
+            if timer is not None:
+                timer.cancel()
+        self.ack_turn = self.ack_timer = self.idle_timer = None
+        for session in self.sessions.values():
+            self.end(session)
+        self.transport.close()
+
+    def frames_received(self, frames):
+        now = self.loop.time()
+        metrics = self.metrics
+        for data in frames:
+            # drop corrupt packets, the sender will time out and resend
+            segment = packet.decode(data)
+            if segment is None:
+                if metrics is not None:
+                    metrics.count(metrics_.CORRUPT_FRAMES)
+                continue
+            if segment.flags & packet.SYN:
+                self.syn_received(segment, now)
+                continue
+            session = self.sessions.get(segment.connection)
+            if session is None:
+                if segment.flags & packet.FIN and segment.connection in self.closed:
+                    # the sender didn't get the answer
+                    self.answer_fin(self.closed[segment.connection], segment)
+                continue
+            session.last_activity = now
+            if segment.flags & packet.FIN:
+                self.fin_received(session, segment, now)
+                # that may have been the last session to serve
+                if self.done:
+                    break
+                continue
+            sequence_number = segment.sequence_number
+            # parity needs FEC, and beyond the window the sender cannot have sent it yet
+            if segment.flags & (packet.ACK | packet.PARITY) or sequence_number >= session.base + self.window_size:
+                continue
+            expected = session.base
+            delivered = session.accept(sequence_number, segment.payload)
+            if metrics is not None:
+                if delivered is None:
+                    metrics.count(metrics_.DUPLICATES)
+                else:
+                    metrics.count(metrics_.BYTES_WRITTEN, delivered)
+            # ACK everything, including segments below the window whose ACK got lost
+            if not session.unacked:
+                session.echo = sequence_number
+            session.unacked += 1
+            # out of order, a duplicate or the segment that fills a gap is ACKed right away
+            if sequence_number != expected or session.base > expected + 1 or session.unacked >= self.ack_every:
+                self.schedule_ack(session)
+            elif session.due is None:
+                session.due = now + self.ack_delay
+                self.delayed.append((session.due, session))
+                if self.ack_timer is None:
+                    self.ack_timer = self.loop.call_later(self.ack_delay, self.ack_timeout)
+        if metrics is not None:
+            metrics.count(metrics_.FRAMES_RECEIVED, len(frames))
+        if self.ready and self.ack_turn is None and not self.done:
+            self.send_acks()
+
+    def syn_received(self, segment, now):
+        """
+        :param segment: decoded SYN
+        :param now: loop time
+        :return:
+        """
+        connection = segment.connection
+        session = self.sessions.get(connection)
+        if session is None:
+            # late copies of a closed connection's SYN, and SYNs without a port to answer on
+            if connection in self.closed or len(segment.payload) != packet.REPLY.size:
+                return
+            port, = packet.REPLY.unpack(bytes(segment.payload))
+            simulator = self.factory(inbound_port=self.inbound_port, outbound_port=port, debug_level=self.debug_level,
+                                     metrics=self.metrics, **self.channel_for(connection))
+            # every session sends on the server's socket instead of opening one of its own
+            simulator.sndr_socket = self.simulator.sndr_socket
+            transport = engine.ChannelTransport(self.loop, simulator, self)
+            session = self.sessions[connection] = Session(connection, transport, self.outputs(connection), now)
+            if self.metrics is not None:
+                self.metrics.count(metrics_.SESSIONS)
+            if self.idle_timer is None:
+                self.idle_timer = self.loop.call_later(self.timeout, self.check_idle)
+        # otherwise the sender didn't get the answer, send it again
+        session.transport.send(packet.encode(0, flags=packet.SYN | packet.ACK, connection=connection))
+
+    def channel_for(self, connection):
+        """
+        :param connection: connection ID
+        :return: channel arguments for a session, each gets errors of its own that are still seeded
+        """
+        channel = dict(self.channel)
+        if channel.get("seed") is not None:
+            channel["seed"] += connection
+        return channel
+
+    def fin_received(self, session, segment, now):
+        """
+        :param session: Session the FIN belongs to
+        :param segment: decoded FIN
+        :param now: loop time
+        :return:
+        """
+        # the sender only closes once everything is acknowledged, anything else is left over from before
+        if segment.sequence_number != session.base or len(segment.payload) != packet.LENGTH.size:
+            return
+        length, = packet.LENGTH.unpack(bytes(segment.payload))
+        if length != session.length:
+            self.logger.info("Connection {:08x} announced {} bytes but {} were delivered".format(
+                session.connection, length, session.length))
+        self.answer_fin(session, segment)
+        if self.metrics is not None:
+            self.metrics.observe(metrics_.SESSION_LATENCY, now - session.opened)
+        self.closed[session.connection] = session
+        if len(self.closed) > CLOSED_SESSIONS:
+            self.closed.popitem(last=False)
+        self.end(session)
+
+    def answer_fin(self, session, segment):
+        session.transport.send(packet.encode(segment.sequence_number, ack_number=session.base,
+                                             flags=packet.FIN | packet.ACK, connection=session.connection))
+
+    def end(self, session):
+        """
+        Close a session's output and forget everything but what answering its FIN again takes
+        :param session: Session to end
+        :return:
+        """
+        if self.sessions.get(session.connection) is not session:
+            # already ended, e.g. by finish() while check_idle was going through the sessions
+            return
+        del self.sessions[session.connection]
+        session.output.close()
+        session.output = None
+        session.buffered = None
+        session.unacked = 0
+        # the transport isn't closed, its channel may still hold back the last answer
+        self.ended += 1
+        if self.max_sessions is not None and self.ended >= self.max_sessions and not self.done:
+            self.finish()
+
+    def schedule_ack(self, session):
+        if not session.queued:
+            session.queued = True
+            self.ready.append(session)
+
+    def send_acks(self):
+        """
+        Send the ACKs of the next ack_budget sessions in the queue, and leave the rest for the next turn
+        :return:
+        """
+        self.ack_turn = None
+        sent = 0
+        while self.ready and sent < self.ack_budget:
+            session = self.ready.popleft()
+            session.queued = False
+            # the session ended, or a delayed ACK already covered everything
+            if session.unacked:
+                session.transport.send(session.ack())
+                sent += 1
+        if self.metrics is not None:
+            self.metrics.count(metrics_.ACKS_SENT, sent)
+        if self.ready:
+            self.ack_turn = self.loop.call_later(0, self.send_acks)
+
+    def ack_timeout(self):
+        self.ack_timer = None
+        now = self.loop.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            due, session = self.delayed.popleft()
+            # unless it was ACKed, and maybe delayed again, since
+            if session.due == due:
+                self.schedule_ack(session)
+        if self.delayed:
+            self.ack_timer = self.loop.call_later(self.delayed[0][0] - now, self.ack_timeout)
+        if self.ready and self.ack_turn is None:
+            self.send_acks()
+
+    def check_idle(self):
+        # a sender that has been quiet for the whole timeout went away
+        self.idle_timer = None
+        now = self.loop.time()
+        for session in [session for session in self.sessions.values()
+                        if now >= session.last_activity + self.timeout]:
+            # ending one may have reached max_sessions, and finish() has ended the rest
+            if self.done:
+                break
+            self.logger.info("Connection {:08x} has been quiet for {} seconds, dropping it".format(
+                session.connection, self.timeout))
+            self.end(session)
+        if self.sessions and not self.done:
+            # the next session to go quiet can't do so before this
+            self.idle_timer = self.loop.call_later(
+                min(session.last_activity for session in self.sessions.values()) + self.timeout - now,
+                self.check_idle)
+
+
+def files(directory, buffer_size=1 << 16):
+    """
+    Outputs for a Server: one file per connection, named after its ID
+    :param directory: directory to write the files to
+    :param buffer_size: bytes to buffer per file, each open session holds that much
+    :return: function for Server's outputs argument
+    """
+    return lambda connection: io.open(os.path.join(directory, "{:08x}".format(connection)), "wb",
+                                      buffering=buffer_size)
@@ -0,0 +1,235 @@
+"""
+Resumable transfers: a session layer on top of Selective Repeat.
+
+The sender opens the connection with a SYN whose payload (HELLO) names the transfer and gives its total length and
+chunk size. The receiver keeps a checkpoint next to the output file with the SHA-1 of every chunk it has written so
+far, and answers with the offset of the first chunk it is missing (RESUME). The sender goes on from there, and after
+the last byte sends the manifest: the SHA-1 of every chunk of the input. The receiver compares it with its own
+hashes. Chunks that don't match are dropped from the checkpoint, so the next attempt sends them again.
+
+Both sides hash each chunk as it goes by, so verifying never takes a second pass over the file. A resumed sender
+reads the part it skips once, to hash it.
+
+Segments are delivered in order, so the chunks written so far are always a prefix of the file and the checkpoint is
+simply the list of their hashes. The transfer ID defaults to a hash of the input file's identity, so a file that
+changed starts over instead of being resumed into a stale output.
+"""
+
+import binascii
+import hashlib
+import io
+import json
+import os
+import struct
+
+import utils
+
+# transfer ID, total length, chunk size
+HELLO = struct.Struct("!16sQI")
+# offset of the first chunk the receiver is missing
+RESUME = struct.Struct("!Q")
+CHUNK_SIZE = 1 << 20
+DIGEST_SIZE = hashlib.sha1().digest_size
+
+
+def chunks(length, chunk_size):
+    return -(-length // chunk_size)
+
+
+def transfer_id(stream):
+    """
+    :param stream: regular file
+    :return: 16 byte ID that stays the same for as long as the file doesn't change
+    """
+    status = os.fstat(stream.fileno())
+    return hashlib.sha1(repr((status.st_dev, status.st_ino, status.st_size, status.st_mtime))).digest()[:16]
+
+
+class Manifest(object):
+    """
+    SHA-1 of every chunk of a stream, computed as the stream goes by
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE, digests=()):
+        """
+        :param chunk_size: bytes per chunk
+        :param digests: digests of the chunks before the stream, when it starts on a chunk boundary
+        """
+        self.chunk_size = chunk_size
+        self.digests = list(digests)
+        self.hash = hashlib.sha1()
+        # bytes of the current chunk hashed so far
+        self.filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            take = min(len(view), self.chunk_size - self.filled)
+            self.hash.update(view[:take])
+            self.filled += take
+            view = view[take:]
+            if self.filled == self.chunk_size:
+                self.digests.append(self.hash.digest())
+                self.hash = hashlib.sha1()
+                self.filled = 0
+
+    def close(self):
+        """
+        End the stream, a partial last chunk counts as a chunk
+        :return: digest of every chunk
+        """
+        if self.filled:
+            self.digests.append(self.hash.digest())
+            self.hash = hashlib.sha1()
+            self.filled = 0
+        return self.digests
+
+
+# region Sender
+
+def segments(stream, offset, chunk_size, segment_size):
+    """
+    :param stream: regular file to send
+    :param offset: byte to resume at, the receiver has everything before it
+    :param chunk_size: bytes per chunk
+    :param segment_size: maximum segment size
+    :return: generator of the segments from offset on, followed by the manifest
+    """
+    manifest = Manifest(chunk_size)
+    for data in utils.read_segments(stream, chunk_size, length=offset):
+        manifest.update(data)
+    for segment in utils.read_segments(stream, segment_size, offset=offset):
+        manifest.update(segment)
+        yield segment
+    for segment in utils.iter_segments(b"".join(manifest.close()), segment_size):
+        yield segment
+
+
+def send(sndr, stream, chunk_size=CHUNK_SIZE, transfer=None):
+    """
+    Send a regular file as a resumable transfer, blocks until all of it is acknowledged
+    :param sndr: SelectiveRepeatSender
+    :param stream: regular file
+    :param chunk_size: bytes per chunk
+    :param transfer: 16 byte transfer ID, defaults to transfer_id(stream)
+    :return:
+    """
+    length = os.fstat(stream.fileno()).st_size
+    transfer = transfer if transfer is not None else transfer_id(stream)
+
+    def established(reply):
+        offset, = RESUME.unpack(reply)
+        if offset > length or offset % chunk_size:
+            raise ValueError("Receiver resumes at byte {} of {}".format(offset, length))
+        sndr.logger.info("Resuming at byte {} of {}".format(offset, length))
+        sndr.start(segments(stream, offset, chunk_size, sndr.MSS))
+
+    sndr.connect(HELLO.pack(transfer, length, chunk_size), established)
+    sndr.loop.run()
+# endregion Sender
+
+
+class SessionReceiver(object):
+    """
+    Output of a SelectiveRepeatReceiver that writes a resumable transfer to a file, pass hello as its on_syn.
+    verified is True once the manifest matched, False if it didn't and None until it arrives.
+    """
+
+    def __init__(self, path, buffer_size=1 << 20):
+        """
+        :param path: file to write to, the checkpoint goes next to it
+        :param buffer_size: bytes to buffer before writing
+        """
+        self.path = path
+        self.checkpoint_path = path + ".checkpoint"
+        self.buffer_size = buffer_size
+        self.file = None
+        self.manifest = None
+        self.verified = None
+
+    def load(self):
+        """
+        :return: (transfer ID, length, chunk size, digests) of the checkpoint, None if there isn't any
+        """
+        try:
+            with open(self.checkpoint_path) as checkpoint:
+                state = json.load(checkpoint)
+        except (IOError, ValueError):
+            return None
+        return (binascii.unhexlify(state["transfer"]), state["length"], state["chunk_size"],
+                [binascii.unhexlify(digest) for digest in state["digests"]])
+
+    def save(self):
+        state = {"transfer": binascii.hexlify(self.transfer), "length": self.length, "chunk_size": self.chunk_size,
+                 "digests": [binascii.hexlify(digest) for digest in self.manifest.digests]}
+        # the chunks have to be in the file before the checkpoint says so
+        self.file.flush()
+        # write and rename, so a crash never leaves half a checkpoint
+        with open(self.checkpoint_path + ".tmp", "w") as checkpoint:
+            json.dump(state, checkpoint)
+        os.rename(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    def hello(self, payload):
+        """
+        Start or resume the transfer a SYN announces
+        :param payload: HELLO
+        :return: RESUME, or None if the payload isn't a HELLO
+        """
+        if len(payload) != HELLO.size:
+            return None
+        self.transfer, self.length, self.chunk_size = HELLO.unpack(bytes(payload))
+        if not self.chunk_size:
+            return None
+        checkpoint = self.load()
+        digests = []
+        if checkpoint is not None and checkpoint[:3] == (self.transfer, self.length, self.chunk_size):
+            digests = checkpoint[3]
+        self.manifest = Manifest(self.chunk_size, digests)
+        self.position = min(len(digests) * self.chunk_size, self.length)
+        # what comes after the last byte is the sender's manifest
+        self.trailer = bytearray()
+        self.verified = None
+        if self.file is None:
+            self.file = io.open(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), "r+b", buffering=self.buffer_size)
+        self.file.truncate(self.length)
+        self.file.seek(self.position)
+        self.save()
+        if not self.length:
+            self.verify()
+        return RESUME.pack(self.position)
+
+    def write(self, data):
+        view = memoryview(data)
+        if self.position < self.length:
+            take = min(len(view), self.length - self.position)
+            self.file.write(view[:take])
+            complete = len(self.manifest.digests)
+            self.manifest.update(view[:take])
+            self.position += take
+            if self.position == self.length:
+                self.manifest.close()
+            if len(self.manifest.digests) > complete:
+                self.save()
+            view = view[take:]
+        if len(view) and self.verified is None:
+            self.trailer += view
+            if len(self.trailer) >= chunks(self.length, self.chunk_size) * DIGEST_SIZE:
+                self.verify()
+
+    def verify(self):
+        expected = [bytes(self.trailer[n:n + DIGEST_SIZE]) for n in xrange(0, len(self.trailer), DIGEST_SIZE)]
+        digests = self.manifest.digests
+        bad = [n for n in xrange(len(digests)) if n >= len(expected) or digests[n] != expected[n]]
+        if bad:
+            # everything from the first bad chunk on is sent again
+            del digests[bad[0]:]
+            self.save()
+            self.verified = False
+        else:
+            self.file.flush()
+            os.remove(self.checkpoint_path)
+            self.verified = True
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
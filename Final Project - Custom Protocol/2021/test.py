@@ -1,8 +1,33 @@
+import argparse
+import csv
+import hashlib
+import itertools
+import json
 import logging
+import os
+import socket
+import tempfile
+import threading
+import time
 import unittest
 from copy import deepcopy
+from io import BytesIO
 
-from channelsimulator import ChannelSimulator, slice_frames
+import channelmodels
+import compression
+import engine
+import loopback
+import fec
+import metrics
+import packet
+import parallel
+import server
+import session
+import utils
+from channelsimulator import ChannelSimulator, iter_frames, slice_frames
+from policy import AdaptiveTimeout, AIMDWindow, FixedWindow
+from receiver import OurReceiver, SelectiveRepeatReceiver
+from sender import MAX_SEGMENT_SIZE, OurSender, SelectiveRepeatSender, segment_size
 
 
 class TestChannelSimulator(unittest.TestCase):
@@ -22,6 +47,23 @@ class TestChannelSimulator(unittest.TestCase):
             assert len(f) == ChannelSimulator.BUFFER_SIZE
         assert len(frames[-1]) == 1
 
+    def test_iter_frames_views(self):
+        test_data = self.get_test_bytes(2 * ChannelSimulator.BUFFER_SIZE + 1)
+        frames = iter_frames(test_data)
+        first = next(frames)
+        # frames share memory with the input
+        test_data[0] = 66
+        assert first[0:1].tobytes() == b"B"
+        assert [len(f) for f in frames] == [ChannelSimulator.BUFFER_SIZE, 1]
+
+    def test_corrupt_swap_copies(self):
+        c = self.setup_channel()
+        test_data = self.get_test_bytes(ChannelSimulator.BUFFER_SIZE)
+        c.corrupt(memoryview(test_data), drop_error_prob=0, swap_error_prob=1, random_error_prob=0)
+        # reusing the buffer must not change the frame held back in the channel
+        test_data[:] = self.get_test_bytes(ChannelSimulator.BUFFER_SIZE).replace(b"A", b"B")
+        assert self.get_test_bytes(ChannelSimulator.BUFFER_SIZE) in c.swap_queue
+
     def test_corrupt_none(self):
         c = self.setup_channel()
         test_data = self.get_test_bytes(ChannelSimulator.BUFFER_SIZE)
@@ -48,6 +90,877 @@ class TestChannelSimulator(unittest.TestCase):
         corrupted_bytes = c.corrupt(test_data, drop_error_prob=0, swap_error_prob=0, random_error_prob=1)
         assert test_data != corrupted_bytes
 
+    def test_corrupt_random_is_bytewise(self):
+        c = self.setup_channel()
+        test_data = self.get_test_bytes(ChannelSimulator.BUFFER_SIZE)
+        corrupted_bytes = c.corrupt(test_data, drop_error_prob=0, swap_error_prob=0, random_error_prob=1)
+        assert len(corrupted_bytes) == len(test_data)
+        for before, after in zip(test_data, corrupted_bytes):
+            assert before ^ after in ChannelSimulator.CORRUPTERS
+
+    def test_random_errors_uniform(self):
+        c = self.setup_channel()
+        errors = c.random_errors(100000)
+        for corrupter in ChannelSimulator.CORRUPTERS:
+            assert 9000 < errors.count(bytearray([corrupter])) < 11000
+
+    def test_seed_reproducible(self):
+        a = ChannelSimulator(inbound_port=44444, outbound_port=55555, seed=303)
+        b = ChannelSimulator(inbound_port=44444, outbound_port=55555, seed=303)
+        assert a.swap_queue == b.swap_queue
+        for n in range(200):
+            test_data = bytearray([n % 256]) * ChannelSimulator.BUFFER_SIZE
+            assert a.corrupt(test_data, 0.1, 0.1, 0.1) == b.corrupt(test_data, 0.1, 0.1, 0.1)
+
+
+class TestBatchedChannel(unittest.TestCase):
+    @staticmethod
+    def setup_loop(port, **channel):
+        # a channel that sends to itself
+        c = ChannelSimulator(inbound_port=port, outbound_port=port, **channel)
+        c.sndr_setup(0.1)
+        c.rcvr_setup(0.1)
+        return c
+
+    def test_receive_many_drains(self):
+        c = self.setup_loop(44450)
+        frames = [bytearray([n]) * 100 for n in range(10)]
+        for frame in frames:
+            c.put_to_socket(frame)
+        assert c.u_receive_many(4) == frames[:4]
+        assert c.u_receive_many(64) == frames[4:]
+        # the socket's own timeout is restored afterwards
+        assert c.rcvr_socket.gettimeout() == 0.1
+
+    def test_receive_many_timeout(self):
+        c = self.setup_loop(44451)
+        self.assertRaises(socket.timeout, c.u_receive_many, 64, 0.01)
+        assert c.rcvr_socket.gettimeout() == 0.1
+
+    def test_send_many(self):
+        c = self.setup_loop(44452)
+        frames = [bytearray([n]) * 100 for n in range(10)]
+        c.u_send_many(frames)
+        received = c.u_receive_many(64)
+        # the channel may drop, corrupt or swap a few
+        assert 0 < len(received) <= len(frames)
+
+    def test_error_probabilities(self):
+        frames = [bytearray([n]) * 100 for n in range(10)]
+        c = self.setup_loop(44453, drop_error_prob=0, random_error_prob=0, swap_error_prob=0)
+        c.u_send_many(frames)
+        assert c.u_receive_many(64) == frames
+        c = self.setup_loop(44454, drop_error_prob=1)
+        c.u_send_many(frames)
+        self.assertRaises(socket.timeout, c.u_receive_many, 64, 0.01)
+
+
+class TestChannelModels(unittest.TestCase):
+    @staticmethod
+    def run_model(model, n, now=0.0):
+        return [model.process(bytearray([i % 256]), now) for i in range(n)]
+
+    def test_gilbert_elliott_bursts(self):
+        model = channelmodels.GilbertElliott(0.01, 0.25, seed=1)
+        lost = [not out for out in self.run_model(model, 100000)]
+        bursts = [len(run) for run in "".join("x" if l else "." for l in lost).split(".") if run]
+        # stationary loss p / (p + r) and mean burst length 1 / r
+        assert abs(sum(lost) / 100000.0 - 0.01 / 0.26) < 0.01
+        assert abs(sum(bursts) / float(len(bursts)) - 4) < 0.5
+        again = channelmodels.GilbertElliott(0.01, 0.25, seed=1)
+        assert [not out for out in self.run_model(again, 100000)] == lost
+
+    def test_delay_keeps_order_without_reordering(self):
+        model = channelmodels.Delay(0.01, jitter=0.005, seed=1)
+        arrivals = [now + out[0][1] for now, out in ((n * 0.001, model.process(b"x", n * 0.001)) for n in range(100))]
+        assert arrivals == sorted(arrivals)
+        assert all(0.005 <= a - n * 0.001 for n, a in enumerate(arrivals))
+
+    def test_jitter_reorders_only_when_asked(self):
+        parser = argparse.ArgumentParser()
+        channelmodels.add_arguments(parser)
+        delay, = channelmodels.from_arguments(parser.parse_args(["--delay", "0.01", "--jitter", "0.005"]))["models"]
+        assert not delay.reorder
+        delay, = channelmodels.from_arguments(parser.parse_args(["--jitter", "0.005", "--jitter-reorder"]))["models"]
+        assert delay.reorder
+
+    def test_reorder_depth(self):
+        model = channelmodels.Reorder(0.2, 5, seed=1)
+        released = [frame[0] for out in self.run_model(model, 200) for frame, delay in out]
+        # the last few may still be held
+        assert 200 - 5 <= len(released) <= 200
+        assert released != sorted(released)
+        # at most depth later frames get past a held one
+        for n, value in enumerate(released):
+            assert sum(1 for later in released[:n] if later > value) <= 5
+
+    def test_shaper(self):
+        model = channelmodels.Shaper(1000, queue=0.5)
+        delays = [out[0][1] if out else None for out in (model.process(b"x" * 100, 0.0) for _ in range(8))]
+        # 0.1 s per frame, frames that would wait more than 0.5 s are dropped
+        assert all(abs(d - 0.1 * n) < 1e-9 for n, d in enumerate(delays[:6], 1))
+        assert delays[6:] == [None, None]
+
+    def test_trace(self):
+        model = channelmodels.TraceLoss("10 0\nx")
+        assert [bool(out) for out in self.run_model(model, 8)] == [False, True, True, False] * 2
+
+    def test_simulator_delays_frames(self):
+        c = ChannelSimulator(inbound_port=44455, outbound_port=44455, drop_error_prob=0, random_error_prob=0,
+                             swap_error_prob=0, models=[channelmodels.Delay(0.05)])
+        c.sndr_setup(1)
+        c.rcvr_setup(1)
+        c.u_send(bytearray(b"late"))
+        assert c.u_receive_many(64, 0.0) == []
+        start = time.time()
+        # u_receive sends the frame to itself once it is due
+        assert c.u_receive() == b"late"
+        assert 0.03 < time.time() - start < 0.5
+        assert c.delayed == []
+
+
+class TestLoopback(unittest.TestCase):
+    def test_send_and_receive(self):
+        network = loopback.Network()
+        a = network.channel(inbound_port=1, outbound_port=2, drop_error_prob=0, random_error_prob=0, swap_error_prob=0)
+        b = network.channel(inbound_port=2, outbound_port=1, drop_error_prob=0, random_error_prob=0, swap_error_prob=0)
+        for c in (a, b):
+            c.sndr_setup(0.05)
+            c.rcvr_setup(0.05)
+        frame = bytearray(b"ping")
+        a.u_send(memoryview(frame))
+        # the channel keeps its own copy
+        frame[:] = b"pong"
+        assert b.u_receive() == b"ping"
+        assert b.u_receive_many(64, 0.0) == []
+        self.assertRaises(socket.timeout, b.u_receive)
+        b.u_send_many([b"a", b"b"])
+        assert a.u_receive_many(64) == [b"a", b"b"]
+
+    def test_blocking_receive_wakes_up(self):
+        network = loopback.Network()
+        c = network.channel(inbound_port=1, outbound_port=1, drop_error_prob=0, random_error_prob=0, swap_error_prob=0)
+        c.sndr_setup(5)
+        c.rcvr_setup(5)
+        threading.Timer(0.05, c.u_send, args=(b"late",)).start()
+        assert c.u_receive() == b"late"
+
+    @staticmethod
+    def simulate(data, seed, delay):
+        loop = engine.VirtualLoop()
+        network = loopback.Network(loop)
+        output = BytesIO()
+        sender_metrics = metrics.Metrics("sender")
+        rcvr = SelectiveRepeatReceiver(timeout=1, output=output, loop=loop, network=network, seed=seed + 1,
+                                       models=[channelmodels.Delay(delay)])
+        sndr = SelectiveRepeatSender(loop=loop, network=network, seed=seed, metrics=sender_metrics,
+                                     models=[channelmodels.Delay(delay)])
+        finished = []
+        rcvr.start()
+        sndr.start(utils.iter_segments(data, sndr.MSS), on_done=lambda: finished.append(loop.time()))
+        loop.run()
+        assert output.getvalue() == data
+        return finished[0], sender_metrics.snapshot()
+
+    def test_virtual_time_transfer_is_deterministic(self):
+        data = bytearray(os.urandom(500 * 1000))
+        start = time.time()
+        seconds, snapshot = self.simulate(data, 1, 0.05)
+        # ~500 segments with a window of at most 64 and a 100 ms round trip, much faster than real time
+        assert seconds > 0.5
+        assert time.time() - start < seconds
+        assert self.simulate(data, 1, 0.05) == (seconds, snapshot)
+        assert self.simulate(data, 2, 0.05) != (seconds, snapshot)
+
+
+class TestReadSegments(unittest.TestCase):
+    def check(self, stream, data, segment_size):
+        segments = [bytes(bytearray(s)) for s in utils.read_segments(stream, segment_size, chunk_segments=3)]
+        assert b"".join(segments) == data
+        assert all(len(s) == segment_size for s in segments[:-1])
+
+    def test_regular_file(self):
+        data = os.urandom(10 * 1000 + 7)
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            self.check(f, data, 1000)
+
+    def test_empty_file(self):
+        with tempfile.TemporaryFile() as f:
+            assert list(utils.read_segments(f, 1000)) == []
+
+    def test_range(self):
+        data = os.urandom(10 * 1000 + 7)
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            segments = utils.read_segments(f, 1000, offset=2500, length=3000)
+            assert [len(s) for s in segments] == [1000, 1000, 1000]
+            segments = utils.read_segments(f, 1000, offset=9000, length=3000)
+            assert b"".join(bytes(bytearray(s)) for s in segments) == data[9000:]
+
+    def test_pipe(self):
+        data = os.urandom(10 * 1000 + 7)
+        read_fd, write_fd = os.pipe()
+
+        def write():
+            with os.fdopen(write_fd, "wb") as w:
+                w.write(data)
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        with os.fdopen(read_fd, "rb") as r:
+            self.check(r, data, 1000)
+        thread.join()
+
+    def test_resegment(self):
+        data = os.urandom(10 * 1000 + 7)
+        pieces = [data[:5], data[5:705], data[705:706], data[706:3000], data[3000:]]
+        segments = [bytes(bytearray(s)) for s in utils.resegment(pieces, 1000)]
+        assert b"".join(segments) == data
+        assert [len(s) for s in segments] == [1000] * 10 + [7]
+
+
+class TestCompression(unittest.TestCase):
+    @staticmethod
+    def round_trip(data, method="zlib"):
+        compressor = compression.Compressor(method)
+        blocks = utils.iter_segments(data, compression.BLOCK_SIZE)
+        stream = b"".join(bytes(bytearray(piece)) for piece in compressor.compress(blocks))
+        output = BytesIO()
+        decompressor = compression.Decompressor(output)
+        # in pieces that split the records anywhere, like segment payloads do
+        for segment in utils.iter_segments(stream, 1000):
+            decompressor.write(segment)
+        assert output.getvalue() == data
+        assert decompressor.pending == b""
+        return compressor, stream
+
+    def test_compressible(self):
+        data = b"".join(b"line {}\n".format(n) for n in range(20000))
+        for method in sorted(compression.METHODS):
+            compressor, stream = self.round_trip(data, method)
+            assert compressor.raw_blocks == 0
+            assert len(stream) < len(data) / 4
+
+    def test_incompressible_is_sent_raw(self):
+        data = os.urandom(5 * compression.BLOCK_SIZE)
+        compressor, stream = self.round_trip(data)
+        assert compressor.compressed_blocks == 0
+        assert len(stream) == len(data) + 5 * compression.RECORD.size
+
+    def test_mixed(self):
+        text = b"a" * compression.BLOCK_SIZE
+        data = text + os.urandom(2 * compression.BLOCK_SIZE) + text + b"tail"
+        compressor, _ = self.round_trip(data)
+        # a few bytes don't compress either
+        assert (compressor.compressed_blocks, compressor.raw_blocks) == (2, 3)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_percentiles(self):
+        m = metrics.Metrics("flow")
+        for n in range(1, 101):
+            m.observe(metrics.RTT, n / 1000.0)
+        summary = m.snapshot()["histograms"]["rtt"]
+        assert summary["count"] == 100
+        assert summary["max"] == 0.1
+        assert abs(summary["mean"] - 0.0505) < 1e-9
+        # within one bucket of the exact value
+        for point in (50, 90, 99):
+            assert point / 1000.0 <= summary["p{}".format(point)] <= point / 1000.0 * 2 ** (1.0 / metrics.SUB_BUCKETS)
+        assert m.snapshot()["histograms"]["ack_latency"]["p50"] is None
+
+    def test_export(self):
+        m = metrics.Metrics("flow")
+        m.count(metrics.RESENDS, 3)
+        directory = tempfile.mkdtemp()
+        for name in ("metrics.json", "metrics.csv"):
+            exporter = metrics.Exporter(os.path.join(directory, name), [m])
+            exporter.start()
+            exporter.dump()
+            exporter.stop()
+        with open(os.path.join(directory, "metrics.json")) as f:
+            assert json.load(f)["flows"][0]["counters"]["resends"] == 3
+        with open(os.path.join(directory, "metrics.csv")) as f:
+            rows = list(csv.DictReader(f))
+        # one dump, plus the one at stop
+        assert len(rows) == 2 and rows[1]["flow"] == "flow" and rows[1]["resends"] == "3"
+
+
+class TestParallel(unittest.TestCase):
+    def test_split(self):
+        assert parallel.split(10, 3, 2) == [(0, 4), (4, 4), (8, 2)]
+        assert parallel.split(3, 4, 2) == [(0, 2), (2, 1), (3, 0), (3, 0)]
+        assert parallel.split(0, 2, 2) == [(0, 0), (0, 0)]
+
+    def test_segment_size(self):
+        assert segment_size() == MAX_SEGMENT_SIZE
+        assert segment_size(fec=4) == MAX_SEGMENT_SIZE - fec.OVERHEAD
+        assert segment_size(100, fec=4) == 100
+
+    def test_transfer(self):
+        data = os.urandom(300 * 1000 + 5)
+        with tempfile.NamedTemporaryFile() as source, tempfile.NamedTemporaryFile() as output:
+            source.write(data)
+            source.flush()
+            source.seek(0)
+            thread = threading.Thread(target=parallel.receive_parallel, args=(output.name, 3),
+                                      kwargs={"timeout": 0.5, "base_port": 46005})
+            thread.start()
+            parallel.send_parallel(source, 3, base_port=46006)
+            thread.join()
+            with open(output.name, "rb") as f:
+                assert f.read() == data
+
+    def test_transfer_with_settings(self):
+        parser = argparse.ArgumentParser()
+        channelmodels.add_arguments(parser)
+        args = parser.parse_args(["--seed", "3", "--drop-prob", "0.02", "--delay", "0.001"])
+        # every flow draws its own errors
+        assert channelmodels.from_arguments(args, 1)["seed"] != channelmodels.from_arguments(args, 0)["seed"] == 3
+        data = os.urandom(100 * 1000)
+        with tempfile.NamedTemporaryFile() as source, tempfile.NamedTemporaryFile() as output:
+            source.write(data)
+            source.flush()
+            source.seek(0)
+            thread = threading.Thread(target=parallel.receive_parallel, args=(output.name, 2),
+                                      kwargs={"timeout": 0.5, "base_port": 46015, "channel_args": args, "fec": 4,
+                                              "ack_every": 1})
+            thread.start()
+            parallel.send_parallel(source, 2, base_port=46016, channel_args=args, fec=4,
+                                   window_policy=FixedWindow(16))
+            thread.join()
+            with open(output.name, "rb") as f:
+                assert f.read() == data
+
+
+class TestSession(unittest.TestCase):
+    CHUNK_SIZE = 50 * 1000
+
+    def test_manifest_is_incremental(self):
+        data = os.urandom(10 * 1000 + 1)
+        manifest = session.Manifest(1000)
+        start = 0
+        for size in itertools.cycle((1, 999, 2500, 7)):
+            manifest.update(memoryview(data)[start:start + size])
+            start += size
+            if start >= len(data):
+                break
+        assert manifest.close() == [hashlib.sha1(data[n:n + 1000]).digest() for n in range(0, len(data), 1000)]
+
+    @staticmethod
+    def setup(source, output, loop=None, seed=0):
+        loop = loop if loop is not None else engine.VirtualLoop()
+        network = loopback.Network(loop)
+        writer = session.SessionReceiver(output)
+        rcvr = SelectiveRepeatReceiver(timeout=1, output=writer, on_syn=writer.hello, loop=loop, network=network,
+                                       seed=seed + 1)
+        rcvr.start()
+        return writer, rcvr, SelectiveRepeatSender(loop=loop, network=network, seed=seed,
+                                                   metrics=metrics.Metrics("sender"))
+
+    def interrupt(self, sndr, writer, source, chunks, transfer=None):
+        """
+        Start a transfer and stop the sender without closing once the receiver has the first chunks, like a sender
+        that got killed
+        """
+        transfer = transfer if transfer is not None else session.transfer_id(source)
+        sndr.connect(session.HELLO.pack(transfer, os.fstat(source.fileno()).st_size, self.CHUNK_SIZE),
+                     lambda reply: sndr.start(session.segments(source, 0, self.CHUNK_SIZE, sndr.MSS)))
+        while writer.manifest is None or len(writer.manifest.digests) < chunks:
+            sndr.loop.run_once()
+        sndr.finish()
+        return len(writer.manifest.digests)
+
+    def test_resume(self):
+        data = os.urandom(300 * 1000 + 5)
+        with tempfile.NamedTemporaryFile() as source, tempfile.NamedTemporaryFile() as output:
+            source.write(data)
+            source.flush()
+            writer, rcvr, sndr = self.setup(source, output.name)
+            chunks = self.interrupt(sndr, writer, source, 3)
+            assert len(writer.load()[3]) == chunks
+            assert writer.verified is None
+            # a new sender connects to the same receiver and only sends the rest, followed by the manifest
+            sndr = SelectiveRepeatSender(loop=rcvr.loop, network=rcvr.simulator.network, seed=2,
+                                         metrics=metrics.Metrics("sender"))
+            session.send(sndr, source, self.CHUNK_SIZE)
+            assert sndr.metrics.snapshot()["counters"]["bytes_sent"] == (len(data) - chunks * self.CHUNK_SIZE +
+                                                                         7 * session.DIGEST_SIZE)
+            assert writer.verified
+            assert not os.path.exists(writer.checkpoint_path)
+            with open(output.name, "rb") as f:
+                assert f.read() == data
+
+    def test_mismatch_is_sent_again(self):
+        data = bytearray(os.urandom(300 * 1000 + 5))
+        # an ID that doesn't notice the file changing
+        transfer = b"\x01" * 16
+        with tempfile.NamedTemporaryFile() as source, tempfile.NamedTemporaryFile() as output:
+            source.write(data)
+            source.flush()
+            writer, rcvr, sndr = self.setup(source, output.name)
+            self.interrupt(sndr, writer, source, 3, transfer)
+            # the receiver gives up on the sender
+            rcvr.loop.run()
+            data[self.CHUNK_SIZE + 10] ^= 1
+            source.seek(0)
+            source.write(data)
+            source.flush()
+            # restarted on both ends, resumes after the chunks it has and finds the second one stale at the end
+            writer, rcvr, sndr = self.setup(source, output.name, seed=2)
+            session.send(sndr, source, self.CHUNK_SIZE, transfer)
+            assert writer.verified is False
+            assert len(writer.load()[3]) == 1
+            writer, rcvr, sndr = self.setup(source, output.name, seed=4)
+            session.send(sndr, source, self.CHUNK_SIZE, transfer)
+            assert writer.verified
+            with open(output.name, "rb") as f:
+                assert f.read() == data
+
+
+class TestEventLoop(unittest.TestCase):
+    def test_timers_run_in_order(self):
+        loop = engine.EventLoop()
+        fired = []
+        loop.call_later(0.02, fired.append, 2)
+        loop.call_later(0.01, fired.append, 1)
+        loop.call_later(0.01, fired.append, 3).cancel()
+        loop.run()
+        assert fired == [1, 2]
+        assert loop.pending == 0
+
+    def test_run_returns_when_only_cancelled_timers_are_left(self):
+        loop = engine.EventLoop()
+        loop.call_later(60, lambda: None).cancel()
+        loop.run()
+
+
+class TestPacket(unittest.TestCase):
+    def test_round_trip(self):
+        payload = bytearray(os.urandom(ChannelSimulator.BUFFER_SIZE - packet.HEADER_SIZE))
+        frame = packet.encode(7, ack_number=3, flags=packet.ACK, payload=payload)
+        assert len(frame) == ChannelSimulator.BUFFER_SIZE
+        assert packet.decode(frame) == packet.Packet(packet.ACK, 7, 3, payload)
+
+    def test_round_trip_empty(self):
+        frame = packet.encode(packet.MAX_SEQUENCE_NUMBER - 1)
+        assert len(frame) == packet.HEADER_SIZE
+        assert packet.decode(frame) == packet.Packet(0, packet.MAX_SEQUENCE_NUMBER - 1, 0, bytearray())
+
+    def test_encode_into_reused_buffer(self):
+        frame = bytearray(ChannelSimulator.BUFFER_SIZE)
+        payload = memoryview(bytearray(os.urandom(100)))
+        view = packet.encode_into(frame, 1, payload=payload)
+        assert len(view) == packet.HEADER_SIZE + 100
+        assert view.tobytes() == bytes(packet.encode(1, payload=payload))
+        view = packet.encode_into(frame, 2, payload=payload[:10])
+        assert packet.decode(bytearray(view)) == packet.Packet(0, 2, 0, payload[:10].tobytes())
+
+    def test_single_byte_errors(self):
+        frame = packet.encode(1, payload=b"hello world")
+        for n in range(len(frame)):
+            for corrupter in ChannelSimulator.CORRUPTERS[1:]:
+                corrupted = bytearray(frame)
+                corrupted[n] ^= corrupter
+                assert packet.decode(corrupted) is None
+
+    def test_truncated(self):
+        frame = packet.encode(1, payload=b"hello world")
+        assert packet.decode(frame[:-1]) is None
+        assert packet.decode(frame[:packet.HEADER_SIZE - 1]) is None
+
+    def test_sack_round_trip(self):
+        assert packet.sack(10, []) == b""
+        bitmap = packet.sack(10, [11, 13, 19, 20])
+        # offsets 0, 2, 8 and 9
+        assert bitmap == bytearray([0x05, 0x03])
+        assert packet.sacked(10, bitmap) == [11, 13, 19, 20]
+        assert packet.sacked(10, b"") == []
+
+    def test_channel_errors(self):
+        c = TestChannelSimulator.setup_channel()
+        frame = packet.encode(1, payload=bytearray(os.urandom(1000)))
+        for _ in range(20):
+            corrupted = c.corrupt(frame, drop_error_prob=0, swap_error_prob=0, random_error_prob=1)
+            assert packet.decode(corrupted) is None
+        # the frames the swap queue starts with are random garbage
+        for garbage in c.swap_queue:
+            assert packet.decode(garbage) is None
+
+
+class TestSelectiveRepeat(unittest.TestCase):
+    @staticmethod
+    def transfer(data, inbound_port, outbound_port, window_size, fec=0):
+        output = BytesIO()
+        rcvr = SelectiveRepeatReceiver(window_size=window_size, timeout=0.5, output=output, fec=fec,
+                                       inbound_port=inbound_port, outbound_port=outbound_port)
+        thread = threading.Thread(target=rcvr.receive)
+        thread.start()
+        sndr = SelectiveRepeatSender(window_size=window_size, fec=fec, metrics=metrics.Metrics("sender"),
+                                     inbound_port=outbound_port, outbound_port=inbound_port)
+        if isinstance(data, bytearray):
+            sndr.send(data)
+        else:
+            sndr.send_segments(data)
+        thread.join()
+        counters = sndr.metrics.snapshot()["counters"]
+        assert counters["bytes_sent"] == len(output.getvalue())
+        parities = -(-counters["segments_sent"] // fec) if fec else 0
+        # and the SYN and the FIN
+        assert counters["channel_frames"] == counters["segments_sent"] + counters["resends"] + parities + 2
+        return output.getvalue()
+
+    def test_transfer(self):
+        data = bytearray(os.urandom(200 * 1000))
+        assert self.transfer(data, 44445, 55556, 32) == data
+
+    def test_transfer_stream(self):
+        data = bytearray(os.urandom(100 * 1000))
+        # a generator, the sender never sees the whole input at once
+        segments = (data[n:n + 500] for n in range(0, len(data), 500))
+        assert self.transfer(segments, 44447, 55558, 16) == data
+
+    def test_concurrent_transfers_share_a_loop(self):
+        loop = engine.EventLoop()
+        transfers = []
+        for n in range(3):
+            data = bytearray(os.urandom(50 * 1000))
+            output = BytesIO()
+            rcvr = SelectiveRepeatReceiver(timeout=0.5, output=output, loop=loop,
+                                           inbound_port=44460 + n, outbound_port=55560 + n)
+            sndr = SelectiveRepeatSender(loop=loop, inbound_port=55560 + n, outbound_port=44460 + n)
+            rcvr.start()
+            sndr.start(utils.iter_segments(data, sndr.MSS))
+            transfers.append((data, output, sndr))
+        loop.run()
+        for data, output, sndr in transfers:
+            assert sndr.done
+            assert output.getvalue() == data
+
+    def test_iter_receive(self):
+        data = bytearray(os.urandom(50 * 1000))
+        rcvr = SelectiveRepeatReceiver(timeout=0.5, output=BytesIO(), inbound_port=44465, outbound_port=55565)
+        sndr = SelectiveRepeatSender(inbound_port=55565, outbound_port=44465)
+        thread = threading.Thread(target=sndr.send, args=(data,))
+        thread.start()
+        chunks = list(rcvr.iter_receive())
+        thread.join()
+        assert b"".join(bytes(c) for c in chunks) == data
+
+    def test_transfer_window_of_one(self):
+        data = bytearray(os.urandom(20 * 1000))
+        assert self.transfer(data, 44446, 55557, 1) == data
+
+    def test_transfer_fec(self):
+        data = bytearray(os.urandom(200 * 1000 + 7))
+        assert self.transfer(data, 44448, 55559, 32, fec=8) == data
+
+
+class TestAcks(unittest.TestCase):
+    @staticmethod
+    def setup_network():
+        loop = engine.VirtualLoop()
+        network = loopback.Network(loop)
+        channel = dict(loop=loop, network=network, drop_error_prob=0, random_error_prob=0, swap_error_prob=0)
+        return loop, network, channel
+
+    @staticmethod
+    def drain(sock):
+        return [packet.decode(sock.recv(ChannelSimulator.BUFFER_SIZE)) for _ in range(len(sock.queue))]
+
+    def test_receiver_delays_and_coalesces(self):
+        loop, network, channel = self.setup_network()
+        acks = network.bind(2)
+        rcvr = SelectiveRepeatReceiver(timeout=1, output=BytesIO(), ack_every=2, ack_delay=0.01, inbound_port=1,
+                                       outbound_port=2, **channel)
+        rcvr.start()
+        segments = [packet.encode(n, payload=b"x") for n in range(6)]
+        # two in-order segments -> a single ACK, echoing the first one
+        rcvr.frames_received(segments[0:2])
+        assert self.drain(acks) == [packet.Packet(packet.ACK, 0, 2, b"")]
+        # one -> held back until the delay runs out
+        rcvr.frames_received(segments[2:3])
+        assert self.drain(acks) == []
+        loop.run_once()
+        assert loop.time() == 0.01
+        assert self.drain(acks) == [packet.Packet(packet.ACK, 2, 3, b"")]
+        # a gap is reported at once, with the segment past it in the SACK bitmap
+        rcvr.frames_received(segments[4:5])
+        assert self.drain(acks) == [packet.Packet(packet.ACK, 4, 3, packet.sack(3, [4]))]
+        # and so is the segment that fills it
+        rcvr.frames_received(segments[3:4])
+        assert self.drain(acks) == [packet.Packet(packet.ACK, 3, 5, b"")]
+        # and a duplicate
+        rcvr.frames_received(segments[0:1])
+        assert self.drain(acks) == [packet.Packet(packet.ACK, 0, 5, b"")]
+        rcvr.finish()
+
+    def test_sender_fast_retransmits_on_sack(self):
+        loop, network, channel = self.setup_network()
+        data = network.bind(1)
+        sndr = SelectiveRepeatSender(window_size=8, window_policy=FixedWindow(8), metrics=metrics.Metrics("sender"),
+                                     inbound_port=2, outbound_port=1, **channel)
+        sndr.start([b"x"] * 10)
+        assert [segment.sequence_number for segment in self.drain(data)] == list(range(8))
+        # one coalesced ACK: segment 0 is missing and the three after it arrived, as good as three duplicate ACKs
+        sndr.frames_received([packet.encode(3, ack_number=0, flags=packet.ACK, payload=packet.sack(0, [1, 2, 3]))])
+        assert sorted(sndr.outstanding) == [0, 4, 5, 6, 7]
+        assert [segment.sequence_number for segment in self.drain(data)] == [0]
+        assert sndr.metrics.snapshot()["counters"]["fast_retransmits"] == 1
+        sndr.frames_received([packet.encode(0, ack_number=8, flags=packet.ACK)])
+        assert sorted(sndr.outstanding) == [8, 9]
+        sndr.finish()
+
+    def test_stale_sack_retires_the_window(self):
+        loop, network, channel = self.setup_network()
+        data = network.bind(1)
+        sndr = SelectiveRepeatSender(window_size=8, window_policy=FixedWindow(8), inbound_port=2, outbound_port=1,
+                                     **channel)
+        sndr.start([b"x"] * 8)
+        self.drain(data)
+        sndr.frames_received([packet.encode(0, ack_number=1, flags=packet.ACK),
+                              # reordered: sent before the ACK above, and its SACKs cover the rest of the window
+                              packet.encode(7, ack_number=0, flags=packet.ACK, payload=packet.sack(0, range(1, 8)))])
+        assert not sndr.outstanding and sndr.base == 8
+        # nothing left to fast retransmit, only the FIN
+        assert [segment.flags for segment in self.drain(data)] == [packet.FIN]
+        sndr.finish()
+
+
+class TestClose(unittest.TestCase):
+    def test_receiver_closes_on_fin(self):
+        loop = engine.VirtualLoop()
+        network = loopback.Network(loop)
+        data = bytearray(os.urandom(50 * 1000))
+        output = BytesIO()
+        rcvr = SelectiveRepeatReceiver(timeout=60, output=output, loop=loop, network=network, seed=1)
+        sndr = SelectiveRepeatSender(loop=loop, network=network, seed=2)
+        rcvr.start()
+        sndr.send(data)
+        assert rcvr.done and sndr.done
+        assert output.getvalue() == data
+        # long before the receiver would have given up
+        assert loop.time() < 1
+
+    def test_sender_gives_up_on_the_fin(self):
+        loop = engine.VirtualLoop()
+        network = loopback.Network(loop)
+        # nobody answers, e.g. because the receiver closed and its FIN | ACK got lost
+        fins = network.bind(1)
+        sndr = SelectiveRepeatSender(time_wait=2, loop=loop, network=network, inbound_port=2, outbound_port=1,
+                                     drop_error_prob=0, random_error_prob=0, swap_error_prob=0)
+        sndr.start([b"abc"])
+        sndr.frames_received([packet.encode(0, ack_number=1, flags=packet.ACK)])
+        loop.run()
+        assert sndr.done
+        assert 2 <= loop.time() < 3
+        frames = [packet.decode(fins.recv(ChannelSimulator.BUFFER_SIZE)) for _ in range(len(fins.queue))]
+        assert frames[0].sequence_number == 0
+        assert all(frame == packet.Packet(packet.FIN, 1, 0, packet.LENGTH.pack(3)) for frame in frames[1:])
+        # backing off
+        assert 2 < len(frames) < 16
+
+    def test_stop_and_wait(self):
+        network = loopback.Network()
+        data = bytearray(os.urandom(20 * 1000))
+        output = BytesIO()
+        rcvr = OurReceiver(output=output, network=network, seed=1)
+        thread = threading.Thread(target=rcvr.receive)
+        thread.start()
+        sndr = OurSender(network=network, seed=2)
+        sndr.send(data)
+        # the receiver is done as soon as it answers the FIN, its timeouts would take seconds
+        thread.join(1)
+        assert not thread.is_alive()
+        assert output.getvalue() == data
+        # the timeout follows the loopback's round trip instead of staying at its initial guess
+        assert sndr.timeout_policy.srtt is not None
+        assert sndr.timeout == sndr.timeout_policy.rto < 0.05
+
+    def test_stop_and_wait_receiver_gives_up(self):
+        network = loopback.Network()
+        rcvr = OurReceiver(timeout=0.2, output=BytesIO(), network=network)
+        start = time.time()
+        rcvr.receive()
+        assert 0.2 <= time.time() - start < 1
+
+
+class TestServer(unittest.TestCase):
+    @staticmethod
+    def send(sndr, data, finished):
+        sndr.connect(packet.REPLY.pack(sndr.inbound_port), lambda reply: sndr.start(
+            utils.iter_segments(data, sndr.MSS), on_done=lambda: finished.append(sndr)))
+
+    def test_concurrent_sessions(self):
+        loop = engine.VirtualLoop()
+        network = loopback.Network(loop)
+        directory = tempfile.mkdtemp()
+        m = metrics.Metrics("server")
+        srvr = server.Server(server.files(directory), max_sessions=20, loop=loop, network=network, inbound_port=1,
+                             metrics=m, seed=1, drop_error_prob=0.02)
+        inputs = [os.urandom(20 * 1000 + n) for n in range(20)]
+        sndrs = [SelectiveRepeatSender(loop=loop, network=network, inbound_port=100 + n, outbound_port=1, seed=n + 2,
+                                       drop_error_prob=0.02) for n in range(20)]
+        finished = []
+        for sndr, data in zip(sndrs, inputs):
+            self.send(sndr, data, finished)
+        srvr.start()
+        loop.run()
+        assert srvr.done and len(finished) == 20 and not srvr.sessions
+        for sndr, data in zip(sndrs, inputs):
+            with open(os.path.join(directory, "{:08x}".format(sndr.connection)), "rb") as f:
+                assert f.read() == data
+        assert m.counters[metrics.SESSIONS] == 20
+        assert m.summary(metrics.SESSION_LATENCY)["count"] == 20
+
+    def test_acks_take_turns(self):
+        loop = engine.VirtualLoop()
+        network = loopback.Network(loop)
+        srvr = server.Server(lambda connection: BytesIO(), ack_budget=2, loop=loop, network=network, inbound_port=1,
+                             drop_error_prob=0, random_error_prob=0, swap_error_prob=0)
+        ports = [network.bind(100 + n) for n in range(3)]
+        srvr.frames_received([packet.encode(0, flags=packet.SYN, payload=packet.REPLY.pack(100 + n), connection=n)
+                              for n in range(3)])
+        # the first session sends far more, out of order so that every segment owes an ACK at once
+        srvr.frames_received([packet.encode(1 + n, payload=b"x", connection=0) for n in range(10)] +
+                             [packet.encode(1, payload=b"x", connection=n) for n in (1, 2)])
+        acks = [[packet.decode(frame) for frame in port.queue if packet.decode(frame).flags == packet.ACK]
+                for port in ports]
+        # a turn has room for 2 ACKs and the first session only gets one for all of its segments
+        assert [len(session) for session in acks] == [1, 1, 0]
+        assert acks[0][0].connection == 0 and packet.sacked(0, acks[0][0].payload) == range(1, 11)
+        loop.run_once()
+        assert len([frame for frame in ports[2].queue if packet.decode(frame).flags == packet.ACK]) == 1
+
+    def test_closed_connection_stays_closed(self):
+        loop = engine.VirtualLoop()
+        network = loopback.Network(loop)
+        outputs = []
+        srvr = server.Server(lambda connection: outputs.append(BytesIO()) or outputs[-1], loop=loop, network=network,
+                             inbound_port=1, drop_error_prob=0, random_error_prob=0, swap_error_prob=0)
+        replies = network.bind(100)
+        syn = packet.encode(0, flags=packet.SYN, payload=packet.REPLY.pack(100), connection=7)
+        fin = packet.encode(0, flags=packet.FIN, payload=packet.LENGTH.pack(0), connection=7)
+        srvr.frames_received([syn, fin])
+        # a late copy of the SYN and the FIN again, because its answer got lost
+        srvr.frames_received([syn, fin, packet.encode(0, payload=b"x", connection=7)])
+        assert len(outputs) == 1 and not srvr.sessions
+        frames = [packet.decode(frame) for frame in replies.queue]
+        assert [frame.flags for frame in frames] == [packet.SYN | packet.ACK] + [packet.FIN | packet.ACK] * 2
+        assert all(frame.connection == 7 for frame in frames)
+
+
+    def test_idle_sessions_past_max_sessions(self):
+        loop = engine.VirtualLoop()
+        network = loopback.Network(loop)
+        srvr = server.Server(lambda connection: BytesIO(), max_sessions=1, timeout=1, loop=loop, network=network,
+                             inbound_port=1, drop_error_prob=0, random_error_prob=0, swap_error_prob=0)
+        srvr.start()
+        # two senders that go quiet right after their SYN, the first one to be dropped is the last session served
+        srvr.frames_received([packet.encode(0, flags=packet.SYN, payload=packet.REPLY.pack(100 + n), connection=n)
+                              for n in range(2)])
+        loop.run()
+        assert srvr.done and not srvr.sessions
+        assert srvr.ended == 2
+
+
+class TestFEC(unittest.TestCase):
+    def test_recover_each_segment(self):
+        payloads = [bytearray(os.urandom(100)) for _ in range(4)] + [bytearray(b"\x00short")]
+        encoder = fec.ParityEncoder(8, 100)
+        for payload in payloads:
+            assert encoder.add(payload) is None
+        count, parity = encoder.flush()
+        assert count == len(payloads)
+        assert encoder.flush() is None
+        for n, payload in enumerate(payloads):
+            assert fec.recover(parity, payloads[:n] + payloads[n + 1:]) == payload
+
+    def test_full_block(self):
+        encoder = fec.ParityEncoder(2, 10)
+        assert encoder.add(b"a" * 10) is None
+        count, parity = encoder.add(b"")
+        assert count == 2
+        assert fec.recover(parity, [b"a" * 10]) == b""
+        assert fec.recover(parity, [b""]) == b"a" * 10
+
+    def test_receiver_rebuilds_lost_segment(self):
+        payloads = [bytearray(os.urandom(50)) for _ in range(4)]
+        encoder = fec.ParityEncoder(4, 50)
+        for payload in payloads:
+            parity = encoder.add(payload)
+        output = BytesIO()
+        rcvr = SelectiveRepeatReceiver(timeout=0.5, output=output, fec=4, inbound_port=44471, outbound_port=55571)
+        rcvr.start()
+        # segment 1 never arrives
+        frames = [packet.encode(n, payload=payloads[n]) for n in (0, 2, 3)]
+        frames.append(packet.encode(0, ack_number=parity[0], flags=packet.PARITY, payload=parity[1]))
+        rcvr.frames_received(frames)
+        rcvr.finish()
+        assert output.getvalue() == b"".join(bytes(p) for p in payloads)
+        assert rcvr.blocks == {} and rcvr.parities == {}
+
+
+class TestAdaptiveTimeout(unittest.TestCase):
+    def test_first_sample(self):
+        t = AdaptiveTimeout(initial=1, minimum=0, maximum=10)
+        t.sample(0.1)
+        # SRTT + 4 * RTTVAR + the receiver's ACK delay = 0.1 + 4 * 0.05 + 0.001
+        assert abs(t.rto - 0.301) < 1e-9
+
+    def test_stable_samples_converge(self):
+        t = AdaptiveTimeout(initial=1, minimum=0, maximum=10)
+        for _ in range(200):
+            t.sample(0.1)
+        assert abs(t.srtt - 0.1) < 1e-6
+        assert t.rto < 0.11
+        # but never right on top of the RTT, nor on top of a delayed ACK
+        assert t.rto >= 0.1 + t.granularity + t.max_ack_delay
+
+    def test_backoff_is_bounded(self):
+        t = AdaptiveTimeout(initial=0.1, minimum=0, maximum=1)
+        t.backoff()
+        assert abs(t.rto - 0.2) < 1e-9
+        for _ in range(10):
+            t.backoff()
+        assert t.rto == 1
+        # a new sample resets the backoff
+        t.sample(0.01)
+        assert t.rto < 0.1
+
+
+class TestAIMDWindow(unittest.TestCase):
+    def test_slow_start_then_congestion_avoidance(self):
+        w = AIMDWindow(initial=2, ssthresh=4, maximum=100)
+        w.on_ack()
+        w.on_ack()
+        assert w.size == 4
+        # about one segment per window's worth of ACKs
+        for _ in range(4):
+            w.on_ack()
+        assert w.size == 4
+        for _ in range(4):
+            w.on_ack()
+        assert w.size == 5
+
+    def test_fast_retransmit_after_three_duplicates(self):
+        w = AIMDWindow(initial=16, ssthresh=64)
+        assert not w.on_duplicate_ack()
+        assert not w.on_duplicate_ack()
+        assert w.on_duplicate_ack()
+        assert w.size == 8
+        # only once per hole
+        assert not w.on_duplicate_ack()
+
+    def test_timeout_collapses_window(self):
+        w = AIMDWindow(initial=16, ssthresh=64, minimum=2)
+        w.on_timeout()
+        assert w.size == 2
+        assert w.ssthresh == 8
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,5 +1,10 @@
 import datetime
+import io
 import logging
+import mmap
+import os
+import stat
+import sys
 
 
 class Logger(object):
@@ -16,3 +21,88 @@ class Logger(object):
     @staticmethod
     def debug(message):
         logging.debug(message)
+
+
+def iter_segments(data, segment_size):
+    """
+    Slice in-memory input into segments without copying it
+    :param data: input bytes (anything that supports the buffer protocol)
+    :param segment_size: maximum segment size
+    :return: generator of memoryviews into data
+    """
+    view = memoryview(data)
+    for start in xrange(0, len(view), segment_size):
+        yield view[start:start + segment_size]
+
+
+def read_segments(stream, segment_size, chunk_segments=1024, offset=0, length=None):
+    """
+    Stream segments out of a file so that only a bounded part of it is ever in memory.
+    Regular files are mmapped, anything else (e.g. a pipe) is read chunk_segments segments at a time.
+    :param stream: file object opened for reading
+    :param segment_size: maximum segment size
+    :param chunk_segments: number of segments per read for non regular files
+    :param offset: byte to start at
+    :param length: number of bytes to read, None for everything up to the end
+    :return: generator of segments
+    """
+    fd = stream.fileno()
+    status = os.fstat(fd)
+    if stat.S_ISREG(status.st_mode) and status.st_size > 0:
+        end = status.st_size if length is None else min(offset + length, status.st_size)
+        mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        try:
+            # slicing an mmap copies just the one segment, the page cache holds the rest
+            for start in xrange(offset, end, segment_size):
+                yield mapped[start:min(start + segment_size, end)]
+        finally:
+            mapped.close()
+        return
+    # not seekable, skip the offset by reading it
+    while offset > 0:
+        skipped = len(stream.read(min(offset, segment_size * chunk_segments)))
+        if not skipped:
+            return
+        offset -= skipped
+    while length is None or length > 0:
+        chunk_size = segment_size * chunk_segments
+        chunk = stream.read(chunk_size if length is None else min(chunk_size, length))
+        if not chunk:
+            return
+        if length is not None:
+            length -= len(chunk)
+        for segment in iter_segments(chunk, segment_size):
+            yield segment
+
+
+def resegment(chunks, segment_size):
+    """
+    Cut a stream that comes in pieces of any size into full segments
+    :param chunks: iterable of bytes
+    :param segment_size: segment size
+    :return: generator of segments of exactly segment_size bytes, except for the last one
+    """
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        if len(pending) < segment_size:
+            continue
+        full = len(pending) - len(pending) % segment_size
+        view = memoryview(pending)
+        # the segments keep viewing this buffer, the rest of the stream goes into a new one
+        pending = pending[full:]
+        for start in xrange(0, full, segment_size):
+            yield view[start:start + segment_size]
+    if pending:
+        yield memoryview(pending)
+
+
+def buffered_stdout(buffer_size=1 << 20):
+    """
+    Binary writer on stdout that only makes a write syscall once buffer_size bytes have piled up.
+    It has to be flushed before exiting.
+    :param buffer_size: bytes to buffer
+    :return: buffered file object
+    """
+    return io.open(sys.stdout.fileno(), "wb", buffering=buffer_size, closefd=False)
+
@@ -0,0 +1,245 @@
+import os
+import sys
+import time
+import errno
+import random
+import socket
+import asyncio
+import argparse
+import selectors
+import threading
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import project1
+
+
+# usage: py benchmark.py [--base n] [--ports n] [--hosts n] [--open n] [--filtered n] [--seed n] [--skip-baseline] [-h]
+# Scans stand-in servers on 127.0.0.1 and up with the blocking engine project1.py used to have and with the current
+# one, which scans all of them as one CIDR block and probes the open ports, then rescans them from its cache.
+
+
+# the services behind the open ports, taking turns: (service, greeting, answer to a request)
+# The last one reads the request and hangs up, so only the port table can name it.
+STUBS = (
+    ("ssh", b"SSH-2.0-OpenSSH_9.6p1 Ubuntu-3ubuntu13\r\n", None),
+    ("smtp", b"220 mail.example.com ESMTP Postfix (Debian/GNU)\r\n", None),
+    ("ftp", b"220 (vsFTPd 3.0.5)\r\n", None),
+    ("http", None, b"HTTP/1.1 200 OK\r\nServer: nginx/1.24.0\r\nContent-Length: 0\r\n\r\n"),
+    (None, None, None)
+)
+
+
+class StandIn:
+    # opens some ports of a range on a loopback address and filters others, the rest are closed. Open ports run
+    # one of the STUBS each.
+    # A filtered port is a listening socket with a backlog of 0 that never accepts: once one connection fills its
+    # queue the kernel drops every SYN, so connects time out like they do against a firewall.
+
+    def __init__(self, base, count, openCount, filteredCount, seed=0, address="127.0.0.1"):
+        ports = list(range(base, base + count))
+        picked = random.Random(seed).sample(ports, openCount + filteredCount)
+        self.address = address
+        self.open = sorted(picked[:openCount])
+        self.filtered = sorted(picked[openCount:])
+        self.stubs = {port: STUBS[i % len(STUBS)] for i, port in enumerate(self.open)}
+        # the service the probe should come up with
+        table = project1.Services()
+        self.services = {port: stub[0] or table.get(port) for port, stub in self.stubs.items()}
+        self.listeners = []
+        self.fillers = []
+        self.selector = selectors.DefaultSelector()
+        self.stopped = threading.Event()
+        # bind the whole range first, so that nothing else listens on it and no filler's own port lands in it
+        bound = []
+        for port in ports:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # earlier runs leave connections in TIME_WAIT, which is no reason to fail
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            bound.append(s)
+            try:
+                s.bind((address, port))
+            except OSError:
+                for s in bound:
+                    s.close()
+                sys.exit(F"Port {port} is in use, pick another --base")
+        for port, s in zip(ports, bound):
+            if port in self.open:
+                s.listen(128)
+                s.setblocking(False)
+                self.selector.register(s, selectors.EVENT_READ)
+                self.listeners.append(s)
+            elif port in self.filtered:
+                s.listen(0)
+                self.listeners.append(s)
+        for port in self.filtered:
+            self.fillers.append(socket.create_connection((address, port)))
+        for port, s in zip(ports, bound):
+            if port not in self.open and port not in self.filtered:
+                s.close()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        # listening sockets are registered without data, connections with what to answer once the client speaks
+        while not self.stopped.is_set():
+            for key, _ in self.selector.select(0.1):
+                try:
+                    if key.data is None:
+                        self.accept(key.fileobj)
+                    else:
+                        self.answer(key.fileobj, key.data)
+                except OSError:
+                    pass
+
+    def accept(self, listener):
+        s = listener.accept()[0]
+        _, greeting, answer = self.stubs[listener.getsockname()[1]]
+        if greeting is None:
+            s.setblocking(False)
+            self.selector.register(s, selectors.EVENT_READ, answer or b"")
+            return
+        try:
+            s.sendall(greeting)
+        finally:
+            s.close()
+
+    def answer(self, s, answer):
+        self.selector.unregister(s)
+        try:
+            if s.recv(4096) and answer:
+                s.sendall(answer)
+        finally:
+            s.close()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                key.fileobj.close()
+        for s in self.listeners + self.fillers:
+            s.close()
+        self.selector.close()
+
+
+def blockingScan(address, ports, workers=4, timeout=1):
+    # the engine project1.py used to have: one blocking connect per port with a fixed timeout, on a few threads
+    def scanPort(port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        try:
+            error = s.connect_ex((address, port))
+        finally:
+            s.close()
+        if error == 0:
+            return port, project1.OPEN
+        # connect_ex reports a timeout as EAGAIN
+        return port, project1.FILTERED if error in (errno.EAGAIN, errno.ETIMEDOUT) else project1.CLOSED
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(executor.map(scanPort, ports))
+
+
+def report(name, seconds, results, standIns, count, probed=False):
+    # results are {(address, port): result}, as project1.result makes them
+    correct = True
+    found = filtered = identified = 0
+    for standIn in standIns:
+        mine = {port: found for (address, port), found in results.items() if address == standIn.address}
+        opened = sorted(port for port, found in mine.items() if found["state"] == project1.OPEN)
+        dropped = sorted(port for port, found in mine.items() if found["state"] == project1.FILTERED)
+        correct &= opened == standIn.open and dropped == standIn.filtered
+        found += len(opened)
+        filtered += len(dropped)
+        identified += sum(mine[port].get("service") == standIn.services[port] for port in opened)
+    correct &= len(results) == count and (not probed or identified == found)
+    print(F"{name:<10} {seconds:>9.2f} {count / seconds:>10.0f} {found:>6} {filtered:>9} "
+          F"{F'{identified}/{found}' if probed else '-':>10} {'yes' if correct else 'NO':>8}")
+    return correct
+
+
+async def scanAndProbe(scanner, targets, ports, onResult, cache=None):
+    # the way project1.py runs its two stages, minus the output
+    prober = project1.Prober(onResult, project1.Services())
+
+    async def collect(host, address, port, state, s):
+        if s is None:
+            onResult(project1.result(host, address, port, state))
+        else:
+            await prober.put(host, address, port, s)
+
+    await scanner.scan(project1.work(targets, ports, cache), collect)
+    await prober.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # below the usual ephemeral range, where a connect could end up talking to itself
+    parser.add_argument("--base", type=int, default=20000, help="first port of the range to scan")
+    parser.add_argument("--ports", type=int, default=1024, help="number of ports to scan")
+    parser.add_argument("--hosts", type=int, default=1, help="stand-ins to scan, on 127.0.0.1 and up")
+    parser.add_argument("--open", type=int, default=20, help="ports each stand-in opens")
+    parser.add_argument("--filtered", type=int, default=50, help="ports each stand-in filters")
+    parser.add_argument("--seed", type=int, default=0, help="seed for picking the open and filtered ports")
+    parser.add_argument("--concurrency", type=int, default=project1.CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=project1.RATE)
+    parser.add_argument("--retries", type=int, default=project1.RETRIES)
+    parser.add_argument("--skip-baseline", action="store_true", help="only run the current engine")
+    ins = parser.parse_args()
+    if ins.open + ins.filtered > ins.ports:
+        sys.exit("--open and --filtered should add up to at most --ports")
+    if not 0 < ins.hosts <= 254:
+        sys.exit("--hosts should be between 1 and 254")
+
+    # 127.0.0.0/24 less its network and broadcast address, so that the block below holds exactly these hosts
+    block = F"127.0.0.0/{32 - (ins.hosts + 1).bit_length()}" if ins.hosts > 1 else "127.0.0.1"
+    addresses = [address for _, address in project1.Targets([block])][:ins.hosts]
+    standIns = []
+    try:
+        for i, address in enumerate(addresses):
+            standIns.append(StandIn(ins.base, ins.ports, ins.open, ins.filtered, ins.seed + i, address))
+    except BaseException:
+        for standIn in standIns:
+            standIn.close()
+        raise
+    ports = range(ins.base, ins.base + ins.ports)
+    count = ins.ports * len(addresses)
+    allCorrect = True
+    print(F"{'engine':<10} {'seconds':>9} {'ports/s':>10} {'open':>6} {'filtered':>9} {'services':>10} "
+          F"{'correct':>8}")
+    try:
+        if not ins.skip_baseline:
+            start = time.monotonic()
+            results = {}
+            for address in addresses:
+                results.update(((address, port), project1.result(address, address, port, state))
+                               for port, state in blockingScan(address, ports).items())
+            allCorrect &= report("blocking", time.monotonic() - start, results, standIns, count)
+        scanner = project1.Scanner(ins.concurrency, ins.rate, max(1, min(ins.rate, project1.BURST)), ins.retries)
+        targets = project1.Targets([block])
+        cachePath = os.path.join(tempfile.mkdtemp(), "cache.jsonl")
+        for name in ("async", "rescan"):
+            cache = project1.Cache(cachePath, scope=targets)
+            results = {}
+
+            def collect(found, probed=False):
+                cache.add(found, probed)
+                if found["address"] in addresses:
+                    results[found["address"], found["port"]] = found
+
+            start = time.monotonic()
+            for address in addresses:
+                for port in ports:
+                    if cache.get(address, port) is not None:
+                        results[address, port] = cache.get(address, port)
+            asyncio.run(scanAndProbe(scanner, targets, ports, collect, cache))
+            allCorrect &= report(name, time.monotonic() - start, results, standIns, count, probed=True)
+            cache.close()
+        os.remove(cachePath)
+        os.rmdir(os.path.dirname(cachePath))
+    finally:
+        for standIn in standIns:
+            standIn.close()
+    if not allCorrect:
+        sys.exit("A scan got the port states wrong")
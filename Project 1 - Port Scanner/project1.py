@@ -1,65 +1,636 @@
+import os
+import re
 import sys
+import json
+import time
+import errno
 import socket
+import asyncio
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+import collections
+import ipaddress
 
+try:
+    import resource
+except ImportError:
+    # Windows has no file descriptor limit to raise
+    resource = None
 
-# usage: py project1.py hostname [-p m:n] [-h]
 
+# usage: py project1.py target [target ...] [-p ports | --top-ports n] [--hosts-file file] [--all] [--no-probe]
+#                       [--cache file] [--concurrency n] [--rate n] [--retries n] [-h]
+# targets are hostnames, IPs or CIDR blocks (e.g. 192.168.1.0/24), ports a list of ports and m:n ranges
+# (e.g. 22,80,8000:8100 or 8000-8100). Results come out as one JSON object per line, open ports with the service
+# and OS their banner and SYN-ACK gave away.
 
-# https://www.netresec.com/?page=Blog&month=2011-11&post=Passive-OS-Fingerprinting
-OS = {
-    (64, 5840): "Linux (kernel 2.4 and 2.6)",
-    (64, 5720): "Google's customized Linux",
-    (64, 65535): "FreeBSD",
-    (128, 65535): "Windows XP",
-    (128, 8192): "Windows 7, Vista and Server 2008",
-    (255, 4128): "Cisco Router (iOS 12.4)"
-}
 
+# What the target's SYN-ACK offers gives its TCP stack away, the way p0f tells them apart: timestamps, selective
+# acknowledgements and the window scale, None when it offered none. (The TTL and window size it arrived with would
+# tell more, but only a raw socket gets to see those.)
+OS = (
+    (True, True, range(7, 15), "Linux"),
+    (True, True, (5, 6), "FreeBSD or macOS"),
+    (False, True, (8,), "Windows (Vista and later)"),
+    (False, True, (None,), "Windows XP"),
+    (False, False, (None,), "Cisco IOS or another embedded stack")
+)
+# bits of tcp_info's options (linux/tcp.h)
+TCPI_OPT_TIMESTAMPS = 1
+TCPI_OPT_SACK = 2
+TCPI_OPT_WSCALE = 4
 
-def scanPort(args):
-    (hostname, port) = args
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(1)
-        connect = s.connect_ex((hostname, port))
-        if connect == 0:
-            ttl = s.getsockopt(socket.IPPROTO_IP, socket.IP_TTL)
-            # https://stackoverflow.com/questions/9615321/is-the-tcp-window-size-relevant-to-the-snd-buf-or-rcv-buf-of-the-tcp-socket
-            winSize = s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
-            if OS.get((ttl, winSize)) is not None:
-                print(F"Port {port} - {OS.get((ttl, winSize))}", end=" ")
+# banner -> service, the version in the product group where the banner has one
+SIGNATURES = tuple((re.compile(pattern, re.I | re.S), service) for pattern, service in (
+    (rb"^SSH-[\d.]+-(?P<product>[^\r\n]+)", "ssh"),
+    (rb"^HTTP/\d\.\d \d{3}(?:.*?\nServer: *(?P<product>[^\r\n]+))?", "http"),
+    (rb"^220[ -][^\r\n]*\bE?SMTP\b", "smtp"),
+    (rb"^220[ -][^\r\n]*FTP", "ftp"),
+    (rb"^\+OK", "pop3"),
+    (rb"^\* (?:OK|PREAUTH)", "imap"),
+    (rb"^RFB \d{3}\.\d{3}", "vnc"),
+    (rb"^.{3}\x00\x0a(?P<product>[\d.]+[^\x00]*)\x00", "mysql")
+))
+# banner -> OS, for the services that name the one they run on
+OS_HINTS = tuple((re.compile(pattern, re.I), system) for pattern, system in (
+    (rb"Ubuntu|Debian|Raspbian|CentOS|Red Hat|Fedora|Alpine", "Linux ({})"),
+    (rb"Microsoft|Win32|Win64|Windows", "Windows"),
+    (rb"FreeBSD|OpenBSD|NetBSD", "{}")
+))
+
+OPEN = "open"
+CLOSED = "closed"
+FILTERED = "filtered"
+# nothing came back: the port may be filtered, or the SYN or its answer got lost
+NO_ANSWER = None
+
+# connects in flight at once, lowered to what the open file limit allows
+CONCURRENCY = 2000
+# new connects per second, and how many may start at once after a quiet spell
+RATE = 5000
+BURST = 500
+# extra attempts for ports that didn't answer, each waits twice as long as the one before
+RETRIES = 1
+# connect timeout before the first round trip is measured, and its bounds after that, in seconds
+INITIAL_TIMEOUT = 1
+MIN_TIMEOUT = 0.1
+MAX_TIMEOUT = 5
+# errors that say more about our end than about the port, so the port is tried again
+LOCAL_ERRORS = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.EAGAIN, errno.EADDRNOTAVAIL}
+
+# nmap's 100 most frequently open TCP ports, most frequent first
+TOP_PORTS = (
+    80, 23, 443, 21, 22, 25, 3389, 110, 445, 139, 143, 53, 135, 3306, 8080, 1723, 111, 995, 993, 5900, 1025, 587,
+    8888, 199, 1720, 465, 548, 113, 81, 6001, 10000, 514, 5060, 179, 1026, 2000, 8443, 8000, 32768, 554, 26, 1433,
+    49152, 2001, 515, 8008, 49154, 1027, 5666, 646, 5000, 5631, 631, 49153, 8081, 2049, 88, 79, 5800, 106, 2121,
+    1110, 49155, 6000, 513, 990, 5357, 427, 49156, 543, 544, 5101, 144, 7, 389, 8009, 3128, 444, 9999, 5009, 7070,
+    5190, 3000, 5432, 1900, 3986, 13, 1029, 9, 5051, 6646, 49157, 1028, 873, 1755, 2717, 4899, 9100, 119, 37
+)
+
+# probes of open ports running at once, and as many more waiting for one
+PROBE_CONCURRENCY = 100
+# seconds to wait for a service to greet, and for an answer once asked
+GREETING_TIMEOUT = 1
+PROBE_TIMEOUT = 3
+BANNER_SIZE = 4096
+# port -> service name database, as on any Unix
+SERVICES_FILE = "/etc/services"
+# services that wait for the client to speak first, so there is no point in waiting for a greeting
+CLIENT_FIRST = {"http", "https", "http-alt", "webcache", "www-http"}
+HTTP_PROBE = "HEAD / HTTP/1.0\r\nHost: {}\r\nUser-Agent: project1\r\n\r\n"
+# the cache's write buffer in bytes, and how often its results reach the file at the latest, in seconds
+CACHE_BUFFER = 1 << 16
+CACHE_FLUSH_INTERVAL = 1
+# open files kept for everything but the connects in flight: probes and their queue, and some to spare
+RESERVED_FILES = 64 + 2 * PROBE_CONCURRENCY
+
+
+class AdaptiveTimeout:
+    # connect timeout from the round trip times seen so far, the way TCP computes its RTO (RFC 6298)
+
+    def __init__(self, initial=INITIAL_TIMEOUT, minimum=MIN_TIMEOUT, maximum=MAX_TIMEOUT):
+        self.timeout = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.srtt = None
+        self.rttvar = None
+
+    def sample(self, rtt):
+        # both an accepted and a refused connect take one round trip
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = min(max(self.srtt + 4 * self.rttvar, self.minimum), self.maximum)
+
+
+class TokenBucket:
+    # holds the connect rate to `rate` per second on average, with bursts of up to `burst`
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def openFileLimit(wanted):
+    # every connect in flight holds a socket, so raise the soft limit on open files as far as needed and allowed
+    if resource is None:
+        return wanted
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        except (ValueError, OSError):
+            soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    return wanted if soft == resource.RLIM_INFINITY else soft
+
+
+def parsePorts(spec):
+    # "22,80,8000:8100" -> sorted list of unique ports, ranges may be written m-n too
+    ports = set()
+    for part in spec.split(','):
+        nums = part.replace('-', ':').split(':')
+        begin = int(nums[0])
+        end = int(nums[-1])
+        if len(nums) > 2 or begin > end:
+            raise ValueError("Input range should be ascending, or equal to scan a single port")
+        ports.update(range(begin, end + 1))
+    if min(ports) < 1 or max(ports) > 65535:
+        raise ValueError("Ports should be between 1 and 65535")
+    return sorted(ports)
+
+
+class Targets:
+    # the hosts to scan: every name is resolved once, up front, and CIDR blocks are walked instead of listed, so
+    # iterating over a /16 takes no memory
+
+    def __init__(self, specs):
+        self.specs = []
+        # hostname -> address
+        self.addresses = {}
+        for spec in specs:
+            try:
+                self.specs.append(ipaddress.IPv4Network(spec, strict=False))
+            except ValueError:
+                self.specs.append(spec)
+
+    async def resolve(self):
+        loop = asyncio.get_running_loop()
+        names = list({spec for spec in self.specs if isinstance(spec, str)})
+        found = await asyncio.gather(*(loop.getaddrinfo(name, None, family=socket.AF_INET, type=socket.SOCK_STREAM)
+                                       for name in names), return_exceptions=True)
+        for name, info in zip(names, found):
+            if isinstance(info, socket.gaierror):
+                sys.exit(F"Hostname {name} could not be resolved")
+            if isinstance(info, BaseException):
+                raise info
+            self.addresses[name] = info[0][4][0]
+
+    def __iter__(self):
+        # (host as given, address) of every host
+        for spec in self.specs:
+            if isinstance(spec, str):
+                yield spec, self.addresses[spec]
+            elif spec.num_addresses == 1:
+                yield str(spec.network_address), str(spec.network_address)
             else:
-                print(F"Port {port} - Unknown OS", end=" ")
+                for address in spec.hosts():
+                    yield str(address), str(address)
+
+    def __contains__(self, address):
+        # whether the address is one of the hosts, without walking the CIDR blocks
+        return address in self.addresses.values() or any(
+            not isinstance(spec, str) and ipaddress.IPv4Address(address) in spec for spec in self.specs)
+
+
+def work(targets, ports, cache=None):
+    # port by port across all hosts, so that consecutive connects go to different hosts instead of hammering one,
+    # leaving out what the cache already knows
+    for port in ports:
+        for host, address in targets:
+            if cache is None or cache.get(address, port) is None:
+                yield host, address, port
+
+
+class Services:
+    # port -> TCP service name, read from the services database in one pass rather than with a getservbyport call
+    # per port; where there is no such file (Windows), a port is looked up the first time an open one asks for it,
+    # and remembered, misses included
+
+    def __init__(self, path=SERVICES_FILE):
+        self.table = {}
+        try:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    fields = line.split("#", 1)[0].split()
+                    if len(fields) < 2 or "/" not in fields[1]:
+                        continue
+                    port, protocol = fields[1].split("/", 1)
+                    # like getservbyport, the first name listed for a port wins
+                    if protocol == "tcp" and port.isdigit():
+                        self.table.setdefault(int(port), fields[0])
+            self.complete = True
+        except OSError:
+            self.complete = False
+
+    def get(self, port):
+        if not self.complete and port not in self.table:
+            try:
+                self.table[port] = socket.getservbyport(port, "tcp")
+            except OSError:
+                self.table[port] = None
+        return self.table.get(port)
+
+
+def fingerprint(s):
+    # (timestamps, SACK, window scale) the target's SYN-ACK offered, as the kernel keeps them for the connection;
+    # None where TCP_INFO isn't available
+    if not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        # struct tcp_info: state, ca_state, retransmits, probes, backoff, options, then snd_wscale:4 and rcv_wscale:4
+        info = s.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 8)
+    except OSError:
+        return None
+    options = info[5]
+    return (bool(options & TCPI_OPT_TIMESTAMPS), bool(options & TCPI_OPT_SACK),
+            info[6] & 0x0f if options & TCPI_OPT_WSCALE else None)
+
+
+def guessOS(options):
+    if options is not None:
+        for timestamps, sack, scales, name in OS:
+            if options[:2] == (timestamps, sack) and options[2] in scales:
+                return name
+    return "Unknown OS"
+
+
+def identify(banner):
+    # (service, product, OS) the banner gives away, None for what it doesn't
+    service = product = system = None
+    for pattern, name in SIGNATURES:
+        match = pattern.search(banner)
+        if match is not None:
+            service = name
+            if match.groupdict().get("product"):
+                product = match.group("product").decode("ascii", "replace").strip()
+            break
+    for pattern, name in OS_HINTS:
+        match = pattern.search(banner)
+        if match is not None:
+            system = name.format(match.group(0).decode("ascii", "replace"))
+            break
+    return service, product, system
+
+
+def result(host, address, port, state, **details):
+    return dict(host=host, address=address, port=port, state=state, **details)
+
+
+class Cache:
+    # results of earlier scans, one JSON object per line and host by host in memory, only for the hosts in scope (the
+    # ones being scanned, all of them when it is None). Results are appended as they settle and flushed every
+    # CACHE_FLUSH_INTERVAL seconds, so an interrupted scan leaves a usable cache and a rescan only does what is missing
+    # from it; closing the cache rewrites the file with one line per port. Filtered ports aren't kept: the silence may
+    # have been loss or our own lack of sockets, so they are scanned again. Neither are open ports that weren't
+    # probed, when this scan probes.
+
+    def __init__(self, path, probing=True, scope=None):
+        self.path = path
+        self.probing = probing
+        self.scope = scope
+        # address -> {port: result, with whether it was probed}
+        self.results = {}
+        for found in self.entries():
+            if found["state"] != FILTERED and (scope is None or found["address"] in scope):
+                self.results.setdefault(found["address"], {})[found["port"]] = found
+        self.stream = open(path, "a", buffering=CACHE_BUFFER)
+        self.flushed = time.monotonic()
+
+    def entries(self):
+        # the results in the file, oldest first
+        try:
+            with open(self.path) as lines:
+                for line in lines:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # the last line of a scan that got killed mid-write
+                        continue
+        except FileNotFoundError:
+            return
+
+    def get(self, address, port):
+        # the result to use instead of scanning the port, None if there is none
+        found = self.results.get(address, {}).get(port)
+        if found is None or found["state"] == FILTERED or (self.probing and found["state"] == OPEN and
+                                                           not found.get("probed")):
+            return None
+        return {key: value for key, value in found.items() if key != "probed"}
+
+    def add(self, found, probed=False):
+        if found["state"] == FILTERED:
+            return
+        found = dict(found, probed=probed)
+        self.results.setdefault(found["address"], {})[found["port"]] = found
+        self.stream.write(json.dumps(found) + "\n")
+        if time.monotonic() - self.flushed >= CACHE_FLUSH_INTERVAL:
+            self.stream.flush()
+            self.flushed = time.monotonic()
+
+    def close(self):
+        self.stream.close()
+        # hosts out of scope keep their lines as they were, the rest get the latest result of each port
+        compacted = self.path + ".tmp"
+        with open(compacted, "w", buffering=CACHE_BUFFER) as stream:
+            for found in self.entries():
+                if found["state"] != FILTERED and found["address"] not in self.results and (
+                        self.scope is not None and found["address"] not in self.scope):
+                    stream.write(json.dumps(found) + "\n")
+            for ports in self.results.values():
+                for found in ports.values():
+                    stream.write(json.dumps(found) + "\n")
+        os.replace(compacted, self.path)
+
+
+class Writer:
+    # every result goes through here and comes out as one JSON object per line, in the order the ports were settled
+
+    def __init__(self, stream=sys.stdout, states=(OPEN,), cache=None):
+        self.stream = stream
+        self.states = states
+        self.cache = cache
+
+    def write(self, found, cached=False, probed=False):
+        if self.cache is not None and not cached:
+            self.cache.add(found, probed)
+        if found["state"] in self.states:
+            self.stream.write(json.dumps(found) + "\n")
+
+    def close(self):
+        self.stream.flush()
+
+
+class Prober:
+    # second stage, for open ports only: fingerprints the host from the options of its SYN-ACK, then waits for the
+    # service to greet or, when it doesn't, sends an HTTP request, and matches what comes back against SIGNATURES.
+    # Probes run concurrently on the connection the scan opened, and the queue in front of them is bounded so that
+    # the scan waits rather than piling up open sockets when they fall behind. Every result goes to
+    # onProbed(result, probed=True).
+
+    def __init__(self, onProbed, table, concurrency=PROBE_CONCURRENCY, greeting=GREETING_TIMEOUT,
+                 timeout=PROBE_TIMEOUT):
+        self.onProbed = onProbed
+        self.table = table
+        self.concurrency = concurrency
+        self.greeting = greeting
+        self.timeout = timeout
+        self.queue = asyncio.Queue(concurrency)
+        self.workers = []
+        # address -> best OS guess so far, a banner naming one beats the SYN-ACK
+        self.os = {}
+
+    async def put(self, host, address, port, s):
+        if not self.workers:
+            self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.concurrency)]
+        await self.queue.put((host, address, port, s))
+
+    async def worker(self):
+        while True:
+            host, address, port, s = await self.queue.get()
+            try:
+                details = await self.probe(host, address, port, s)
+                self.onProbed(result(host, address, port, OPEN, **details), probed=True)
+            except Exception as e:
+                # one port must not take down a worker, and with it the queue the scan waits on
+                print(F"Probing {address}:{port} failed: {e!r}", file=sys.stderr)
+            finally:
+                s.close()
+                self.queue.task_done()
+
+    async def probe(self, host, address, port, s):
+        if address not in self.os:
+            self.os[address] = guessOS(fingerprint(s))
+        banner = b""
+        try:
+            # services that talk first are read, the rest are asked; the table says which kind to expect
+            if self.table.get(port) not in CLIENT_FIRST:
+                banner = await self.read(s, self.greeting)
+            if not banner:
+                await asyncio.get_running_loop().sock_sendall(s, HTTP_PROBE.format(host).encode("ascii", "replace"))
+                banner = await self.read(s, self.timeout, b"\r\n\r\n")
+        except OSError:
+            pass
+        service, product, system = identify(banner)
+        if system is not None:
+            self.os[address] = system
+        details = {"service": service or self.table.get(port), "os": self.os[address]}
+        if product is not None:
+            details["product"] = product
+        if banner:
+            details["banner"] = banner.split(b"\n", 1)[0].strip().decode("ascii", "replace")
+        return details
+
+    async def read(self, s, timeout, end=None):
+        # up to BANNER_SIZE bytes, until `end` shows up (anything at all without one), the service closes the
+        # connection or time runs out
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        data = b""
+        while len(data) < BANNER_SIZE and not (data and (end is None or end in data)):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
             try:
-                print(F"- {socket.getservbyport(port)} - Open")
-            except:
-                print(F"- Open")
-        s.close()
-    except socket.gaierror:
-        sys.exit("Hostname could not be resolved")
-    except socket.error:
-        sys.exit("Server not responding")
+                chunk = await asyncio.wait_for(loop.sock_recv(s, BANNER_SIZE - len(data)), remaining)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    async def close(self):
+        await self.queue.join()
+        for worker in self.workers:
+            worker.cancel()
+
+
+class Scanner:
+    # non-blocking connect scan: thousands of connects in flight on one event loop instead of one thread each
+
+    def __init__(self, concurrency=CONCURRENCY, rate=RATE, burst=BURST, retries=RETRIES):
+        # leave some descriptors for everything else
+        self.concurrency = max(1, min(concurrency, openFileLimit(concurrency + RESERVED_FILES) - RESERVED_FILES))
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        # hosts that answered have a timeout of their own, the rest share one learned from all of them
+        self.timeout = AdaptiveTimeout()
+        self.timeouts = {}
+
+    async def scanPort(self, address, port, backoff):
+        # returns the state of the port and, when it is open, the connected socket, which the caller then owns
+        loop = asyncio.get_running_loop()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(False)
+        start = time.monotonic()
+        connect = asyncio.ensure_future(loop.sock_connect(s, (address, port)))
+        try:
+            while not connect.done():
+                # the timeout adapts while the connect is in flight, so it is checked again every minimum timeout
+                timeout = self.timeouts.get(address, self.timeout)
+                remaining = start + timeout.timeout * backoff - time.monotonic()
+                if remaining <= 0:
+                    connect.cancel()
+                    s.close()
+                    return NO_ANSWER, None
+                await asyncio.wait((connect,), timeout=min(remaining, timeout.minimum))
+            connect.result()
+            self.sample(address, time.monotonic() - start)
+            return OPEN, s
+        except ConnectionRefusedError:
+            self.sample(address, time.monotonic() - start)
+            s.close()
+            return CLOSED, None
+        except OSError as e:
+            s.close()
+            # out of sockets or ports, or an ICMP error such as host unreachable
+            return NO_ANSWER if e.errno in LOCAL_ERRORS else FILTERED, None
+        except BaseException:
+            s.close()
+            raise
+
+    def sample(self, address, rtt):
+        self.timeout.sample(rtt)
+        if address not in self.timeouts:
+            self.timeouts[address] = AdaptiveTimeout(self.timeout.timeout)
+        self.timeouts[address].sample(rtt)
+
+    async def scan(self, items, onResult):
+        # scans (host, address, port) items, taking them from the iterator as it goes, and awaits
+        # onResult(host, address, port, state, socket) once per item, handing over the connected socket of an open
+        # port and None otherwise. Items that didn't answer wait in a queue of at most `concurrency` for another try
+        # once the fresh ones run out; when it is full they are tried again right away, so memory stays bounded
+        # however many ports are filtered.
+        items = iter(items)
+        # (host, address, port, attempt) of the items waiting for another try
+        self.waiting = retries = collections.deque()
+        exhausted = False
+
+        def take():
+            # the next fresh item, then the ones waiting for another try, None once there are neither
+            nonlocal exhausted
+            if not exhausted:
+                for host, address, port in items:
+                    return host, address, port, 0
+                exhausted = True
+            return retries.popleft() if retries else None
+
+        async def settle(host, address, port, attempt):
+            # the state of the item, None if it was queued for another try
+            while True:
+                await self.bucket.take()
+                state, s = await self.scanPort(address, port, 2 ** attempt)
+                if state is not NO_ANSWER:
+                    return state, s
+                if attempt == self.retries:
+                    return FILTERED, None
+                attempt += 1
+                # workers only stop once the fresh items are gone, and then nothing is queued any more
+                if not exhausted and len(retries) < self.concurrency:
+                    retries.append((host, address, port, attempt))
+                    return None, None
+
+        async def worker():
+            while True:
+                item = take()
+                if item is None:
+                    return
+                state, s = await settle(*item)
+                if state is not None:
+                    await onResult(*item[:3], state, s)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+
+async def main(ins, ports):
+    targets = Targets(ins.targets)
+    await targets.resolve()
+    cache = Cache(ins.cache, probing=not ins.no_probe, scope=targets) if ins.cache is not None else None
+    writer = Writer(states=(OPEN, CLOSED, FILTERED) if ins.all else (OPEN,), cache=cache)
+    scanner = Scanner(ins.concurrency, ins.rate, max(1, min(ins.rate, BURST)), ins.retries)
+    prober = Prober(writer.write, Services())
+
+    async def onResult(host, address, port, state, s):
+        if s is None:
+            writer.write(result(host, address, port, state))
+        elif ins.no_probe:
+            s.close()
+            writer.write(result(host, address, port, state, service=prober.table.get(port)))
+        else:
+            await prober.put(host, address, port, s)
+
+    try:
+        if cache is not None:
+            for port in ports:
+                for host, address in targets:
+                    if cache.get(address, port) is not None:
+                        writer.write(dict(cache.get(address, port), host=host), cached=True)
+        await scanner.scan(work(targets, ports, cache), onResult)
+        await prober.close()
+    finally:
+        writer.close()
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("hostname", help="host IP to scan")
-    parser.add_argument("-p", nargs='?', help="range of ports to scan, e.g. m:n", default="1:1024")
+    parser.add_argument("targets", nargs="*", help="hostnames, IPs or CIDR blocks to scan")
+    parser.add_argument("-p", help="ports to scan, e.g. 22,80,8000:8100", default="1:1024")
+    parser.add_argument("--top-ports", type=int, help=F"scan the n most common ports instead, up to {len(TOP_PORTS)}")
+    parser.add_argument("--hosts-file", help="file with more targets, one per line")
+    parser.add_argument("--all", action="store_true", help="report closed and filtered ports too")
+    parser.add_argument("--no-probe", action="store_true", help="don't probe open ports for their service and OS")
+    parser.add_argument("--cache", help="file of earlier results, a rescan skips the ports it has and adds the rest")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="connects in flight at once")
+    parser.add_argument("--rate", type=float, default=RATE, help="new connects per second")
+    parser.add_argument("--retries", type=int, default=RETRIES, help="extra attempts for ports that don't answer")
     ins = parser.parse_args()
     ports = None
 
-    try:
-        nums = ins.p.split(':')
-        begin = int(nums[0])
-        end = int(nums[1])
-        if begin > end:
-            sys.exit("Input range should be ascending, or equal to scan a single port")
-        ports = range(begin, end + 1)
-    except:
-        sys.exit("Improper input format\nusage: py project1.py hostname [-p m:n] [-h]")
-
-    params = ((ins.hostname, val) for val in ports)
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        executor.map(scanPort, params)
+    if ins.hosts_file is not None:
+        try:
+            with open(ins.hosts_file) as hosts:
+                ins.targets += [line.strip() for line in hosts if line.strip() and not line.startswith("#")]
+        except OSError as e:
+            sys.exit(F"Could not read {ins.hosts_file}: {e.strerror}")
+    if not ins.targets:
+        sys.exit("No targets to scan\nusage: py project1.py target [target ...] [-p ports] [-h]")
+    if ins.top_ports is not None:
+        if not 0 < ins.top_ports <= len(TOP_PORTS):
+            sys.exit(F"--top-ports should be between 1 and {len(TOP_PORTS)}")
+        ports = sorted(TOP_PORTS[:ins.top_ports])
+    else:
+        try:
+            ports = parsePorts(ins.p)
+        except ValueError as e:
+            sys.exit(F"Improper input format: {e}\nusage: py project1.py target [target ...] [-p ports] [-h]")
+    if ins.concurrency < 1 or ins.rate <= 0 or ins.retries < 0:
+        sys.exit("--concurrency and --rate should be positive and --retries at least 0")
+
+    asyncio.run(main(ins, ports))
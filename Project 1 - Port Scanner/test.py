@@ -0,0 +1,285 @@
+import asyncio
+import collections
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import project1
+from project1 import (CLOSED, FILTERED, OPEN, AdaptiveTimeout, Cache, Scanner, Services, Targets, TokenBucket,
+                      guessOS, identify, parsePorts, result, work)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestParsePorts(unittest.TestCase):
+    def test_ranges(self):
+        assert parsePorts("22") == [22]
+        assert parsePorts("8000:8003") == [8000, 8001, 8002, 8003]
+        assert parsePorts("8000-8003") == [8000, 8001, 8002, 8003]
+        assert parsePorts("5:5") == [5]
+        assert parsePorts("1:65535") == list(range(1, 65536))
+
+    def test_lists(self):
+        assert parsePorts("80,22,443") == [22, 80, 443]
+        assert parsePorts("22,20:23,8080-8081") == [20, 21, 22, 23, 8080, 8081]
+
+    def test_top_ports(self):
+        assert len(project1.TOP_PORTS) == len(set(project1.TOP_PORTS)) == 100
+        assert all(1 <= port <= 65535 for port in project1.TOP_PORTS)
+        assert project1.TOP_PORTS[0] == 80
+
+    def test_bad_input(self):
+        for spec in ("", "abc", "80,", "100:10", "1:2:3", "0", "65536", "1-70000", "-5"):
+            with self.assertRaises(ValueError):
+                parsePorts(spec)
+
+    def test_bare_p(self):
+        # -p without ports is a usage error, not a scan of the default ports
+        run = subprocess.run([sys.executable, os.path.join(HERE, "project1.py"), "127.0.0.1", "-p"],
+                             capture_output=True, text=True, timeout=30)
+        assert run.returncode == 2
+        assert "usage:" in run.stderr and "expected one argument" in run.stderr
+
+
+class TestTargets(unittest.TestCase):
+    def test_cidr(self):
+        targets = Targets(["10.0.0.0/30"])
+        assert list(targets) == [("10.0.0.1", "10.0.0.1"), ("10.0.0.2", "10.0.0.2")]
+        # host bits are dropped, the way an address with a prefix length means its network
+        assert list(Targets(["10.0.0.3/30"])) == list(targets)
+        assert "10.0.0.2" in targets and "10.0.0.9" not in targets
+
+    def test_single_address(self):
+        assert list(Targets(["192.168.1.7/32"])) == [("192.168.1.7", "192.168.1.7")]
+        assert list(Targets(["192.168.1.7"])) == [("192.168.1.7", "192.168.1.7")]
+
+    def test_hostname(self):
+        targets = Targets(["localhost", "10.0.0.1"])
+        asyncio.run(targets.resolve())
+        assert list(targets) == [("localhost", "127.0.0.1"), ("10.0.0.1", "10.0.0.1")]
+        assert "127.0.0.1" in targets
+
+    def test_walks_blocks(self):
+        # a /8 would take gigabytes if its hosts were listed
+        hosts = iter(Targets(["10.0.0.0/8"]))
+        assert next(hosts) == ("10.0.0.1", "10.0.0.1")
+
+
+class TestWork(unittest.TestCase):
+    def test_port_by_port(self):
+        targets = Targets(["10.0.0.0/30", "10.0.1.1"])
+        assert list(work(targets, [22, 80])) == [
+            ("10.0.0.1", "10.0.0.1", 22), ("10.0.0.2", "10.0.0.2", 22), ("10.0.1.1", "10.0.1.1", 22),
+            ("10.0.0.1", "10.0.0.1", 80), ("10.0.0.2", "10.0.0.2", 80), ("10.0.1.1", "10.0.1.1", 80)]
+
+    def test_skips_cached(self):
+        class Known:
+            def get(self, address, port):
+                return {} if (address, port) == ("10.0.0.2", 22) else None
+
+        assert list(work(Targets(["10.0.0.0/30"]), [22, 80], Known())) == [
+            ("10.0.0.1", "10.0.0.1", 22), ("10.0.0.1", "10.0.0.1", 80), ("10.0.0.2", "10.0.0.2", 80)]
+
+
+class Silent(Scanner):
+    # a scanner whose ports never answer, keeping track of how long the retry queue got
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tries = collections.Counter()
+        self.longest = 0
+
+    async def scanPort(self, address, port, backoff):
+        self.longest = max(self.longest, len(self.waiting))
+        self.tries[address, port] += 1
+        await asyncio.sleep(0)
+        return project1.NO_ANSWER, None
+
+
+class TestScanner(unittest.TestCase):
+    def test_retry_queue_is_bounded(self):
+        scanner = Silent(concurrency=4, rate=10 ** 6, burst=10 ** 6, retries=3)
+        results = []
+
+        async def onResult(host, address, port, state, s):
+            results.append((address, port, state))
+
+        asyncio.run(scanner.scan(work(Targets(["10.0.0.0/30"]), range(1, 101)), onResult))
+        assert 0 < scanner.longest <= scanner.concurrency == 4
+        assert sorted(results) == sorted((address, port, project1.FILTERED)
+                                         for address in ("10.0.0.1", "10.0.0.2") for port in range(1, 101))
+        assert set(scanner.tries.values()) == {4}
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_rate(self):
+        bucket = TokenBucket(100, 5)
+
+        async def take(n):
+            for _ in range(n):
+                await bucket.take()
+
+        start = time.monotonic()
+        asyncio.run(take(5))
+        assert time.monotonic() - start < 0.02
+        # the burst is spent, the next 10 come at 100 per second
+        start = time.monotonic()
+        asyncio.run(take(10))
+        assert 0.08 <= time.monotonic() - start < 0.5
+
+    def test_refill_stops_at_burst(self):
+        bucket = TokenBucket(1000, 3)
+        bucket.tokens = 0
+        time.sleep(0.05)
+        asyncio.run(bucket.take())
+        assert bucket.tokens == 2
+
+
+class TestAdaptiveTimeout(unittest.TestCase):
+    def test_first_sample(self):
+        timeout = AdaptiveTimeout(initial=1, minimum=0.01, maximum=5)
+        assert timeout.timeout == 1
+        timeout.sample(0.1)
+        assert timeout.srtt == 0.1 and timeout.rttvar == 0.05
+        assert abs(timeout.timeout - 0.3) < 1e-9
+
+    def test_converges(self):
+        timeout = AdaptiveTimeout(initial=1, minimum=0.01, maximum=5)
+        for _ in range(100):
+            timeout.sample(0.02)
+        assert abs(timeout.srtt - 0.02) < 1e-6
+        assert timeout.timeout < 0.03
+
+    def test_bounds(self):
+        timeout = AdaptiveTimeout(initial=1, minimum=0.1, maximum=2)
+        timeout.sample(0.001)
+        assert timeout.timeout == 0.1
+        timeout.sample(10)
+        assert timeout.timeout == 2
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.path = os.path.join(directory, "cache.jsonl")
+        self.addCleanup(os.rmdir, directory)
+        self.addCleanup(lambda: os.path.exists(self.path) and os.remove(self.path))
+
+    def write(self, *lines):
+        with open(self.path, "w") as f:
+            f.write("".join(lines))
+
+    def entry(self, address, port, state, probed=False, **details):
+        return json.dumps(dict(result(address, address, port, state, **details), probed=probed)) + "\n"
+
+    def test_filtered_is_rescanned(self):
+        self.write(self.entry("10.0.0.1", 22, FILTERED), self.entry("10.0.0.1", 23, CLOSED))
+        cache = Cache(self.path)
+        assert cache.get("10.0.0.1", 22) is None
+        assert cache.get("10.0.0.1", 23) == result("10.0.0.1", "10.0.0.1", 23, CLOSED)
+        assert list(work(Targets(["10.0.0.1"]), [22, 23], cache)) == [("10.0.0.1", "10.0.0.1", 22)]
+        # nor does a new filtered result make it in
+        cache.add(result("10.0.0.1", "10.0.0.1", 24, FILTERED))
+        assert cache.get("10.0.0.1", 24) is None
+        cache.close()
+
+    def test_unprobed_open(self):
+        self.write(self.entry("10.0.0.1", 80, OPEN, service="http"),
+                   self.entry("10.0.0.1", 22, OPEN, probed=True, service="ssh", os="Linux"))
+        # a probing scan probes it again, one that doesn't probe can use it as it is
+        probing = Cache(self.path)
+        assert probing.get("10.0.0.1", 80) is None
+        assert probing.get("10.0.0.1", 22) == result("10.0.0.1", "10.0.0.1", 22, OPEN, service="ssh", os="Linux")
+        probing.close()
+        reusing = Cache(self.path, probing=False)
+        assert reusing.get("10.0.0.1", 80) == result("10.0.0.1", "10.0.0.1", 80, OPEN, service="http")
+        reusing.close()
+
+    def test_truncated_last_line(self):
+        line = self.entry("10.0.0.1", 22, CLOSED)
+        self.write(self.entry("10.0.0.1", 23, CLOSED), line[:len(line) // 2])
+        cache = Cache(self.path)
+        assert cache.get("10.0.0.1", 22) is None
+        assert cache.get("10.0.0.1", 23) is not None
+        cache.close()
+
+    def test_close_compacts(self):
+        self.write(self.entry("10.0.0.1", 22, CLOSED), self.entry("10.0.0.1", 22, OPEN, probed=True),
+                   self.entry("10.0.0.2", 22, FILTERED), self.entry("10.0.0.9", 22, CLOSED),
+                   self.entry("10.0.0.9", 22, CLOSED))
+        cache = Cache(self.path, scope=Targets(["10.0.0.0/30"]))
+        # hosts out of scope aren't loaded
+        assert cache.get("10.0.0.9", 22) is None
+        cache.add(result("10.0.0.2", "10.0.0.2", 22, CLOSED))
+        cache.add(result("10.0.0.1", "10.0.0.1", 22, OPEN), probed=True)
+        cache.close()
+        with open(self.path) as f:
+            lines = [json.loads(line) for line in f]
+        assert sorted((found["address"], found["port"], found["state"]) for found in lines) == [
+            ("10.0.0.1", 22, OPEN), ("10.0.0.2", 22, CLOSED), ("10.0.0.9", 22, CLOSED), ("10.0.0.9", 22, CLOSED)]
+        assert not os.path.exists(self.path + ".tmp")
+
+    def test_results_reach_the_file(self):
+        cache = Cache(self.path)
+        cache.add(result("10.0.0.1", "10.0.0.1", 22, CLOSED))
+        # buffered, until the flush interval is up or the cache is closed
+        cache.flushed -= project1.CACHE_FLUSH_INTERVAL
+        cache.add(result("10.0.0.1", "10.0.0.1", 23, CLOSED))
+        with open(self.path) as f:
+            assert len(f.readlines()) == 2
+        cache.close()
+
+
+class TestIdentify(unittest.TestCase):
+    def test_services(self):
+        assert identify(b"SSH-2.0-OpenSSH_9.6p1 Ubuntu-3ubuntu13\r\n") == ("ssh", "OpenSSH_9.6p1 Ubuntu-3ubuntu13",
+                                                                          "Linux (Ubuntu)")
+        assert identify(b"HTTP/1.1 200 OK\r\nServer: nginx/1.24.0\r\n\r\n") == ("http", "nginx/1.24.0", None)
+        assert identify(b"HTTP/1.0 404 Not Found\r\n\r\n") == ("http", None, None)
+        assert identify(b"220 mail.example.com ESMTP Postfix (Debian/GNU)\r\n") == ("smtp", None, "Linux (Debian)")
+        assert identify(b"220 (vsFTPd 3.0.5)\r\n") == ("ftp", None, None)
+        assert identify(b"+OK POP3 ready\r\n")[0] == "pop3"
+        assert identify(b"* OK IMAP4rev1 ready\r\n")[0] == "imap"
+        assert identify(b"RFB 003.008\n")[0] == "vnc"
+        assert identify(b"J\x00\x00\x00\x0a8.0.36\x00rest") == ("mysql", "8.0.36", None)
+
+    def test_os_hints(self):
+        assert identify(b"HTTP/1.1 200 OK\r\nServer: Microsoft-IIS/10.0\r\n\r\n") == ("http", "Microsoft-IIS/10.0",
+                                                                                      "Windows")
+        assert identify(b"SSH-2.0-OpenSSH_9.3 FreeBSD-20230316\r\n")[2] == "FreeBSD"
+
+    def test_unknown(self):
+        assert identify(b"") == (None, None, None)
+        assert identify(b"\x00\x01 garbage") == (None, None, None)
+
+    def test_guess_os(self):
+        assert guessOS((True, True, 7)) == "Linux"
+        assert guessOS((True, True, 6)) == "FreeBSD or macOS"
+        assert guessOS((False, True, 8)) == "Windows (Vista and later)"
+        assert guessOS((False, True, None)) == "Windows XP"
+        assert guessOS((False, False, None)) == "Cisco IOS or another embedded stack"
+        assert guessOS((True, False, 7)) == "Unknown OS"
+        assert guessOS(None) == "Unknown OS"
+
+
+class TestServices(unittest.TestCase):
+    def test_file(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".services", delete=False) as f:
+            f.write("# comment\nssh 22/tcp\nsecure 22/tcp\ndomain 53/udp\nhttp 80/tcp www # WorldWideWeb\n")
+        self.addCleanup(os.remove, f.name)
+        services = Services(f.name)
+        assert services.get(22) == "ssh" and services.get(80) == "http"
+        assert services.get(53) is None and services.get(12345) is None
+
+    def test_without_file(self):
+        services = Services(os.path.join(HERE, "missing"))
+        assert not services.complete
+        assert services.get(22) == "ssh"
+        assert 22 in services.table
+
+
+if __name__ == "__main__":
+    unittest.main()